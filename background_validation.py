@@ -0,0 +1,85 @@
+import copy
+import queue
+import atexit
+import torch
+import torch.multiprocessing as mp
+import torch.utils.data as utils
+
+'''
+Validation of weight snapshots in a separate process, used by the training
+scripts with --val_every_steps: the training loop sends a snapshot of the
+weights to the worker and keeps training, and the early stopping consumes
+the validation losses when they are ready.
+The worker evaluates on cpu with its own torch threads (--val_threads).
+'''
+
+
+def validation_worker(model, loss_fn, dataset, batch_size, num_threads, jobs, results):
+    torch.set_num_threads(num_threads)
+    loader = utils.DataLoader(dataset, batch_size, shuffle=False)
+    model.eval()
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        step, state_dict = job
+        model.load_state_dict(state_dict)
+        val_loss = 0.
+        with torch.no_grad():
+            for example_num, (x, target) in enumerate(loader):
+                loss = loss_fn(model, x, target).item()
+                val_loss += (1. / float(example_num + 1)) * (loss - val_loss)
+        results.put((step, val_loss))
+
+
+class BackgroundValidator():
+    '''
+    Evaluate weight snapshots of model on dataset in a worker process.
+    submit(step, model) sends a cpu copy of the weights and returns at once,
+    results() returns the (step, val_loss) pairs finished since the last call.
+    One snapshot is evaluated at a time: while the worker is busy,
+    submit() drops the new snapshot and returns False.
+    loss_fn(model, x, target) must be a picklable (module-level) function
+    returning the mean loss of a cpu batch.
+    '''
+    def __init__(self, model, loss_fn, dataset, batch_size, num_threads=1):
+        context = mp.get_context('spawn')
+        self.jobs = context.Queue()
+        self.results_queue = context.Queue()
+        self.pending = 0
+        model = copy.deepcopy(model).cpu()
+        self.process = context.Process(target=validation_worker, daemon=True,
+                                       args=(model, loss_fn, dataset, batch_size, num_threads,
+                                             self.jobs, self.results_queue))
+        self.process.start()
+        atexit.register(self.close)
+
+    def busy(self):
+        return self.pending > 0
+
+    def submit(self, step, model):
+        if self.busy():
+            return False
+        state_dict = {k: v.detach().cpu().clone() for k, v in model.state_dict().items()}
+        self.jobs.put((step, state_dict))
+        self.pending += 1
+        return True
+
+    def results(self, block=False):
+        finished = []
+        while self.pending > 0:
+            try:
+                finished.append(self.results_queue.get(block=block))
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('The validation process died')
+                break
+            self.pending -= 1
+        return finished
+
+    def close(self):
+        if self.process.is_alive():
+            self.jobs.put(None)
+            self.process.join(10)
+        if self.process.is_alive():
+            self.process.terminate()
@@ -0,0 +1,506 @@
+import sys, os
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.optim import Adam
+from models.SELDNet import Seldnet_vanilla, Seldnet_augmented, StreamingSeldnet, fuse_for_inference
+from models.FaSNet import FaSNet_origin, FaSNet_TAC, StreamingFaSNet, set_low_copy_layout
+from utility_functions import seld_loss, autocast, compile_model
+from utility_functions import activation_memory_mb, set_activation_checkpointing
+from data_pipeline import bucket_batches
+from evaluate_baseline_task1 import enhance_sound
+
+'''
+CPU micro-benchmarks of the baseline models on random data.
+Each benchmark prints the mean latency of the compared variants.
+Command line arguments select the benchmark and the input size, e.g.:
+python benchmark.py --benchmark seld_step --time_dim 1200 --batch_size 3
+'''
+
+
+def time_fn(fn, n_iters, n_warmup):
+    '''
+    Mean wall time of fn() in seconds, after n_warmup untimed calls
+    '''
+    for i in range(n_warmup):
+        fn()
+    t = time.time()
+    for i in range(n_iters):
+        fn()
+    return (time.time() - t) / n_iters
+
+
+def print_comparison(name, baseline, candidate, baseline_name='before', candidate_name='after'):
+    print ('{}: {} {:.1f} ms | {} {:.1f} ms | speedup x{:.2f}'.format(
+           name, baseline_name, baseline*1000, candidate_name, candidate*1000, baseline/candidate))
+
+
+def build_seldnet(architecture, args, bidirectional=True):
+    if architecture == 'seldnet_vanilla':
+        model = Seldnet_vanilla(time_dim=args.time_dim, freq_dim=256, input_channels=4,
+                                output_classes=14, pool_size=[[8,2],[8,2],[2,2]], pool_time=True,
+                                rnn_size=128, n_rnn=2, fc_size=128, dropout_perc=0.,
+                                n_cnn_filters=64, class_overlaps=3, bidirectional=bidirectional)
+    elif architecture == 'seldnet_augmented':
+        model = Seldnet_augmented(time_dim=args.time_dim, freq_dim=256, input_channels=4,
+                                  output_classes=14, pool_size=[[8,2],[8,2],[2,2],[1,1]],
+                                  cnn_filters=[64,128,256,512], pool_time=True, rnn_size=256,
+                                  n_rnn=3, fc_size=1024, dropout_perc=0.3, class_overlaps=3,
+                                  bidirectional=bidirectional)
+    return model
+
+
+def build_fasnet(architecture, args):
+    #default parameters of train_baseline_task1.py
+    if architecture == 'fasnet':
+        model = FaSNet_origin(enc_dim=64, feature_dim=64, hidden_dim=128, layer=6,
+                              segment_size=24, nspk=1, win_len=16, context_len=16, sr=16000)
+    elif architecture == 'tac':
+        model = FaSNet_TAC(enc_dim=64, feature_dim=64, hidden_dim=128, layer=6,
+                           segment_size=24, nspk=1, win_len=16, context_len=16, sr=16000)
+    return model
+
+
+def allocated_mb(fn):
+    '''
+    MB of the tensors allocated by the operators run by fn(): the memory written
+    by the outputs of the operators, copies included
+    '''
+    with torch.autograd.profiler.profile(profile_memory=True) as prof:
+        fn()
+    return sum([max(e.self_cpu_memory_usage, 0) for e in prof.function_events]) / 2.**20
+
+
+def fasnet_batch(args):
+    #random 4-channels waveforms with the default task 1 shapes
+    return torch.rand(args.batch_size, 4, int(16000 * args.segment_secs))
+
+
+def seld_batch(args):
+    #random spectrogram and seld target with the default task 2 shapes
+    x = torch.rand(args.batch_size, 4, 256, args.time_dim)
+    n_frames = args.time_dim // 8
+    target = torch.cat((torch.randint(0, 2, (args.batch_size, n_frames, 42)).float(),
+                        torch.rand(args.batch_size, n_frames, 126) * 2 - 1), -1)
+    return x, target
+
+
+def bench_seld_step(args):
+    '''
+    Training and evaluation step of train_baseline_task2: the old step ran
+    a second forward pass inside the loss, the new one reuses (sed, doa)
+    '''
+    x, target = seld_batch(args)
+    criterion_sed = nn.BCELoss()
+    criterion_doa = nn.MSELoss()
+    for architecture in ['seldnet_vanilla', 'seldnet_augmented']:
+        model = build_seldnet(architecture, args)
+        optimizer = Adam(params=model.parameters(), lr=0.00001)
+
+        def train_step(double_forward):
+            optimizer.zero_grad()
+            sed, doa = model(x)
+            if double_forward:
+                sed, doa = model(x)
+            loss = seld_loss(sed, doa, target, criterion_sed, criterion_doa, 42)
+            loss.backward()
+            optimizer.step()
+
+        def eval_step(double_forward):
+            with torch.no_grad():
+                sed, doa = model(x)
+                if double_forward:
+                    sed, doa = model(x)
+                loss = seld_loss(sed, doa, target, criterion_sed, criterion_doa, 42)
+
+        model.train()
+        before = time_fn(lambda: train_step(True), args.n_iters, args.n_warmup)
+        after = time_fn(lambda: train_step(False), args.n_iters, args.n_warmup)
+        print_comparison(architecture + ' train step', before, after)
+        model.eval()
+        before = time_fn(lambda: eval_step(True), args.n_iters, args.n_warmup)
+        after = time_fn(lambda: eval_step(False), args.n_iters, args.n_warmup)
+        print_comparison(architecture + ' eval step', before, after)
+
+
+def bench_amp(args):
+    '''
+    fp32 vs bfloat16 autocast inference latency of all baseline architectures,
+    with the max absolute difference of the outputs
+    '''
+    x_seld, _ = seld_batch(args)
+    x_fasnet = fasnet_batch(args)
+    models = [(a, build_seldnet(a, args), x_seld) for a in ['seldnet_vanilla', 'seldnet_augmented']]
+    models += [(a, build_fasnet(a, args), x_fasnet) for a in ['fasnet', 'tac']]
+    for architecture, model, x in models:
+        model.eval()
+
+        def forward(amp):
+            with torch.no_grad(), autocast(amp, 'cpu'):
+                if architecture in ['fasnet', 'tac']:
+                    out = [model(x, torch.tensor([0.]))]
+                else:
+                    out = model(x)
+            return [o.float() for o in out]
+
+        fp32 = time_fn(lambda: forward('none'), args.n_iters, args.n_warmup)
+        bf16 = time_fn(lambda: forward('bf16'), args.n_iters, args.n_warmup)
+        print_comparison(architecture + ' forward', fp32, bf16, 'fp32', 'bf16')
+        delta = max([(a - b).abs().max().item() for a, b in zip(forward('none'), forward('bf16'))])
+        print ('{}: max abs output delta {:.5f}'.format(architecture, delta))
+
+
+def bench_compile(args):
+    '''
+    Eager vs compiled (--compile inductor or torchscript) latency of all baseline
+    architectures: training step and inference forward.
+    The first call of the compiled model, that builds the graph, is timed apart
+    '''
+    x_seld, target_seld = seld_batch(args)
+    x_fasnet = fasnet_batch(args)
+    criterion_sed = nn.BCELoss()
+    criterion_doa = nn.MSELoss()
+    criterion = nn.MSELoss()
+    for architecture in ['seldnet_vanilla', 'seldnet_augmented', 'fasnet', 'tac']:
+        if architecture in ['fasnet', 'tac']:
+            model = build_fasnet(architecture, args)
+            inputs = (x_fasnet, torch.tensor([0.]))
+            loss_fn = lambda m: criterion(m(*inputs), x_fasnet[:,:1])
+        else:
+            model = build_seldnet(architecture, args)
+            inputs = (x_seld,)
+            loss_fn = lambda m: seld_loss(*m(*inputs), target_seld, criterion_sed, criterion_doa, 42)
+        optimizer = Adam(params=model.parameters(), lr=0.00001)
+
+        def train_step(m):
+            optimizer.zero_grad()
+            loss_fn(m).backward()
+            optimizer.step()
+
+        def forward(m):
+            with torch.no_grad():
+                m(*inputs)
+
+        def first_call(fn):
+            t = time.time()
+            fn()
+            print ('{}: {} graph built in {:.1f} s'.format(architecture, args.compile, time.time() - t))
+
+        model.train()
+        compiled = compile_model(model, args.compile, training=True)
+        first_call(lambda: train_step(compiled))
+        eager = time_fn(lambda: train_step(model), args.n_iters, args.n_warmup)
+        fast = time_fn(lambda: train_step(compiled), args.n_iters, args.n_warmup)
+        print_comparison(architecture + ' train step', eager, fast, 'eager', args.compile)
+        model.eval()
+        eager = time_fn(lambda: forward(model), args.n_iters, args.n_warmup)
+        compiled = compile_model(model, args.compile, inputs)
+        first_call(lambda: forward(compiled))
+        fast = time_fn(lambda: forward(compiled), args.n_iters, args.n_warmup)
+        print_comparison(architecture + ' forward', eager, fast, 'eager', args.compile)
+
+
+def bench_seg_context(args):
+    '''
+    Forward and forward+backward time of the FaSNet signal segmentation with the
+    default win_len=16, context_len=16: one gather per chunk offset vs one unfold
+    '''
+    model = build_fasnet('fasnet', args)
+    x = fasnet_batch(args).requires_grad_()
+
+    def forward(fn):
+        with torch.no_grad():
+            fn(x, model.window, model.context)
+
+    def forward_backward(fn):
+        center, chunks, rest = fn(x, model.window, model.context)
+        (center.sum() + chunks.sum()).backward()
+
+    for name, step in [('forward', forward), ('forward+backward', forward_backward)]:
+        before = time_fn(lambda: step(model.seg_signal_context_gather), args.n_iters, args.n_warmup)
+        after = time_fn(lambda: step(model.seg_signal_context), args.n_iters, args.n_warmup)
+        print_comparison('seg_signal_context ' + name, before, after, 'gather', 'unfold')
+
+
+def bench_streaming(args):
+    '''
+    Real-time factor and per-hop latency of the streaming FaSNet enhancement,
+    on a segment_secs long 4-channels stream
+    '''
+    sr = 16000
+    hop_len = int(sr * args.hop_ms / 1000)
+    lookahead = int(sr * args.lookahead_ms / 1000)
+    window_len = int(sr * args.stream_window_secs)
+    x = torch.rand(4, int(sr * args.segment_secs) // hop_len * hop_len)
+    print ('Algorithmic latency: {:.1f} ms (hop {} ms + lookahead {} ms), window {} s'.format(
+           args.hop_ms + args.lookahead_ms, args.hop_ms, args.lookahead_ms, args.stream_window_secs))
+    for architecture in ['fasnet', 'tac']:
+        streamer = StreamingFaSNet(build_fasnet(architecture, args), hop_len, window_len, lookahead)
+        for i in range(args.n_warmup):
+            streamer.process(x[:,:hop_len])
+        streamer.reset()
+        hop_times = []
+        for start in range(0, x.shape[-1], hop_len):
+            t = time.time()
+            streamer.process(x[:,start:start+hop_len])
+            hop_times.append(time.time() - t)
+        hop_times = np.array(hop_times)
+        print ('{}: real-time factor {:.3f} | hop latency mean {:.1f} ms, p95 {:.1f} ms, max {:.1f} ms'.format(
+               architecture, hop_times.sum() / (x.shape[-1] / sr), hop_times.mean()*1000,
+               np.percentile(hop_times, 95)*1000, hop_times.max()*1000))
+
+
+def bench_seld_streaming(args):
+    '''
+    Whole-recording forward vs chunked streaming of unidirectional SELDNets
+    (--chunk_frames label frames per chunk) on a time_dim frames spectrogram:
+    latency, real-time factor, peak input buffer and max output difference
+    '''
+    x = torch.rand(1, 4, 256, args.time_dim)
+    duration = args.time_dim / 80.  #80 stft frames per second
+    for architecture in ['seldnet_vanilla', 'seldnet_augmented']:
+        model = build_seldnet(architecture, args, bidirectional=False)
+        model.eval()
+        with torch.no_grad():
+            whole = time_fn(lambda: model(x), args.n_iters, args.n_warmup)
+            sed, doa = model(x)
+        streamer = StreamingSeldnet(model, args.chunk_frames)
+        hop = args.chunk_frames * streamer.pool
+        chunk_times = []
+        max_buffer = 0
+        outputs = []
+        for i in range(0, x.shape[-1], hop):
+            t = time.time()
+            outputs.append(streamer.push(x[...,i:i+hop]))
+            chunk_times.append(time.time() - t)
+            context = streamer.context.shape[-1] if streamer.context is not None else 0
+            max_buffer = max(max_buffer, streamer.pending.shape[-1] + context)
+        outputs.append(streamer.flush())
+        sed_stream = torch.cat([o[0] for o in outputs if o[0] is not None], 1)
+        doa_stream = torch.cat([o[1] for o in outputs if o[1] is not None], 1)
+        delta = max((sed - sed_stream).abs().max().item(), (doa - doa_stream).abs().max().item())
+        print ('{}: whole {:.1f} ms (RTF {:.3f}) | streaming {:.1f} ms per {} ms chunk (RTF {:.3f}), '
+               'max buffer {} frames, max abs output delta {:.6f}'.format(
+               architecture, whole*1000, whole / duration, np.mean(chunk_times)*1000,
+               args.chunk_frames * 100, sum(chunk_times) / duration, max_buffer, delta))
+
+
+def bench_bucketing(args):
+    '''
+    SELDNet inference throughput on a set of recordings of different durations
+    (--bucket_secs): batches padded to the longest duration vs batches of
+    recordings of the same duration (length buckets)
+    '''
+    rng = np.random.RandomState(1)
+    lengths = [int(80 * rng.choice(args.bucket_secs)) for i in range(args.n_items)]  #80 stft frames per second
+    max_len = max(lengths)
+    data = [torch.rand(4, 256, l) for l in lengths]
+    total_secs = sum(lengths) / 80.
+    padded_batches = [list(range(i, min(i + args.batch_size, len(data)))) for i in range(0, len(data), args.batch_size)]
+    buckets = bucket_batches(lengths, args.batch_size)
+    print ('{} recordings, {:.0f} s of audio: {} padded batches, {} bucketed batches'.format(
+           len(data), total_secs, len(padded_batches), len(buckets)))
+
+    def run_padded():
+        for batch in padded_batches:
+            x = torch.zeros(len(batch), 4, 256, max_len)
+            mask = torch.zeros(len(batch), max_len, dtype=torch.bool)
+            for j, i in enumerate(batch):
+                x[j,:,:,:lengths[i]] = data[i]
+                mask[j,:lengths[i]] = True
+            model(x, mask)
+
+    def run_bucketed():
+        for batch in buckets:
+            model(torch.stack([data[i] for i in batch]))
+
+    for architecture in ['seldnet_vanilla', 'seldnet_augmented']:
+        model = build_seldnet(architecture, args)
+        model.eval()
+        with torch.no_grad():
+            padded = time_fn(run_padded, args.n_iters, args.n_warmup)
+            bucketed = time_fn(run_bucketed, args.n_iters, args.n_warmup)
+        print_comparison(architecture + ' inference', padded, bucketed, 'padded', 'bucketed')
+        print ('{}: padded {:.1f} | bucketed {:.1f} seconds of audio per second'.format(
+               architecture, total_secs / padded, total_secs / bucketed))
+
+
+def bench_seld_fused(args):
+    '''
+    SELDNet inference latency of the eval-mode model vs the model fused for
+    inference (BatchNorm folded, Dropout removed, fused sed/doa heads),
+    for the whole forward and for the heads alone, with the max output difference
+    '''
+    x = torch.rand(args.batch_size, 4, 256, args.time_dim)
+    for architecture in ['seldnet_vanilla', 'seldnet_augmented']:
+        model = build_seldnet(architecture, args)
+        model.eval()
+        fused = fuse_for_inference(model)
+        with torch.no_grad():
+            features, _ = model.rnn(model.cnn_features(x))
+            eager = time_fn(lambda: model(x), args.n_iters, args.n_warmup)
+            fast = time_fn(lambda: fused(x), args.n_iters, args.n_warmup)
+            eager_heads = time_fn(lambda: model.heads(features), args.n_iters, args.n_warmup)
+            fast_heads = time_fn(lambda: fused.heads(features), args.n_iters, args.n_warmup)
+            sed, doa = model(x)
+            sed_fused, doa_fused = fused(x)
+        delta = max((sed - sed_fused).abs().max().item(), (doa - doa_fused).abs().max().item())
+        print_comparison(architecture + ' inference', eager, fast, 'eager', 'fused')
+        print_comparison(architecture + ' heads', eager_heads, fast_heads, 'eager', 'fused')
+        print ('{}: max abs output delta {:.2e}'.format(architecture, delta))
+
+
+def bench_checkpointing(args):
+    '''
+    Training step without and with activation checkpointing (DPRNN layers of
+    FaSNet/TAC, cnn blocks of SELDNet): memory of the activations saved by the
+    forward pass, step time and training throughput
+    '''
+    x_seld, target_seld = seld_batch(args)
+    x_fasnet = fasnet_batch(args)
+    criterion_sed = nn.BCELoss()
+    criterion_doa = nn.MSELoss()
+    criterion = nn.MSELoss()
+    print ('{:<20}{:<15}{:>18}{:>15}{:>15}'.format('architecture', 'checkpointing', 'activations MB',
+                                                  'step ms', 'samples/s'))
+    for architecture in ['fasnet', 'tac', 'seldnet_vanilla', 'seldnet_augmented']:
+        if architecture in ['fasnet', 'tac']:
+            model = build_fasnet(architecture, args)
+            loss_fn = lambda: criterion(model(x_fasnet, torch.tensor([0.])), x_fasnet[:,:1])
+        else:
+            model = build_seldnet(architecture, args)
+            loss_fn = lambda: seld_loss(*model(x_seld), target_seld, criterion_sed, criterion_doa, 42)
+        model.train()
+        optimizer = Adam(params=model.parameters(), lr=0.00001)
+
+        def train_step():
+            optimizer.zero_grad()
+            loss_fn().backward()
+            optimizer.step()
+
+        for checkpointing in [False, True]:
+            set_activation_checkpointing(model, checkpointing)
+            losses = []
+            mem = activation_memory_mb(lambda: losses.append(loss_fn()),
+                                       list(model.parameters()) + [x_fasnet, x_seld, target_seld])
+            losses[0].backward()
+            step = time_fn(train_step, args.n_iters, args.n_warmup)
+            print ('{:<20}{:<15}{:>18.1f}{:>15.1f}{:>15.2f}'.format(architecture, str(checkpointing), mem,
+                                                                   step * 1000, args.batch_size / step))
+
+
+def bench_dprnn_layout(args):
+    '''
+    FaSNet/TAC forward and backward with the standard DPRNN layers, that permute
+    and copy the features at every row, column and TAC stage, vs the low-copy layout:
+    time, MB allocated by the operators (memory traffic of the activations) and
+    max output difference
+    '''
+    x = fasnet_batch(args)
+    num_mic = torch.tensor([0.])
+    print ('{:<8}{:<10}{:>14}{:>14}{:>16}{:>16}'.format('model', 'layout', 'forward ms', 'backward ms',
+                                                        'forward MB', 'backward MB'))
+    for architecture in ['fasnet', 'tac']:
+        model = build_fasnet(architecture, args)
+        model.train()
+        outputs = []
+        for low_copy in [False, True]:
+            set_low_copy_layout(model, low_copy)
+            losses = []
+            forward = lambda: losses.append(model(x, num_mic).sum())
+            backward = lambda: losses.pop().backward()
+            forward_time = time_fn(lambda: (forward(), losses.pop()), args.n_iters, args.n_warmup)
+            step_time = time_fn(lambda: (forward(), backward()), args.n_iters, args.n_warmup)
+            forward_mb = allocated_mb(forward)
+            backward_mb = allocated_mb(backward)
+            with torch.no_grad():
+                outputs.append(model(x, num_mic))
+            print ('{:<8}{:<10}{:>14.1f}{:>14.1f}{:>16.1f}{:>16.1f}'.format(architecture,
+                   'low_copy' if low_copy else 'standard', forward_time * 1000,
+                   (step_time - forward_time) * 1000, forward_mb, backward_mb))
+        print ('{}: max abs output delta {:.2e}'.format(architecture, (outputs[0] - outputs[1]).abs().max().item()))
+
+
+def bench_enhance(args):
+    '''
+    Task 1 sliding window enhancement of a --sound_secs sound with windows of
+    --segment_secs: one forward pass per window vs batches of up to --max_batch
+    windows, with the max difference of the reconstructed waveforms.
+    The batched enhancement is also run with the model traced with --max_batch
+    windows (--compile torchscript of evaluate_baseline_task1.py), zero-padding the last batch
+    '''
+    x = torch.rand(1, 4, int(16000 * args.sound_secs))
+    length = int(16000 * args.segment_secs)
+    for architecture in ['fasnet', 'tac']:
+        model = build_fasnet(architecture, args)
+        model.eval()
+        with torch.no_grad():
+            enhance = lambda max_batch: enhance_sound(x, model, 'cpu', length, 0.5, max_batch)
+            looped = time_fn(lambda: enhance(1), args.n_iters, args.n_warmup)
+            batched = time_fn(lambda: enhance(args.max_batch), args.n_iters, args.n_warmup)
+            delta = np.abs(enhance(1) - enhance(args.max_batch)).max()
+            traced_model = compile_model(model, 'torchscript', (torch.zeros(args.max_batch, 4, length), torch.tensor([0.])))
+            enhance_traced = lambda: enhance_sound(x, traced_model, 'cpu', length, 0.5, args.max_batch, pad_batch=True)
+            traced = time_fn(enhance_traced, args.n_iters, args.n_warmup)
+            traced_delta = np.abs(enhance(args.max_batch) - enhance_traced()).max()
+        print_comparison(architecture + ' enhance_sound', looped, batched, 'per window', 'batched')
+        print_comparison(architecture + ' batched enhance_sound', batched, traced, 'eager', 'torchscript')
+        print ('{}: {:.1f} | {:.1f} | {:.1f} seconds of audio per second, max abs output delta {:.2e} | torchscript {:.2e}'.format(
+               architecture, args.sound_secs / looped, args.sound_secs / batched, args.sound_secs / traced,
+               delta, traced_delta))
+
+
+BENCHMARKS = {'seld_step': bench_seld_step,
+              'amp': bench_amp,
+              'compile': bench_compile,
+              'seg_context': bench_seg_context,
+              'streaming': bench_streaming,
+              'seld_streaming': bench_seld_streaming,
+              'bucketing': bench_bucketing,
+              'seld_fused': bench_seld_fused,
+              'checkpointing': bench_checkpointing,
+              'dprnn_layout': bench_dprnn_layout,
+              'enhance': bench_enhance}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmark', type=str, default='seld_step',
+                        help='one of: ' + ', '.join(BENCHMARKS.keys()))
+    parser.add_argument('--n_iters', type=int, default=5)
+    parser.add_argument('--n_warmup', type=int, default=1)
+    parser.add_argument('--num_threads', type=int, default=None,
+                        help='torch intra-op threads, default is torch default')
+    parser.add_argument('--batch_size', type=int, default=3)
+    parser.add_argument('--compile', type=str, default='inductor',
+                        help='compile mode of the compile benchmark: inductor or torchscript')
+    parser.add_argument('--hop_ms', type=float, default=64.,
+                        help='hop size of the streaming benchmark')
+    parser.add_argument('--lookahead_ms', type=float, default=32.,
+                        help='lookahead of the streaming benchmark')
+    parser.add_argument('--stream_window_secs', type=float, default=1.,
+                        help='input window kept by the streaming benchmark')
+    parser.add_argument('--chunk_frames', type=int, default=10,
+                        help='label frames (100 ms) per chunk of the seld streaming benchmark')
+    parser.add_argument('--bucket_secs', type=str, default='15,30,60',
+                        help='recording durations of the bucketing benchmark')
+    parser.add_argument('--n_items', type=int, default=12,
+                        help='recordings of the bucketing benchmark')
+    parser.add_argument('--time_dim', type=int, default=1200,
+                        help='stft frames of the task 2 input (4800 for 60-seconds sounds)')
+    parser.add_argument('--segment_secs', type=float, default=2.,
+                        help='length of the task 1 input waveforms in seconds')
+    parser.add_argument('--sound_secs', type=float, default=20.,
+                        help='length of the sound of the enhance benchmark in seconds')
+    parser.add_argument('--max_batch', type=int, default=16,
+                        help='max windows per forward pass of the enhance benchmark')
+
+    args = parser.parse_args()
+    args.bucket_secs = [float(d) for d in args.bucket_secs.split(',')]
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(1)
+    BENCHMARKS[args.benchmark](args)
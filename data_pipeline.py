@@ -0,0 +1,453 @@
+import os, sys
+import time
+import math
+import glob
+import pickle
+import numpy as np
+import soundfile as sf
+import librosa
+import torch
+import torch.utils.data as utils
+import utility_functions as uf
+
+'''
+Dataset backends and data loaders for the training scripts.
+The backend is selected with --dataset_backend:
+- pickle: the .pkl matrices produced by preprocessing.py, loaded in memory
+- mmap: .npy shards produced by pickle_to_shards(), memory-mapped from disk
+- wav: the raw L3DAS21 wav files, processed on the fly inside the loader workers
+Every split is read only when its loader is requested, so the test set
+is not loaded until the end of the training.
+'''
+
+SPLITS = ['train', 'validation', 'test']
+
+#argparse names of the pickle paths of each split
+PICKLE_PATHS = {'train': ('training_predictors_path', 'training_target_path'),
+                'validation': ('validation_predictors_path', 'validation_target_path'),
+                'test': ('test_predictors_path', 'test_target_path')}
+
+
+class MmapShardDataset(utils.Dataset):
+    '''
+    Dataset reading predictors/target pairs from .npy shards:
+    shard_dir/predictors_00000.npy, shard_dir/target_00000.npy, ...
+    Shards are memory-mapped lazily, so that every loader worker
+    opens its own maps after forking.
+    '''
+    def __init__(self, shard_dir):
+        self.predictors_paths = sorted(glob.glob(os.path.join(shard_dir, 'predictors_*.npy')))
+        self.target_paths = sorted(glob.glob(os.path.join(shard_dir, 'target_*.npy')))
+        if len(self.predictors_paths) == 0 or len(self.predictors_paths) != len(self.target_paths):
+            raise FileNotFoundError('No valid predictors/target shards found in ' + shard_dir)
+        #shard sizes are read from the npy headers, without loading any data
+        shard_lens = [np.load(p, mmap_mode='r').shape[0] for p in self.predictors_paths]
+        self.offsets = np.cumsum([0] + shard_lens)
+        self.shards = None
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, idx):
+        if self.shards is None:
+            self.shards = [(np.load(p, mmap_mode='r'), np.load(t, mmap_mode='r'))
+                           for p, t in zip(self.predictors_paths, self.target_paths)]
+        shard = np.searchsorted(self.offsets, idx, side='right') - 1
+        predictors, target = self.shards[shard]
+        i = idx - self.offsets[shard]
+        x = torch.from_numpy(np.array(predictors[i], dtype=np.float32))
+        y = torch.from_numpy(np.array(target[i], dtype=np.float32))
+        return x, y
+
+
+class Task1WavDataset(utils.Dataset):
+    '''
+    Raw Task1 wav files, cut into segmentation_len frames on the fly.
+    Only the requested frame is read from disk.
+    '''
+    def __init__(self, file_list, num_mics=1, segmentation_len=2, sr=16000):
+        self.num_mics = num_mics
+        self.sr = sr
+        if segmentation_len is not None:
+            self.segment_samps = int(sr * segmentation_len)
+        else:
+            self.segment_samps = sr * 10  #as in preprocessing: full sounds padded to 10 seconds
+        self.index = []
+        for sound_path, target_path in file_list:
+            n_samples = sf.info(sound_path).frames
+            if segmentation_len is None:
+                self.index.append((sound_path, target_path, 0))
+            else:
+                for start in range(0, n_samples, self.segment_samps):
+                    self.index.append((sound_path, target_path, start))
+
+    def read(self, path, start):
+        samples, sr = sf.read(path, start=start, stop=start+self.segment_samps,
+                              dtype='float32', always_2d=True)
+        if sr != self.sr:
+            raise ValueError('Expected ' + str(self.sr) + 'Hz audio, found ' + str(sr) + 'Hz in ' + path)
+        samples = samples.T
+        pad = np.zeros((samples.shape[0], self.segment_samps), dtype=np.float32)
+        pad[:,:samples.shape[-1]] = samples
+        return pad
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        sound_path, target_path, start = self.index[idx]
+        x = self.read(sound_path, start)
+        if self.num_mics == 2:
+            B_sound_path = sound_path[:-5] + 'B' +  sound_path[-4:]  #change A with B
+            x = np.concatenate((x, self.read(B_sound_path, start)), axis=-2)
+        y = self.read(target_path, start)
+        return torch.from_numpy(x), torch.from_numpy(y)
+
+
+class Task2WavDataset(utils.Dataset):
+    '''
+    Raw Task2 wav files and label csv files, turned into stft predictors and
+    seld target matrices on the fly, with the same routines of preprocessing.py
+    '''
+    def __init__(self, file_list, args, sr=32000):
+        self.file_list = file_list
+        self.args = args
+        self.sr = sr
+
+    def __len__(self):
+        return len(self.file_list)
+
+    def __getitem__(self, idx):
+        sound_path, target_path = self.file_list[idx]
+        samples, sr = librosa.load(sound_path, self.sr, mono=False)
+        if self.args.num_mics == 2:
+            B_sound_path = sound_path[:-5] + 'B' +  sound_path[-4:]  #change A with B
+            samples_B, sr = librosa.load(B_sound_path, self.sr, mono=False)
+            samples = np.concatenate((samples,samples_B), axis=-2)
+        stft = uf.spectrum_fast(samples, nperseg=self.args.stft_nperseg,
+                                noverlap=self.args.stft_noverlap,
+                                window=self.args.stft_window,
+                                output_phase=self.args.output_phase)
+        label = uf.csv_to_matrix_task2(target_path, uf.sound_classes_dict_task2,
+                                       dur=60, step=self.args.frame_len/1000., max_loc_value=2.,
+                                       no_overlaps=self.args.no_overlaps)
+        return torch.tensor(stft).float(), torch.tensor(label).float()
+
+
+class TimedLoader():
+    '''
+    Wrap a data loader measuring how long the training loop waits for data.
+    wait_time is reset at the beginning of every iteration over the loader,
+    last_wait is the wait of the last batch.
+    '''
+    def __init__(self, loader):
+        self.loader = loader
+        self.wait_time = 0.
+        self.last_wait = 0.
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.wait_time = 0.
+        iterator = iter(self.loader)
+        while True:
+            t = time.time()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.last_wait = time.time() - t
+            self.wait_time += self.last_wait
+            yield batch
+
+
+def list_task1_files(folder):
+    '''
+    List (mic A sound, clean target) path pairs of a Task1 dataset folder
+    '''
+    file_list = []
+    for sub in sorted(os.listdir(folder)):
+        sub_folder = os.path.join(folder, sub)
+        for lower in sorted(os.listdir(sub_folder)):
+            data_path = os.path.join(sub_folder, lower, 'data')
+            labels_path = os.path.join(sub_folder, lower, 'labels')
+            data = sorted([i for i in os.listdir(data_path) if i.split('.')[0].split('_')[-1]=='A'])
+            for sound in data:
+                target = sound[:-6] + sound[-4:]  #remove mic ID
+                file_list.append((os.path.join(data_path, sound), os.path.join(labels_path, target)))
+    return file_list
+
+
+def list_task2_files(folder, ov_subsets):
+    '''
+    List (mic A sound, label csv) path pairs of a Task2 dataset folder
+    '''
+    file_list = []
+    data_path = os.path.join(folder, 'data')
+    labels_path = os.path.join(folder, 'labels')
+    data = sorted([i for i in os.listdir(data_path) if i.split('.')[0].split('_')[-1]=='A'])
+    for sound in data:
+        if sound.split('_')[-3] in ov_subsets:
+            target = 'label_' + sound.replace('_A', '').replace('.wav', '.csv')
+            file_list.append((os.path.join(data_path, sound), os.path.join(labels_path, target)))
+    return file_list
+
+
+def load_pickle_split(predictors_path, target_path):
+    with open(predictors_path, 'rb') as f:
+        predictors = pickle.load(f)
+    with open(target_path, 'rb') as f:
+        target = pickle.load(f)
+    predictors = torch.tensor(np.array(predictors)).float()
+    target = torch.tensor(np.array(target)).float()
+    return utils.TensorDataset(predictors, target)
+
+
+def pickle_to_shards(predictors_path, target_path, shard_dir, shard_size=1000):
+    '''
+    Convert a pair of preprocessing.py pickle matrices into .npy shards
+    readable by MmapShardDataset
+    '''
+    with open(predictors_path, 'rb') as f:
+        predictors = pickle.load(f)
+    with open(target_path, 'rb') as f:
+        target = pickle.load(f)
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    for n, start in enumerate(range(0, len(predictors), shard_size)):
+        end = start + shard_size
+        np.save(os.path.join(shard_dir, 'predictors_{:05d}.npy'.format(n)),
+                np.array(predictors[start:end], dtype=np.float32))
+        np.save(os.path.join(shard_dir, 'target_{:05d}.npy'.format(n)),
+                np.array(target[start:end], dtype=np.float32))
+
+
+def split_file_list(file_list, split, train_val_split):
+    #train and validation come from the same folder, as in preprocessing.py
+    split_point = int(len(file_list) * train_val_split)
+    if split == 'train':
+        return file_list[:split_point]
+    return file_list[split_point:]
+
+
+def load_dataset(args, split, task):
+    '''
+    Build the dataset of a split ('train', 'validation' or 'test')
+    with the backend selected in args.dataset_backend
+    '''
+    if split not in SPLITS:
+        raise ValueError('Unknown split ' + str(split))
+    if args.dataset_backend == 'pickle':
+        predictors_arg, target_arg = PICKLE_PATHS[split]
+        dataset = load_pickle_split(getattr(args, predictors_arg), getattr(args, target_arg))
+    elif args.dataset_backend == 'mmap':
+        shard_dir = os.path.join(args.mmap_dir, split)
+        if not os.path.exists(shard_dir):
+            #first run: build the shards from the pickle matrices
+            print ('Building ' + split + ' shards into ' + shard_dir)
+            predictors_arg, target_arg = PICKLE_PATHS[split]
+            pickle_to_shards(getattr(args, predictors_arg), getattr(args, target_arg),
+                             shard_dir, args.shard_size)
+        dataset = MmapShardDataset(shard_dir)
+    elif args.dataset_backend == 'wav':
+        if task == 1:
+            if split == 'test':
+                folder = 'L3DAS_Task1_dev'
+            else:
+                folder = 'L3DAS_Task1_' + args.training_set
+            file_list = list_task1_files(os.path.join(args.wav_path, folder))
+            if split != 'test':
+                file_list = split_file_list(file_list, split, args.train_val_split)
+            dataset = Task1WavDataset(file_list, args.num_mics, args.segmentation_len, args.sr)
+        elif task == 2:
+            if split == 'test':
+                folder = 'L3DAS_Task2_dev'
+            else:
+                folder = 'L3DAS_Task2_train'
+            file_list = list_task2_files(os.path.join(args.wav_path, folder), args.ov_subsets)
+            if split != 'test':
+                file_list = split_file_list(file_list, split, args.train_val_split)
+            dataset = Task2WavDataset(file_list, args, args.sr)
+    else:
+        raise NotImplementedError("Couldn't find dataset backend " + str(args.dataset_backend))
+
+    print (split + ' set: ' + str(len(dataset)) + ' data points')
+    return dataset
+
+
+def validation_subset(dataset, fraction, seed=0):
+    '''
+    Fixed random subset of fraction of the data points of dataset,
+    the same at every call (and in every process)
+    '''
+    if fraction >= 1.:
+        return dataset
+    n = max(1, int(round(len(dataset) * fraction)))
+    indices = np.random.RandomState(seed).choice(len(dataset), n, replace=False)
+    return utils.Subset(dataset, sorted(indices.tolist()))
+
+
+class ResumableSampler(utils.Sampler):
+    '''
+    Sampler whose order depends only on (seed, epoch), so that an interrupted
+    epoch can be restarted at any position without reading the skipped data.
+    With num_replicas > 1 every process gets its own shard of the dataset,
+    like torch DistributedSampler (padded to equal length).
+    If seed is None it is drawn from the torch random generator.
+    '''
+    def __init__(self, dataset, shuffle=True, seed=None, num_replicas=1, rank=0):
+        self.size = len(dataset)
+        self.shuffle = shuffle
+        self.seed = int(torch.randint(2**31, (1,))) if seed is None else seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = int(math.ceil(self.size / num_replicas))
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start = 0
+
+    def set_start(self, start):
+        #skip the first start samples of this epoch (of this process)
+        self.start = start
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(self.size, generator=generator).tolist()
+        else:
+            indices = list(range(self.size))
+        total_size = self.num_samples * self.num_replicas
+        indices = (indices * int(math.ceil(total_size / self.size)))[:total_size]
+        indices = indices[self.rank:total_size:self.num_replicas]
+        return iter(indices[self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
+def bucket_batches(lengths, batch_size, shuffle=False):
+    '''
+    Batches of indices of data points with the same length, so that
+    variable-length data can be batched without padding.
+    Can be used as batch_sampler of a DataLoader.
+    '''
+    buckets = {}
+    for i, length in enumerate(lengths):
+        buckets.setdefault(length, []).append(i)
+    batches = [b[i:i+batch_size] for b in buckets.values() for i in range(0, len(b), batch_size)]
+    if shuffle:
+        batches = [batches[i] for i in np.random.permutation(len(batches))]
+    return batches
+
+
+def build_dataloader(dataset, args, shuffle=False):
+    '''
+    DataLoader with the worker/prefetch settings of args.
+    The order of the data is set by a ResumableSampler, whose epoch has to be
+    set with set_loader_epoch().
+    In distributed mode every process reads its own shard of the dataset.
+    '''
+    kwargs = {}
+    if args.num_workers > 0:
+        #these are only accepted by torch when workers are used
+        kwargs['persistent_workers'] = args.persistent_workers
+        kwargs['prefetch_factor'] = args.prefetch_factor
+    if args.distributed:
+        #all processes must agree on the order
+        sampler = ResumableSampler(dataset, shuffle, seed=0,
+                                   num_replicas=torch.distributed.get_world_size(),
+                                   rank=torch.distributed.get_rank())
+    else:
+        sampler = ResumableSampler(dataset, shuffle)
+    return utils.DataLoader(dataset, args.batch_size, sampler=sampler, pin_memory=True,
+                            num_workers=args.num_workers, **kwargs)
+
+
+def set_loader_epoch(loader, epoch):
+    #reshuffle the data at every epoch
+    if isinstance(loader, TimedLoader):
+        loader = loader.loader
+    if isinstance(loader.sampler, ResumableSampler):
+        loader.sampler.set_epoch(epoch)
+
+
+def set_loader_start(loader, n_batches):
+    #resume the current epoch after its first n_batches batches
+    if isinstance(loader, TimedLoader):
+        loader = loader.loader
+    loader.sampler.set_start(n_batches * loader.batch_size)
+
+
+def loader_seed(loader):
+    if isinstance(loader, TimedLoader):
+        loader = loader.loader
+    return loader.sampler.seed
+
+
+def set_loader_seed(loader, seed):
+    if isinstance(loader, TimedLoader):
+        loader = loader.loader
+    loader.sampler.seed = seed
+
+
+def add_dataset_args(parser, task):
+    '''
+    Add the dataset backend and loader arguments to a training script parser
+    '''
+    parser.add_argument('--dataset_backend', type=str, default='pickle',
+                        help='pickle, mmap or wav')
+    parser.add_argument('--mmap_dir', type=str, default='DATASETS/processed/task' + str(task) + '_shards',
+                        help='folder of the .npy shards (mmap backend), built from the pickles if missing')
+    parser.add_argument('--shard_size', type=int, default=1000,
+                        help='data points per .npy shard')
+    parser.add_argument('--wav_path', type=str, default='DATASETS/Task' + str(task),
+                        help='folder of the downloaded dataset (wav backend)')
+    parser.add_argument('--train_val_split', type=float, default=0.8,
+                        help='perc split between train and validation sets (wav backend)')
+    parser.add_argument('--num_mics', type=int, default=1,
+                        help='how many ambisonics mics (1 or 2, wav backend)')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='data loader worker processes')
+    parser.add_argument('--persistent_workers', type=str, default='True',
+                        help='keep the loader workers alive between epochs')
+    parser.add_argument('--prefetch_factor', type=int, default=2,
+                        help='batches prefetched by each worker')
+    parser.add_argument('--distributed', type=str, default='False',
+                        help='DistributedDataParallel training, launch the script with torchrun')
+    parser.add_argument('--dist_backend', type=str, default='gloo',
+                        help='torch.distributed backend (gloo for CPU training)')
+    if task == 1:
+        parser.add_argument('--training_set', type=str, default='train100',
+                            help='which training set: train100, train360 (wav backend)')
+        parser.add_argument('--segmentation_len', type=float, default=2,
+                            help='length of segmented frames in seconds (wav backend)')
+    elif task == 2:
+        parser.add_argument('--frame_len', type=int, default=100,
+                            help='frame length for SELD evaluation in ms (wav backend)')
+        parser.add_argument('--stft_nperseg', type=int, default=512,
+                            help='num of stft frames (wav backend)')
+        parser.add_argument('--stft_noverlap', type=int, default=112,
+                            help='num of overlapping samples for stft (wav backend)')
+        parser.add_argument('--stft_window', type=str, default='hamming',
+                            help='stft window_type (wav backend)')
+        parser.add_argument('--output_phase', type=str, default='False',
+                            help='concatenate phase channels to stft matrix (wav backend)')
+        parser.add_argument('--ov_subsets', type=str, default='["ov1", "ov2", "ov3"]',
+                            help='list of the ov subsets to use (wav backend)')
+        parser.add_argument('--no_overlaps', type=str, default='False',
+                            help='use only the non overlapped sounds in the labels (wav backend)')
+
+
+def eval_dataset_args(args, task):
+    #eval string bools and lists of the dataset arguments
+    args.persistent_workers = eval(args.persistent_workers)
+    args.distributed = eval(args.distributed)
+    if task == 2:
+        args.output_phase = eval(args.output_phase)
+        args.ov_subsets = eval(args.ov_subsets)
+        args.no_overlaps = eval(args.no_overlaps)
@@ -0,0 +1,113 @@
+import sys, os
+import json
+from tqdm import tqdm
+import numpy as np
+import torch
+import torch.utils.data as utils
+from utility_functions import is_main_process
+
+'''
+Knowledge distillation of the baseline models (--teacher_path of the train scripts).
+The outputs of a trained teacher on the training set are computed once and cached
+to disk as a .npy file, memory-mapped by the data loaders, so that the student
+epochs do not repeat the teacher forward passes.
+TeacherTargetDataset appends the teacher outputs to the ground truth target of
+each data point: the target is still a single tensor, so batching, distributed
+sampling and resuming are unchanged. split_teacher_target() separates them
+in the training loss.
+'''
+
+
+def teacher_outputs_task1(teacher, x):
+    #enhanced waveforms: [batch, nspk, samples]
+    return teacher(x, torch.tensor([0.]))
+
+
+def teacher_outputs_task2(teacher, x):
+    #sed and doa joint like in the target matrices: [batch, frames, sed_size + doa_size]
+    sed, doa = teacher(x)
+    return torch.cat([sed, doa], -1)
+
+
+def cache_teacher_outputs(teacher, forward_fn, dataset, path, teacher_path, batch_size, device):
+    '''
+    Compute forward_fn(teacher, x) on every data point of dataset, in order, and save it to path.
+    The cache is reused if it was computed by the same teacher checkpoint on a dataset of
+    the same length (see path.json). In distributed mode rank 0 computes it.
+    '''
+    info = {'teacher_path': os.path.abspath(teacher_path),
+            'teacher_mtime': os.path.getmtime(teacher_path),
+            'length': len(dataset)}
+    info_path = path + '.json'
+    cached = False
+    if is_main_process() and os.path.exists(path) and os.path.exists(info_path):
+        with open(info_path) as f:
+            cached = json.load(f) == info
+        if cached:
+            print ('Using the cached teacher outputs ' + path)
+    if is_main_process() and not cached:
+        print ('Computing the teacher outputs of the training set')
+        if len(os.path.dirname(path)) > 0 and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        teacher.eval()
+        loader = utils.DataLoader(dataset, batch_size, shuffle=False)
+        tmp_path = path + '.tmp.npy'
+        cache = None
+        i = 0
+        with torch.no_grad():
+            for x, _ in tqdm(loader):
+                outputs = forward_fn(teacher, x.to(device)).float().cpu().numpy()
+                if cache is None:
+                    cache = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                                      shape=(len(dataset),) + outputs.shape[1:])
+                cache[i:i+len(outputs)] = outputs
+                i += len(outputs)
+        cache.flush()
+        del cache
+        os.replace(tmp_path, path)
+        with open(info_path, 'w') as f:
+            json.dump(info, f)
+        print ('Teacher outputs saved to ' + path)
+    #the other processes wait for the cache of rank 0
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        torch.distributed.barrier()
+
+
+class TeacherTargetDataset(utils.Dataset):
+    '''
+    dataset with the cached teacher outputs concatenated to each target along dim.
+    The cache is memory-mapped on first access, in each data loader worker
+    '''
+    def __init__(self, dataset, cache_path, dim):
+        self.dataset = dataset
+        self.cache_path = cache_path
+        self.dim = dim
+        self.cache = None
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, i):
+        if self.cache is None:
+            self.cache = np.load(self.cache_path, mmap_mode='r')
+        x, target = self.dataset[i]
+        teacher = torch.from_numpy(np.array(self.cache[i])).to(target.dtype)
+        return x, torch.cat([target, teacher], self.dim)
+
+
+def split_teacher_target(target, dim):
+    #ground truth and teacher halves of a batch of TeacherTargetDataset targets
+    n = target.shape[dim] // 2
+    return target.narrow(dim, 0, n), target.narrow(dim, n, n)
+
+
+def add_distillation_args(parser):
+    parser.add_argument('--teacher_path', type=str, default=None,
+                        help='checkpoint of a trained teacher model, enables knowledge distillation')
+    parser.add_argument('--teacher_args', type=str, default='{}',
+                        help="model parameters of the teacher that differ from the student ones, "
+                             "e.g. \"{'cnn_filters': [64,128,256,512], 'fc_size': 1024}\"")
+    parser.add_argument('--distill_weight', type=float, default=0.5,
+                        help='weight of the loss on the teacher outputs, the ground truth loss has 1 - distill_weight')
+    parser.add_argument('--teacher_cache', type=str, default=None,
+                        help='teacher outputs cache, default is checkpoint_dir/teacher_outputs_train.npy')
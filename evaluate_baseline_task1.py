@@ -1,4 +1,5 @@
 import sys, os
+import time
 import pickle
 import argparse
 from tqdm import tqdm
@@ -7,8 +8,10 @@ import soundfile as sf
 import torch
 import torch.utils.data as utils
 from metrics import task1_metric
-from FaSNet import FaSNet_origin
-from utility_functions import load_model, save_model
+from models.FaSNet import FaSNet_origin, FaSNet_TAC, set_low_copy_layout
+from export_onnx import OnnxModel
+from telemetry import StepProfiler, add_profiler_args
+from utility_functions import compile_model, load_inference_model, load_model, save_model, autocast
 
 '''
 Load pretrained model and compute the metrics for Task 1
@@ -18,18 +21,16 @@ where to save the obtained results.
 '''
 
 
-def enhance_sound(predictors, model, device, length, overlap):
+def enhance_sound(predictors, model, device, length, overlap, max_batch=None, pad_batch=False):
     '''
     Compute enhanced waveform using a trained model,
-    applying a sliding crossfading window
+    applying a sliding crossfading window.
+    The windows of all the sounds of predictors are processed in batches
+    of up to max_batch windows (default: all of them in a single batch).
+    With pad_batch, the last batch is zero-padded to the size of the others,
+    for the traced models that only take the batch size they were traced with
     '''
 
-    def pad(x, d):
-        #zeropad to desired length
-        pad = torch.zeros((x.shape[0], x.shape[1], d))
-        pad[:,:,:x.shape[-1]] = x
-        return pad
-
     def xfade(x1, x2, fade_samps, exp=1.):
         #simple linear/exponential crossfade and concatenation
         out = []
@@ -47,27 +48,30 @@ def enhance_sound(predictors, model, device, length, overlap):
     overlap_len = int(length*overlap)  #in samples
     total_len = predictors.shape[-1]
     starts = np.arange(0,total_len, overlap_len)  #points to cut
-    #iterate the sliding frames
-    for i in range(len(starts)):
-        start = starts[i]
-        end = starts[i] + length
-        if end < total_len:
-            cut_x = predictors[:,:,start:end]
-        else:
-            #zeropad the last frame
-            end = total_len
-            cut_x = pad(predictors[:,:,start:end], length)
-
-        #compute model's output
+    #zeropad the last frames, and view the sliding frames as [batch, channels, frame, samples]
+    padded = torch.zeros((predictors.shape[0], predictors.shape[1], starts[-1] + length))
+    padded[:,:,:total_len] = predictors
+    frames = padded.unfold(-1, length, overlap_len)
+    #frames per forward pass, each of them for all the sounds
+    step = len(starts) if max_batch is None else max(1, max_batch // predictors.shape[0])
+    predicted = []
+    for i in range(0, len(starts), step):
+        #compute model's output on a batch of [frames * sounds]
+        cut_x = frames[:,:,i:i+step].permute(2,0,1,3).reshape(-1, predictors.shape[1], length)
+        num_windows = len(cut_x)
+        if pad_batch and num_windows < step * predictors.shape[0]:
+            cut_x = torch.cat((cut_x, cut_x.new_zeros((step * predictors.shape[0] - num_windows,) + cut_x.shape[1:])))
         cut_x = cut_x.to(device)
         predicted_x = model(cut_x, torch.tensor([0.]))
-        predicted_x = predicted_x.cpu().numpy()
+        predicted_x = predicted_x[:num_windows].float().cpu().numpy()
+        predicted += np.split(predicted_x, len(predicted_x) // predictors.shape[0])
 
-        #reconstruct sound crossfading segments
+    #reconstruct sound crossfading segments
+    for i in range(len(starts)):
         if i == 0:
-            recon = predicted_x
+            recon = predicted[i]
         else:
-            recon = xfade(recon, predicted_x, overlap_len)
+            recon = xfade(recon, predicted[i], overlap_len)
 
     #undo final pad
     recon = recon[:,:,:total_len]
@@ -103,25 +107,41 @@ def main(args):
     if not os.path.exists(args.results_path):
         os.makedirs(args.results_path)
 
-    #LOAD MODEL
-    if args.architecture == 'fasnet':
-        model = FaSNet_origin(enc_dim=args.enc_dim, feature_dim=args.feature_dim,
-                              hidden_dim=args.hidden_dim, layer=args.layer,
-                              segment_size=args.segment_size, nspk=args.nspk,
-                              win_len=args.win_len, context_len=args.context_len,
-                              sr=args.sr)
-    elif args.architecture == 'tac':
-        model = FaSNet_TAC(enc_dim=args.enc_dim, feature_dim=args.feature_dim,
-                              hidden_dim=args.hidden_dim, layer=args.layer,
-                              segment_size=args.segment_size, nspk=args.nspk,
-                              win_len=args.win_len, context_len=args.context_len,
-                              sr=args.sr)
-    if args.use_cuda:
-        print("Moving model to gpu")
-    model = model.to(device)
-
-    #load checkpoint
-    state = load_model(model, None, args.model_path, args.use_cuda)
+    #onnxruntime backend: the export_onnx.py graph runs in place of the torch model
+    if args.backend == 'onnxruntime':
+        if args.use_cuda or args.amp != 'none' or args.compile != 'none':
+            raise ValueError('the onnxruntime backend runs the fp32 graph on cpu: '
+                             'use --use_cuda False, --amp none and --compile none')
+        onnx_path = args.onnx_path or args.model_path + '.onnx'
+        print ('Loading onnxruntime session ' + onnx_path)
+        model = OnnxModel(onnx_path, args.ort_threads, args.ort_inter_threads)
+    else:
+        #LOAD MODEL
+        if args.architecture == 'fasnet':
+            model = FaSNet_origin(enc_dim=args.enc_dim, feature_dim=args.feature_dim,
+                                  hidden_dim=args.hidden_dim, layer=args.layer,
+                                  segment_size=args.segment_size, nspk=args.nspk,
+                                  win_len=args.win_len, context_len=args.context_len,
+                                  sr=args.sr)
+        elif args.architecture == 'tac':
+            model = FaSNet_TAC(enc_dim=args.enc_dim, feature_dim=args.feature_dim,
+                                  hidden_dim=args.hidden_dim, layer=args.layer,
+                                  segment_size=args.segment_size, nspk=args.nspk,
+                                  win_len=args.win_len, context_len=args.context_len,
+                                  sr=args.sr)
+        if args.use_cuda:
+            print("Moving model to gpu")
+        model = model.to(device)
+
+        #load checkpoint, also int8 checkpoints of quantize_model.py
+        model, state = load_inference_model(model, args.model_path, args.use_cuda)
+        set_low_copy_layout(model, args.low_copy_layout)
+        #graph compilation for faster inference
+        if args.compile == 'torchscript' and args.amp != 'none':
+            raise ValueError('torchscript traces the fp32 model, it can not be used with --amp')
+        #the traced model takes batches of max_batch windows (one sound per data point)
+        model = compile_model(model, args.compile, (torch.zeros(max(1, args.max_batch), predictors.shape[1], args.segment_length).to(device), torch.tensor([0.])))
+    pad_batch = args.compile == 'torchscript'
 
     #COMPUTING METRICS
     print("COMPUTING TASK 1 METRICS")
@@ -132,16 +152,41 @@ def main(args):
     WER = 0.
     STOI = 0.
     METRIC = 0.
+    #with --amp_compare the fp32 model is evaluated too, as reference
+    amp_compare = args.amp_compare and args.amp != 'none'
+    STOI_FP32 = 0.
+    METRIC_FP32 = 0.
+    enhance_time = 0.
+    enhance_time_fp32 = 0.
     count = 0
     model.eval()
+    #optional torch.profiler capture of the first data points
+    profiler = StepProfiler(args.profile_steps,
+                            args.profile_dir or os.path.join(args.results_path, 'profile'),
+                            args.profile_warmup, device=device)
+    profiler.start()
     with tqdm(total=len(dataloader) // 1) as pbar, torch.no_grad():
         for example_num, (x, target) in enumerate(dataloader):
 
-            outputs = enhance_sound(x, model, device, args.segment_length, args.segment_overlap)
+            t = time.time()
+            with autocast(args.amp, device):
+                outputs = enhance_sound(x, model, device, args.segment_length, args.segment_overlap, args.max_batch, pad_batch)
+            enhance_time += time.time() - t
 
             outputs = np.squeeze(outputs)
             target = np.squeeze(target)
 
+            if amp_compare:
+                t = time.time()
+                outputs_fp32 = enhance_sound(x, model, device, args.segment_length, args.segment_overlap, args.max_batch, pad_batch)
+                enhance_time_fp32 += time.time() - t
+                outputs_fp32 = np.squeeze(outputs_fp32)
+                outputs_fp32 = outputs_fp32 / np.max(outputs_fp32) * 0.9
+                metric_fp32, _, stoi_fp32 = task1_metric(target, outputs_fp32)
+                if metric_fp32 is not None:
+                    METRIC_FP32 += (1. / float(example_num + 1)) * (metric_fp32 - METRIC_FP32)
+                    STOI_FP32 += (1. / float(example_num + 1)) * (stoi_fp32 - STOI_FP32)
+
             outputs = outputs / np.max(outputs) * 0.9  #normalize prediction
             metric, wer, stoi = task1_metric(target, outputs)
 
@@ -165,14 +210,21 @@ def main(args):
             pbar.set_description('M:' +  str(np.round(METRIC,decimals=3)) +
                    ', W:' + str(np.round(WER,decimals=3)) + ', S: ' + str(np.round(STOI,decimals=3)))
             pbar.update(1)
+            profiler.step()
             count += 1
+    profiler.stop()
 
 
     #visualize and save results
     results = {'word error rate': WER,
                'stoi': STOI,
-               'task 1 metric': METRIC
+               'task 1 metric': METRIC,
+               'throughput': count / enhance_time
                }
+    if amp_compare:
+        results['stoi delta vs fp32'] = STOI - STOI_FP32
+        results['task 1 metric delta vs fp32'] = METRIC - METRIC_FP32
+        results['throughput gain vs fp32'] = enhance_time_fp32 / enhance_time
 
     print ('RESULTS')
     for i in results:
@@ -200,10 +252,29 @@ if __name__ == '__main__':
     #reconstruction parameters
     parser.add_argument('--segment_length', type=int, default=32000)
     parser.add_argument('--segment_overlap', type=float, default=0.5)
+    parser.add_argument('--max_batch', type=int, default=16,
+                        help='max sliding windows per forward pass')
     #model parameters
     parser.add_argument('--architecture', type=str, default='fasnet',
                         help="can be fasnet or tac")
     parser.add_argument('--gpu_id', type=int, default=0)
+    add_profiler_args(parser)
+    parser.add_argument('--compile', type=str, default='none',
+                        help='none, inductor (torch.compile, needs torch >= 2.0) or torchscript (traced and frozen model)')
+    parser.add_argument('--low_copy_layout', type=str, default='False',
+                        help='keep the DPRNN features in the rnn layout across the layers, with fewer activation copies')
+    parser.add_argument('--backend', type=str, default='torch',
+                        help="'torch' or 'onnxruntime' (graph exported by export_onnx.py)")
+    parser.add_argument('--onnx_path', type=str, default=None,
+                        help='onnx graph of the onnxruntime backend, default is model_path + ".onnx"')
+    parser.add_argument('--ort_threads', type=int, default=0,
+                        help='onnxruntime intra-op threads, 0: one per physical core')
+    parser.add_argument('--ort_inter_threads', type=int, default=1,
+                        help='onnxruntime inter-op threads, > 1 enables the parallel executor')
+    parser.add_argument('--amp', type=str, default='none',
+                        help='none (fp32) or bf16 (bfloat16 autocast of the forward pass)')
+    parser.add_argument('--amp_compare', type=str, default='False',
+                        help='also evaluate the fp32 model and report the throughput gain and metric delta')
     parser.add_argument('--use_cuda', type=str, default='True')
     parser.add_argument('--enc_dim', type=int, default=64)
     parser.add_argument('--feature_dim', type=int, default=64)
@@ -217,5 +288,7 @@ if __name__ == '__main__':
     args = parser.parse_args()
     #eval string args
     args.use_cuda = eval(args.use_cuda)
+    args.amp_compare = eval(args.amp_compare)
+    args.low_copy_layout = eval(args.low_copy_layout)
 
     main(args)
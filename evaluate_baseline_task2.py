@@ -1,4 +1,5 @@
 import sys, os
+import time
 import pickle
 import argparse
 from tqdm import tqdm
@@ -8,8 +9,10 @@ import torch
 import torch.nn as nn
 import torch.utils.data as utils
 from metrics import location_sensitive_detection
-from models.SELDNet import Seldnet_vanilla, Seldnet_augmented
-from utility_functions import load_model, save_model, gen_submission_list_task2
+from models.SELDNet import Seldnet_vanilla, Seldnet_augmented, StreamingSeldnet, fuse_for_inference
+from export_onnx import OnnxModel
+from telemetry import StepProfiler, add_profiler_args
+from utility_functions import compile_model, load_inference_model, load_model, save_model, gen_submission_list_task2, autocast
 
 '''
 Load pretrained model and compute the metrics for Task 2
@@ -20,6 +23,13 @@ where to save the obtained results.
 '''
 
 
+def f_score(TP, FP, FN):
+    precision = TP / (TP + FP + sys.float_info.epsilon)
+    recall = TP / (TP + FN + sys.float_info.epsilon)
+    F_score = 2 * ((precision * recall) / (precision + recall + sys.float_info.epsilon))
+    return precision, recall, F_score
+
+
 def main(args):
     if args.use_cuda:
         device = 'cuda:' + str(args.gpu_id)
@@ -49,75 +59,117 @@ def main(args):
     if not os.path.exists(args.results_path):
         os.makedirs(args.results_path)
 
-    #LOAD MODEL
-    n_time_frames = predictors.shape[-1]
-    if args.architecture == 'seldnet_vanilla':
-        model = Seldnet_vanilla(time_dim=n_time_frames, freq_dim=args.freq_dim, input_channels=args.input_channels,
-                    output_classes=args.output_classes, pool_size=args.pool_size,
-                    pool_time=args.pool_time, rnn_size=args.rnn_size, n_rnn=args.n_rnn,
-                    fc_size=args.fc_size, dropout_perc=args.dropout_perc,
-                    n_cnn_filters=args.n_cnn_filters, class_overlaps=args.class_overlaps,
-                    verbose=args.verbose)
-    if args.architecture == 'seldnet_augmented':
-        model = Seldnet_augmented(time_dim=n_time_frames, freq_dim=args.freq_dim, input_channels=args.input_channels,
-                    output_classes=args.output_classes, pool_size=args.pool_size,
-                    pool_time=args.pool_time, rnn_size=args.rnn_size, n_rnn=args.n_rnn,
-                    fc_size=args.fc_size, dropout_perc=args.dropout_perc,
-                    cnn_filters=args.cnn_filters, class_overlaps=args.class_overlaps,
-                    verbose=args.verbose)
+    #onnxruntime backend: the export_onnx.py graph runs in place of the torch model
+    if args.backend == 'onnxruntime':
+        if args.use_cuda or args.amp != 'none' or args.compile != 'none' or args.streaming:
+            raise ValueError('the onnxruntime backend runs the fp32 graph on cpu: '
+                             'use --use_cuda False, --amp none, --compile none and --streaming False')
+        onnx_path = args.onnx_path or args.model_path + '.onnx'
+        print ('Loading onnxruntime session ' + onnx_path)
+        model = OnnxModel(onnx_path, args.ort_threads, args.ort_inter_threads)
+    else:
+        #LOAD MODEL
+        n_time_frames = predictors.shape[-1]
+        if args.architecture == 'seldnet_vanilla':
+            model = Seldnet_vanilla(time_dim=n_time_frames, freq_dim=args.freq_dim, input_channels=args.input_channels,
+                        output_classes=args.output_classes, pool_size=args.pool_size,
+                        pool_time=args.pool_time, rnn_size=args.rnn_size, n_rnn=args.n_rnn,
+                        fc_size=args.fc_size, dropout_perc=args.dropout_perc,
+                        n_cnn_filters=args.n_cnn_filters, class_overlaps=args.class_overlaps,
+                        bidirectional=args.bidirectional, verbose=args.verbose)
+        if args.architecture == 'seldnet_augmented':
+            model = Seldnet_augmented(time_dim=n_time_frames, freq_dim=args.freq_dim, input_channels=args.input_channels,
+                        output_classes=args.output_classes, pool_size=args.pool_size,
+                        pool_time=args.pool_time, rnn_size=args.rnn_size, n_rnn=args.n_rnn,
+                        fc_size=args.fc_size, dropout_perc=args.dropout_perc,
+                        cnn_filters=args.cnn_filters, class_overlaps=args.class_overlaps,
+                        bidirectional=args.bidirectional, verbose=args.verbose)
 
-    if args.use_cuda:
-        print("Moving model to gpu")
-    model = model.to(device)
+        if args.use_cuda:
+            print("Moving model to gpu")
+        model = model.to(device)
 
-    #load checkpoint
-    state = load_model(model, None, args.model_path, args.use_cuda)
+        #load checkpoint, also int8 checkpoints of quantize_model.py
+        model, state = load_inference_model(model, args.model_path, args.use_cuda)
+        if args.fuse_inference:
+            #fold batchnorm, remove dropout and fuse the sed/doa heads
+            model = fuse_for_inference(model)
+        #graph compilation for faster inference
+        if args.compile == 'torchscript' and args.amp != 'none':
+            raise ValueError('torchscript traces the fp32 model, it can not be used with --amp')
+        model = compile_model(model, args.compile, (predictors[:1].to(device),))
+
+    def predict(x):
+        if not args.streaming:
+            return model(x)
+        #feed the spectrogram in chunk_frames label frames at a time, as a live stream
+        streamer = StreamingSeldnet(model, args.chunk_frames)
+        hop = args.chunk_frames * streamer.pool
+        outputs = [streamer.push(x[...,i:i+hop]) for i in range(0, x.shape[-1], hop)] + [streamer.flush()]
+        sed = torch.cat([o[0] for o in outputs if o[0] is not None], 1)
+        doa = torch.cat([o[1] for o in outputs if o[1] is not None], 1)
+        return sed, doa
 
     #COMPUTING METRICS
     print("COMPUTING TASK 2 METRICS")
-    TP = 0
-    FP = 0
-    FN = 0
+    #with --amp_compare the fp32 model is evaluated too, as reference
+    amp_modes = [args.amp]
+    if args.amp_compare and args.amp != 'none':
+        amp_modes.append('none')
+    counts = {m: {'TP': 0, 'FP': 0, 'FN': 0, 'time': 0.} for m in amp_modes}
     count = 0
     model.eval()
+    #optional torch.profiler capture of the first data points
+    profiler = StepProfiler(args.profile_steps,
+                            args.profile_dir or os.path.join(args.results_path, 'profile'),
+                            args.profile_warmup, device=device)
+    profiler.start()
     with tqdm(total=len(dataloader) // 1) as pbar, torch.no_grad():
         for example_num, (x, target) in enumerate(dataloader):
             x = x.to(device)
-            sed, doa = model(x)
-            sed = sed.cpu().numpy().squeeze()
-            doa = doa.cpu().numpy().squeeze()
             target = target.numpy().squeeze()
             #in the target matrices sed and doa are joint
             sed_target = target[:,:args.output_classes*args.class_overlaps]
             doa_target = target[:,args.output_classes*args.class_overlaps:]
-
-            prediction = gen_submission_list_task2(sed, doa,
-                                                   max_overlaps=args.class_overlaps,
-                                                   max_loc_value=args.max_loc_value)
-
             target = gen_submission_list_task2(sed_target, doa_target,
                                                max_overlaps=args.class_overlaps,
                                                max_loc_value=args.max_loc_value)
+            for amp in amp_modes:
+                t = time.time()
+                with autocast(amp, device):
+                    sed, doa = predict(x)
+                sed = sed.float().cpu().numpy().squeeze()
+                doa = doa.float().cpu().numpy().squeeze()
+                counts[amp]['time'] += time.time() - t
+
+                prediction = gen_submission_list_task2(sed, doa,
+                                                       max_overlaps=args.class_overlaps,
+                                                       max_loc_value=args.max_loc_value)
 
-            tp, fp, fn, _ = location_sensitive_detection(prediction, target, args.num_frames,
-                                                      args.spatial_threshold, False)
+                tp, fp, fn, _ = location_sensitive_detection(prediction, target, args.num_frames,
+                                                          args.spatial_threshold, False)
 
-            TP += tp
-            FP += fp
-            FN += fn
+                counts[amp]['TP'] += tp
+                counts[amp]['FP'] += fp
+                counts[amp]['FN'] += fn
 
             count += 1
             pbar.update(1)
+            profiler.step()
+    profiler.stop()
 
     #compute total F score
-    precision = TP / (TP + FP + sys.float_info.epsilon)
-    recall = TP / (TP + FN + sys.float_info.epsilon)
-    F_score = 2 * ((precision * recall) / (precision + recall + sys.float_info.epsilon))
+    TP = counts[args.amp]['TP']
+    FP = counts[args.amp]['FP']
+    FN = counts[args.amp]['FN']
+    precision, recall, F_score = f_score(TP, FP, FN)
+    throughput = count / counts[args.amp]['time']
 
     #visualize and save results
     results = {'precision': precision,
                'recall': recall,
-               'F score': F_score
+               'F score': F_score,
+               'throughput': throughput
                }
     print ('*******************************')
     print ('RESULTS')
@@ -127,6 +179,14 @@ def main(args):
     print  ('TP: ' , TP)
     print  ('FP: ' , FP)
     print  ('FN: ' , FN)
+    print ('Throughput (' + args.amp + '): ', throughput, 'data points/s')
+    if 'none' in counts and args.amp != 'none':
+        _, _, F_score_fp32 = f_score(counts['none']['TP'], counts['none']['FP'], counts['none']['FN'])
+        throughput_fp32 = count / counts['none']['time']
+        results['F score delta vs fp32'] = F_score - F_score_fp32
+        results['throughput gain vs fp32'] = throughput / throughput_fp32
+        print ('F score fp32: ', F_score_fp32, '| delta: ', F_score - F_score_fp32)
+        print ('Throughput fp32: ', throughput_fp32, 'data points/s | gain: x', throughput / throughput_fp32)
 
     '''
     Baseline results:
@@ -167,6 +227,27 @@ if __name__ == '__main__':
                         help= 'max number of simultaneous sounds of the same class')
     parser.add_argument('--use_cuda', type=str, default='True')
     parser.add_argument('--gpu_id', type=int, default=0)
+    add_profiler_args(parser)
+    parser.add_argument('--compile', type=str, default='none',
+                        help='none, inductor (torch.compile, needs torch >= 2.0) or torchscript (traced and frozen model)')
+    parser.add_argument('--streaming', type=str, default='False',
+                        help='chunked streaming inference, for models trained with --bidirectional False')
+    parser.add_argument('--chunk_frames', type=int, default=10,
+                        help='label frames (100 ms) per streaming chunk')
+    parser.add_argument('--fuse_inference', type=str, default='False',
+                        help='fold batchnorm into the convolutions and fuse the sed/doa heads')
+    parser.add_argument('--backend', type=str, default='torch',
+                        help="'torch' or 'onnxruntime' (graph exported by export_onnx.py)")
+    parser.add_argument('--onnx_path', type=str, default=None,
+                        help='onnx graph of the onnxruntime backend, default is model_path + ".onnx"')
+    parser.add_argument('--ort_threads', type=int, default=0,
+                        help='onnxruntime intra-op threads, 0: one per physical core')
+    parser.add_argument('--ort_inter_threads', type=int, default=1,
+                        help='onnxruntime inter-op threads, > 1 enables the parallel executor')
+    parser.add_argument('--amp', type=str, default='none',
+                        help='none (fp32) or bf16 (bfloat16 autocast of the forward pass)')
+    parser.add_argument('--amp_compare', type=str, default='False',
+                        help='also evaluate the fp32 model and report the throughput gain and F score delta')
     parser.add_argument('--time_dim', type=int, default=4800)
     parser.add_argument('--freq_dim', type=int, default=256)
     parser.add_argument('--output_classes', type=int, default=14)
@@ -174,6 +255,8 @@ if __name__ == '__main__':
     parser.add_argument('--cnn_filters', type=str, default='[64,128,256,512]',
                         help= 'only for seldnet augmented')
     parser.add_argument('--pool_time', type=str, default='True')
+    parser.add_argument('--bidirectional', type=str, default='True',
+                        help='bidirectional gru, False for models that can be streamed')
     parser.add_argument('--rnn_size', type=int, default=256)
     parser.add_argument('--n_rnn', type=int, default=3)
     parser.add_argument('--fc_size', type=int, default=1024)
@@ -188,8 +271,12 @@ if __name__ == '__main__':
     args = parser.parse_args()
     #eval string args
     args.use_cuda = eval(args.use_cuda)
+    args.amp_compare = eval(args.amp_compare)
+    args.streaming = eval(args.streaming)
+    args.fuse_inference = eval(args.fuse_inference)
     args.pool_size= eval(args.pool_size)
     args.cnn_filters = eval(args.cnn_filters)
+    args.bidirectional = eval(args.bidirectional)
     args.verbose = eval(args.verbose)
 
     main(args)
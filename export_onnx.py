@@ -0,0 +1,181 @@
+import sys, os
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+from model_builder import add_model_args, parse_model_args, build_model
+from models.SELDNet import fuse_for_inference
+from utility_functions import load_model
+
+'''
+Export of the baseline models to ONNX, for cpu inference with onnxruntime.
+SELDNet graphs have dynamic batch and time axes, FaSNet graphs dynamic
+batch and sample length. FaSNet is exported for the fixed microphone
+geometry of the challenge (num_mic = 0), its only input is the waveform.
+After the export, the onnxruntime outputs are compared with PyTorch on
+random inputs of batch sizes and lengths different from the export ones,
+so that a dimension baked into the graph is caught.
+With --fuse True (default) SELDNets are exported fused for inference
+(BatchNorm folded, Dropout removed, fused sed/doa heads), and checked
+against the original model.
+OnnxModel wraps an onnxruntime session with the call signature of the
+torch models, and is used by the evaluate scripts with --backend onnxruntime.
+onnxruntime is only needed by the export check and by that backend:
+pip install onnxruntime
+'''
+
+
+class FixedGeometry(nn.Module):
+    '''
+    FaSNet called with num_mic = 0 for every batch item, for the export:
+    the num_mic branch is fixed at trace time
+    '''
+    def __init__(self, model):
+        super(FixedGeometry, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x, torch.zeros(x.shape[0]))
+
+
+def make_session(path, num_threads=0, inter_op_threads=1):
+    '''
+    onnxruntime cpu session with all the graph optimizations.
+    num_threads is the intra-op thread pool size (0: one per physical core),
+    inter_op_threads is only used by the parallel executor (inter_op_threads > 1)
+    '''
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = num_threads
+    if inter_op_threads > 1:
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        options.inter_op_num_threads = inter_op_threads
+    else:
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    return ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+
+class OnnxModel():
+    '''
+    onnxruntime session called like the torch model it was exported from:
+    takes and returns torch tensors. Inputs of the torch signature that are
+    not graph inputs (the FaSNet num_mic) are ignored
+    '''
+    def __init__(self, path, num_threads=0, inter_op_threads=1):
+        self.path = path
+        self.session = make_session(path, num_threads, inter_op_threads)
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def eval(self):
+        return self
+
+    def __call__(self, *inputs):
+        feed = {name: x.detach().float().cpu().numpy() for name, x in zip(self.input_names, inputs)}
+        outputs = [torch.from_numpy(o) for o in self.session.run(None, feed)]
+        if len(outputs) == 1:
+            return outputs[0]
+        return tuple(outputs)
+
+
+def export_onnx(model, example_inputs, path, input_names, output_names, dynamic_axes, opset=13):
+    model.eval()
+    output_dir = os.path.dirname(path)
+    if len(output_dir) > 0 and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with torch.no_grad():
+        torch.onnx.export(model, example_inputs, path, input_names=input_names,
+                          output_names=output_names, dynamic_axes=dynamic_axes,
+                          opset_version=opset, do_constant_folding=True)
+
+
+def check_parity(model, onnx_model, inputs, atol, rtol):
+    '''
+    Max absolute difference between torch and onnxruntime outputs,
+    and whether they match within the tolerances
+    '''
+    with torch.no_grad():
+        expected = model(*inputs)
+    outputs = onnx_model(*inputs)
+    if not isinstance(expected, tuple):
+        expected, outputs = (expected,), (outputs,)
+    max_err = max([(e - o).abs().max().item() for e, o in zip(expected, outputs)])
+    match = all([e.shape == o.shape and torch.allclose(e, o, atol=atol, rtol=rtol)
+                 for e, o in zip(expected, outputs)])
+    return max_err, match
+
+
+def export_task(model, args):
+    '''
+    Export model to args.output_path and return the list of parity check inputs
+    '''
+    if args.task == 1:
+        model = FixedGeometry(model)
+        example_inputs = (torch.rand(1, args.input_channels, args.segment_length),)
+        export_onnx(model, example_inputs, args.output_path, ['input'], ['output'],
+                    {'input': {0: 'batch', 2: 'samples'}, 'output': {0: 'batch', 2: 'samples'}},
+                    args.opset)
+        check_lengths = [args.segment_length, args.segment_length * 3 // 4 + 1]
+        check_inputs = [(torch.rand(b, args.input_channels, l),) for b, l in zip([2, 3], check_lengths)]
+    else:
+        exported = fuse_for_inference(model) if args.fuse else model
+        example_inputs = (torch.rand(1, args.input_channels, args.freq_dim, args.export_frames),)
+        export_onnx(exported, example_inputs, args.output_path, ['input'], ['sed', 'doa'],
+                    {'input': {0: 'batch', 3: 'time'}, 'sed': {0: 'batch', 1: 'frames'},
+                     'doa': {0: 'batch', 1: 'frames'}},
+                    args.opset)
+        #multiples of the 100 ms label frames
+        pool = model.time_pool
+        check_lengths = [args.export_frames // 2 // pool * pool, args.export_frames * 3 // 2 // pool * pool]
+        check_inputs = [(torch.rand(b, args.input_channels, args.freq_dim, l),) for b, l in zip([2, 3], check_lengths)]
+    return model, check_inputs
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+    model = build_model(args)
+    if args.model_path is not None and os.path.exists(args.model_path):
+        load_model(model, None, args.model_path, False)
+    else:
+        print ('Checkpoint not found, exporting a randomly initialized model')
+    model.eval()
+
+    print ('Exporting ' + args.architecture + ' to ' + args.output_path)
+    model, check_inputs = export_task(model, args)
+
+    #PARITY CHECK
+    onnx_model = OnnxModel(args.output_path, args.num_threads)
+    all_match = True
+    for inputs in check_inputs:
+        t = time.time()
+        max_err, match = check_parity(model, onnx_model, inputs, args.atol, args.rtol)
+        all_match = all_match and match
+        print ('Input {}: max abs error {:.2e} ({}), {:.3f}s'.format(
+               list(inputs[0].shape), max_err, 'ok' if match else 'MISMATCH', time.time() - t))
+    if not all_match:
+        raise RuntimeError('onnxruntime outputs do not match PyTorch within atol={} rtol={}'.format(
+                           args.atol, args.rtol))
+    print ('Parity check passed')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    parser.add_argument('--output_path', type=str, default=None,
+                        help='onnx graph, default is model_path + ".onnx"')
+    parser.add_argument('--opset', type=int, default=13)
+    parser.add_argument('--export_frames', type=int, default=800,
+                        help='time frames of the SELDNet example input (80 per second)')
+    parser.add_argument('--fuse', type=str, default='True',
+                        help='export SELDNets with batchnorm folding and fused sed/doa heads')
+    parser.add_argument('--num_threads', type=int, default=1)
+    parser.add_argument('--atol', type=float, default=1e-4)
+    parser.add_argument('--rtol', type=float, default=1e-3)
+
+    args = parse_model_args(parser.parse_args())
+    args.fuse = eval(args.fuse)
+    if args.output_path is None:
+        args.output_path = args.model_path + '.onnx'
+
+    main(args)
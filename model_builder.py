@@ -0,0 +1,112 @@
+import sys, os
+from models.FaSNet import FaSNet_origin, FaSNet_TAC
+from models.SELDNet import Seldnet_vanilla, Seldnet_augmented
+
+'''
+Command line parameters and construction of the baseline models,
+shared by the scripts that work on both tasks (quantize_model.py, export_onnx.py).
+The defaults are the ones of the train and evaluate scripts of each task.
+'''
+
+#defaults of the evaluate scripts for the flags shared by the two tasks
+TASK_DEFAULTS = {1: {'model_path': 'RESULTS/Task1/checkpoint',
+                     'predictors_path': 'DATASETS/processed/task1_predictors_test_uncut.pkl',
+                     'target_path': 'DATASETS/processed/task1_target_test_uncut.pkl',
+                     'architecture': 'fasnet',
+                     'sr': 16000},
+                 2: {'model_path': 'RESULTS/Task2/checkpoint',
+                     'predictors_path': 'DATASETS/processed/task2_predictors_test.pkl',
+                     'target_path': 'DATASETS/processed/task2_target_test.pkl',
+                     'architecture': 'seldnet_augmented',
+                     'sr': 32000}}
+
+
+def add_model_args(parser):
+    parser.add_argument('--task', type=int, default=2, choices=[1, 2])
+    #i/o parameters
+    parser.add_argument('--model_path', type=str, default=None,
+                        help='checkpoint, default is the one of the evaluate script of --task')
+    #dataset parameters
+    parser.add_argument('--predictors_path', type=str, default=None)
+    parser.add_argument('--target_path', type=str, default=None)
+    parser.add_argument('--sr', type=int, default=None)
+    #model parameters
+    parser.add_argument('--architecture', type=str, default=None,
+                        help="task 1: 'fasnet' or 'tac', task 2: 'seldnet_vanilla' or 'seldnet_augmented'")
+    #task 1 parameters
+    parser.add_argument('--segment_length', type=int, default=32000)
+    parser.add_argument('--segment_overlap', type=float, default=0.5)
+    parser.add_argument('--enc_dim', type=int, default=64)
+    parser.add_argument('--feature_dim', type=int, default=64)
+    parser.add_argument('--hidden_dim', type=int, default=128)
+    parser.add_argument('--layer', type=int, default=6)
+    parser.add_argument('--segment_size', type=int, default=24)
+    parser.add_argument('--nspk', type=int, default=1)
+    parser.add_argument('--win_len', type=int, default=16)
+    parser.add_argument('--context_len', type=int, default=16)
+    #task 2 parameters
+    parser.add_argument('--max_loc_value', type=float, default=2.)
+    parser.add_argument('--num_frames', type=int, default=600)
+    parser.add_argument('--spatial_threshold', type=float, default=2.)
+    parser.add_argument('--input_channels', type=int, default=4)
+    parser.add_argument('--class_overlaps', type=int, default=3)
+    parser.add_argument('--time_dim', type=int, default=4800)
+    parser.add_argument('--freq_dim', type=int, default=256)
+    parser.add_argument('--output_classes', type=int, default=14)
+    parser.add_argument('--pool_size', type=str, default='[[8,2],[8,2],[2,2],[1,1]]')
+    parser.add_argument('--cnn_filters', type=str, default='[64,128,256,512]')
+    parser.add_argument('--pool_time', type=str, default='True')
+    parser.add_argument('--bidirectional', type=str, default='True')
+    parser.add_argument('--rnn_size', type=int, default=256)
+    parser.add_argument('--n_rnn', type=int, default=3)
+    parser.add_argument('--fc_size', type=int, default=1024)
+    parser.add_argument('--dropout_perc', type=float, default=0.3)
+    parser.add_argument('--n_cnn_filters', type=float, default=64)
+
+
+def parse_model_args(args):
+    '''
+    Fill the task dependent defaults and eval the string args of add_model_args
+    '''
+    for key, value in TASK_DEFAULTS[args.task].items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+    args.pool_size = eval(args.pool_size)
+    args.cnn_filters = eval(args.cnn_filters)
+    args.pool_time = eval(args.pool_time)
+    args.bidirectional = eval(args.bidirectional)
+    return args
+
+
+def build_model(args, time_dim=None):
+    if time_dim is None:
+        time_dim = args.time_dim
+    if args.architecture == 'fasnet':
+        model = FaSNet_origin(enc_dim=args.enc_dim, feature_dim=args.feature_dim,
+                              hidden_dim=args.hidden_dim, layer=args.layer,
+                              segment_size=args.segment_size, nspk=args.nspk,
+                              win_len=args.win_len, context_len=args.context_len,
+                              sr=args.sr)
+    elif args.architecture == 'tac':
+        model = FaSNet_TAC(enc_dim=args.enc_dim, feature_dim=args.feature_dim,
+                           hidden_dim=args.hidden_dim, layer=args.layer,
+                           segment_size=args.segment_size, nspk=args.nspk,
+                           win_len=args.win_len, context_len=args.context_len,
+                           sr=args.sr)
+    elif args.architecture == 'seldnet_vanilla':
+        model = Seldnet_vanilla(time_dim=time_dim, freq_dim=args.freq_dim, input_channels=args.input_channels,
+                    output_classes=args.output_classes, pool_size=args.pool_size,
+                    pool_time=args.pool_time, rnn_size=args.rnn_size, n_rnn=args.n_rnn,
+                    fc_size=args.fc_size, dropout_perc=args.dropout_perc,
+                    n_cnn_filters=args.n_cnn_filters, class_overlaps=args.class_overlaps,
+                    bidirectional=args.bidirectional)
+    elif args.architecture == 'seldnet_augmented':
+        model = Seldnet_augmented(time_dim=time_dim, freq_dim=args.freq_dim, input_channels=args.input_channels,
+                    output_classes=args.output_classes, pool_size=args.pool_size,
+                    pool_time=args.pool_time, rnn_size=args.rnn_size, n_rnn=args.n_rnn,
+                    fc_size=args.fc_size, dropout_perc=args.dropout_perc,
+                    cnn_filters=args.cnn_filters, class_overlaps=args.class_overlaps,
+                    bidirectional=args.bidirectional)
+    else:
+        raise ValueError('unknown architecture ' + args.architecture)
+    return model
@@ -4,6 +4,11 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
+try:
+    from models.checkpointing import checkpoint, unwrap_model, set_activation_checkpointing
+except ImportError:
+    #run as a script from the models directory
+    from checkpointing import checkpoint, unwrap_model, set_activation_checkpointing
 
 '''
 Filter-and-Sum Network (FasNet) and Transform-Average-Concatenate Network (TAC) models
@@ -13,6 +18,42 @@ from: https://github.com/yluo42/TACz
 
 
 
+def masked_channel_mean(input, num_mic, ch_dim, batch_dim=0):
+    """
+    Mean over the channel dimension ch_dim of input, counting only the first
+    num_mic[b] channels of each batch item b (batch dimension batch_dim).
+    The vectorized equivalent of input[b, :num_mic[b]].mean() for each b.
+    """
+    ch = input.shape[ch_dim]
+    mask = torch.arange(ch, device=input.device).view(1, -1) < num_mic.to(input.device).view(-1, 1)  # B, ch
+    if batch_dim > ch_dim:
+        mask = mask.t()  # ch, B
+    shape = [1] * input.dim()
+    shape[batch_dim] = num_mic.shape[0]
+    shape[ch_dim] = ch
+    mask = mask.reshape(shape).to(input.dtype)
+    return (input * mask).sum(ch_dim) / mask.sum(ch_dim)
+
+
+def channel_last_group_norm(input, norm, batch_dim):
+    """
+    Single group nn.GroupNorm norm applied to input with the channels in the last
+    dimension and the batch in dimension batch_dim, in any memory layout.
+    """
+    dims = [d for d in range(input.dim()) if d != batch_dim]
+    var, mean = torch.var_mean(input, dims, unbiased=False, keepdim=True)
+    scale = torch.rsqrt(var + norm.eps) * norm.weight
+    return torch.addcmul(norm.bias - mean * scale, input, scale)
+
+
+def channel_last_output(output_layer, input):
+    """
+    DPRNN output layer (PReLU and 1x1 Conv2d) applied to input with the channels in the last dimension.
+    """
+    prelu, conv = output_layer[0], output_layer[1]
+    return F.linear(prelu(input), conv.weight.view(conv.out_channels, -1), conv.bias)
+
+
 class SingleRNN(nn.Module):
     """
     Container module for a single RNN layer.
@@ -46,6 +87,12 @@ class SingleRNN(nn.Module):
         rnn_output = self.proj(rnn_output.contiguous().view(-1, rnn_output.shape[2])).view(output.shape)
         return rnn_output
 
+    def forward_time_major(self, input):
+        # input shape: seq, batch, dim
+        # the rnn computes time-major sequences, so transposing its batch_first input and output copies nothing
+        rnn_output, _ = self.rnn(input.transpose(0, 1))
+        return self.proj(rnn_output.transpose(0, 1))  # seq, batch, dim
+
 # dual-path RNN
 class DPRNN(nn.Module):
     """
@@ -85,30 +132,74 @@ class DPRNN(nn.Module):
         self.output = nn.Sequential(nn.PReLU(),
                                     nn.Conv2d(input_size, output_size, 1)
                                    )
+        # recompute the layers in the backward pass instead of storing their activations
+        self.checkpointing = False
+        # use forward_low_copy()
+        self.low_copy = False
 
     def forward(self, input):
         # input shape: batch, N, dim1, dim2
         # apply RNN on dim1 first and then dim2
 
-        batch_size, _, dim1, dim2 = input.shape
+        if self.low_copy:
+            return self.forward_low_copy(input)
         output = input
         for i in range(len(self.row_rnn)):
-            row_input = output.permute(0,3,2,1).contiguous().view(batch_size*dim2, dim1, -1)  # B*dim2, dim1, N
-            row_output = self.row_rnn[i](row_input)  # B*dim2, dim1, H
-            row_output = row_output.view(batch_size, dim2, dim1, -1).permute(0,3,2,1).contiguous()  # B, N, dim1, dim2
-            row_output = self.row_norm[i](row_output)
-            output = output + row_output
-
-            col_input = output.permute(0,2,3,1).contiguous().view(batch_size*dim1, dim2, -1)  # B*dim1, dim2, N
-            col_output = self.col_rnn[i](col_input)  # B*dim1, dim2, H
-            col_output = col_output.view(batch_size, dim1, dim2, -1).permute(0,3,1,2).contiguous()  # B, N, dim1, dim2
-            col_output = self.col_norm[i](col_output)
-            output = output + col_output
+            if self.checkpointing and torch.is_grad_enabled():
+                output = checkpoint(self.layer_forward, i, output)
+            else:
+                output = self.layer_forward(i, output)
 
         output = self.output(output)
 
         return output
 
+    def layer_forward(self, i, output):
+        # layer i: row and column RNNs
+        batch_size, _, dim1, dim2 = output.shape
+        row_input = output.permute(0,3,2,1).contiguous().view(batch_size*dim2, dim1, -1)  # B*dim2, dim1, N
+        row_output = self.row_rnn[i](row_input)  # B*dim2, dim1, H
+        row_output = row_output.view(batch_size, dim2, dim1, -1).permute(0,3,2,1).contiguous()  # B, N, dim1, dim2
+        row_output = self.row_norm[i](row_output)
+        output = output + row_output
+
+        col_input = output.permute(0,2,3,1).contiguous().view(batch_size*dim1, dim2, -1)  # B*dim1, dim2, N
+        col_output = self.col_rnn[i](col_input)  # B*dim1, dim2, H
+        col_output = col_output.view(batch_size, dim1, dim2, -1).permute(0,3,1,2).contiguous()  # B, N, dim1, dim2
+        col_output = self.col_norm[i](col_output)
+        output = output + col_output
+
+        return output
+
+    def forward_low_copy(self, input):
+        # same output as forward(), keeping the features in the dim2, B, dim1, N layout across the layers:
+        # the row RNN reads them as B*dim2 sequences of dim1 frames and the column RNN as a time-major
+        # sequence of dim2 frames without copies, only the input and the output are permuted
+        batch_size, N, dim1, dim2 = input.shape
+        output = input.permute(3,0,2,1).contiguous()  # dim2, B, dim1, N
+        for i in range(len(self.row_rnn)):
+            if self.checkpointing and torch.is_grad_enabled():
+                output = checkpoint(self.layer_forward_low_copy, i, output)
+            else:
+                output = self.layer_forward_low_copy(i, output)
+
+        output = channel_last_output(self.output, output)  # dim2, B, dim1, output_size
+
+        return output.permute(1,3,2,0).contiguous()  # B, output_size, dim1, dim2
+
+    def layer_forward_low_copy(self, i, output):
+        dim2, batch_size, dim1, N = output.shape
+        # the row RNN output is time-major (dim1, dim2*B, N), the residual sum writes it back in the dim2, B, dim1, N layout
+        row_output = self.row_rnn[i].forward_time_major(output.view(dim2*batch_size, dim1, N).transpose(0, 1))  # dim1, dim2*B, N
+        row_output = channel_last_group_norm(row_output.view(dim1, dim2, batch_size, N), self.row_norm[i], 2)
+        output = output + row_output.permute(1,2,0,3)  # dim2, B, dim1, N
+
+        col_output = self.col_rnn[i].forward_time_major(output.view(dim2, batch_size*dim1, N))  # dim2, B*dim1, N
+        col_output = channel_last_group_norm(col_output.view(dim2, batch_size, dim1, N), self.col_norm[i], 1)
+        output = output + col_output  # dim2, B, dim1, N
+
+        return output
+
 
 # dual-path RNN with transform-average-concatenate (TAC)
 class DPRNN_TAC(nn.Module):
@@ -171,54 +262,130 @@ class DPRNN_TAC(nn.Module):
         self.output = nn.Sequential(nn.PReLU(),
                                     nn.Conv2d(input_size, output_size, 1)
                                    )
+        # recompute the layers in the backward pass instead of storing their activations
+        self.checkpointing = False
+        # use forward_low_copy()
+        self.low_copy = False
 
     def forward(self, input, num_mic):
         # input shape: batch, ch, N, dim1, dim2
         # num_mic shape: batch,
         # apply RNN on dim1 first, then dim2, then ch
 
+        if self.low_copy:
+            return self.forward_low_copy(input, num_mic)
         batch_size, ch, N, dim1, dim2 = input.shape
         output = input
         for i in range(len(self.row_rnn)):
-            # intra-segment RNN
-            output = output.view(batch_size*ch, N, dim1, dim2)  # B*ch, N, dim1, dim2
-            row_input = output.permute(0,3,2,1).contiguous().view(batch_size*ch*dim2, dim1, -1)  # B*ch*dim2, dim1, N
-            row_output = self.row_rnn[i](row_input)  # B*ch*dim2, dim1, N
-            row_output = row_output.view(batch_size*ch, dim2, dim1, -1).permute(0,3,2,1).contiguous()  # B*ch, N, dim1, dim2
-            row_output = self.row_norm[i](row_output)
-            output = output + row_output  # B*ch, N, dim1, dim2
-
-            # inter-segment RNN
-            col_input = output.permute(0,2,3,1).contiguous().view(batch_size*ch*dim1, dim2, -1)  # B*ch*dim1, dim2, N
-            col_output = self.col_rnn[i](col_input)  # B*dim1, dim2, N
-            col_output = col_output.view(batch_size*ch, dim1, dim2, -1).permute(0,3,1,2).contiguous()  # B*ch, N, dim1, dim2
-            col_output = self.col_norm[i](col_output)
-            output = output + col_output  # B*ch, N, dim1, dim2
-
-            # TAC for cross-channel communication
-            ch_input = output.view(input.shape)  # B, ch, N, dim1, dim2
-            ch_input = ch_input.permute(0,3,4,1,2).contiguous().view(-1, N)  # B*dim1*dim2*ch, N
-            ch_output = self.ch_transform[i](ch_input).view(batch_size, dim1*dim2, ch, -1)  # B, dim1*dim2, ch, H
-            # mean pooling across channels
-            if num_mic.max() == 0:
-                # fixed geometry array
-                ch_mean = ch_output.mean(2).view(batch_size*dim1*dim2, -1)  # B*dim1*dim2, H
+            if self.checkpointing and torch.is_grad_enabled():
+                output = checkpoint(self.layer_forward, i, output, num_mic, batch_size, ch)
             else:
-                # only consider valid channels
-                ch_mean = [ch_output[b,:,:num_mic[b]].mean(1).unsqueeze(0) for b in range(batch_size)]  # 1, dim1*dim2, H
-                ch_mean = torch.cat(ch_mean, 0).view(batch_size*dim1*dim2, -1)  # B*dim1*dim2, H
-            ch_output = ch_output.view(batch_size*dim1*dim2, ch, -1)  # B*dim1*dim2, ch, H
-            ch_mean = self.ch_average[i](ch_mean).unsqueeze(1).expand_as(ch_output).contiguous()  # B*dim1*dim2, ch, H
-            ch_output = torch.cat([ch_output, ch_mean], 2)  # B*dim1*dim2, ch, 2H
-            ch_output = self.ch_concat[i](ch_output.view(-1, ch_output.shape[-1]))  # B*dim1*dim2*ch, N
-            ch_output = ch_output.view(batch_size, dim1, dim2, ch, -1).permute(0,3,4,1,2).contiguous()  # B, ch, N, dim1, dim2
-            ch_output = self.ch_norm[i](ch_output.view(batch_size*ch, N, dim1, dim2))  # B*ch, N, dim1, dim2
-            output = output + ch_output
+                output = self.layer_forward(i, output, num_mic, batch_size, ch)
 
         output = self.output(output)  # B*ch, N, dim1, dim2
 
         return output
 
+    def layer_forward(self, i, output, num_mic, batch_size, ch):
+        # layer i: row, column and channel processing
+        _, N, dim1, dim2 = output.shape[-4:]
+        # intra-segment RNN
+        output = output.view(batch_size*ch, N, dim1, dim2)  # B*ch, N, dim1, dim2
+        row_input = output.permute(0,3,2,1).contiguous().view(batch_size*ch*dim2, dim1, -1)  # B*ch*dim2, dim1, N
+        row_output = self.row_rnn[i](row_input)  # B*ch*dim2, dim1, N
+        row_output = row_output.view(batch_size*ch, dim2, dim1, -1).permute(0,3,2,1).contiguous()  # B*ch, N, dim1, dim2
+        row_output = self.row_norm[i](row_output)
+        output = output + row_output  # B*ch, N, dim1, dim2
+
+        # inter-segment RNN
+        col_input = output.permute(0,2,3,1).contiguous().view(batch_size*ch*dim1, dim2, -1)  # B*ch*dim1, dim2, N
+        col_output = self.col_rnn[i](col_input)  # B*dim1, dim2, N
+        col_output = col_output.view(batch_size*ch, dim1, dim2, -1).permute(0,3,1,2).contiguous()  # B*ch, N, dim1, dim2
+        col_output = self.col_norm[i](col_output)
+        output = output + col_output  # B*ch, N, dim1, dim2
+
+        # TAC for cross-channel communication
+        ch_input = output.view(batch_size, ch, N, dim1, dim2)  # B, ch, N, dim1, dim2
+        ch_input = ch_input.permute(0,3,4,1,2).contiguous().view(-1, N)  # B*dim1*dim2*ch, N
+        ch_output = self.ch_transform[i](ch_input).view(batch_size, dim1*dim2, ch, -1)  # B, dim1*dim2, ch, H
+        # mean pooling across channels
+        if num_mic.max() == 0:
+            # fixed geometry array
+            ch_mean = ch_output.mean(2).view(batch_size*dim1*dim2, -1)  # B*dim1*dim2, H
+        else:
+            # only consider valid channels
+            ch_mean = masked_channel_mean(ch_output, num_mic, 2).view(batch_size*dim1*dim2, -1)  # B*dim1*dim2, H
+        ch_output = ch_output.view(batch_size*dim1*dim2, ch, -1)  # B*dim1*dim2, ch, H
+        ch_mean = self.ch_average[i](ch_mean).unsqueeze(1).expand_as(ch_output).contiguous()  # B*dim1*dim2, ch, H
+        ch_output = torch.cat([ch_output, ch_mean], 2)  # B*dim1*dim2, ch, 2H
+        ch_output = self.ch_concat[i](ch_output.view(-1, ch_output.shape[-1]))  # B*dim1*dim2*ch, N
+        ch_output = ch_output.view(batch_size, dim1, dim2, ch, -1).permute(0,3,4,1,2).contiguous()  # B, ch, N, dim1, dim2
+        ch_output = self.ch_norm[i](ch_output.view(batch_size*ch, N, dim1, dim2))  # B*ch, N, dim1, dim2
+        output = output + ch_output
+
+        return output
+
+    def forward_low_copy(self, input, num_mic):
+        # same output as forward(), keeping the features in the dim2, B, ch, dim1, N layout across the layers:
+        # the row and column RNNs read them without copies as in DPRNN.forward_low_copy(),
+        # and the TAC linear layers work on the last dimension
+        batch_size, ch, N, dim1, dim2 = input.shape
+        output = input.permute(4,0,1,3,2).contiguous()  # dim2, B, ch, dim1, N
+        for i in range(len(self.row_rnn)):
+            if self.checkpointing and torch.is_grad_enabled():
+                output = checkpoint(self.layer_forward_low_copy, i, output, num_mic)
+            else:
+                output = self.layer_forward_low_copy(i, output, num_mic)
+
+        output = channel_last_output(self.output, output)  # dim2, B, ch, dim1, output_size
+
+        return output.permute(1,2,4,3,0).contiguous().view(batch_size*ch, -1, dim1, dim2)  # B*ch, output_size, dim1, dim2
+
+    def layer_forward_low_copy(self, i, output, num_mic):
+        dim2, batch_size, ch, dim1, N = output.shape
+        # intra-segment RNN
+        row_output = self.row_rnn[i].forward_time_major(output.view(dim2*batch_size*ch, dim1, N).transpose(0, 1))  # dim1, dim2*B*ch, N
+        row_output = channel_last_group_norm(row_output.view(dim1, dim2, batch_size*ch, N), self.row_norm[i], 2)
+        output = output + row_output.permute(1,2,0,3).view(dim2, batch_size, ch, dim1, N)
+
+        # inter-segment RNN
+        col_output = self.col_rnn[i].forward_time_major(output.view(dim2, batch_size*ch*dim1, N))  # dim2, B*ch*dim1, N
+        col_output = channel_last_group_norm(col_output.view(dim2, batch_size*ch, dim1, N), self.col_norm[i], 1)
+        output = output + col_output.view(dim2, batch_size, ch, dim1, N)
+
+        # TAC for cross-channel communication
+        ch_output = self.ch_transform[i](output)  # dim2, B, ch, dim1, H
+        # mean pooling across channels
+        if num_mic.max() == 0:
+            # fixed geometry array
+            ch_mean = ch_output.mean(2)  # dim2, B, dim1, H
+        else:
+            # only consider valid channels
+            ch_mean = masked_channel_mean(ch_output, num_mic, 2, batch_dim=1)  # dim2, B, dim1, H
+        ch_mean = self.ch_average[i](ch_mean)
+        # the concat layer split into its channel and mean halves: the mean is broadcast
+        # to the channels instead of being expanded and concatenated
+        linear, prelu = self.ch_concat[i][0], self.ch_concat[i][1]
+        if isinstance(linear.weight, torch.Tensor):
+            H = ch_output.shape[-1]
+            ch_output = F.linear(ch_output, linear.weight[:,:H], linear.bias) + F.linear(ch_mean, linear.weight[:,H:]).unsqueeze(2)
+        else:
+            # int8 linear layer of quantize_model.py, its weight can not be split
+            ch_output = linear(torch.cat([ch_output, ch_mean.unsqueeze(2).expand_as(ch_output)], -1))
+        ch_output = prelu(ch_output)  # dim2, B, ch, dim1, N
+        ch_output = channel_last_group_norm(ch_output.view(dim2, batch_size*ch, dim1, N), self.ch_norm[i], 1)
+        output = output + ch_output.view(dim2, batch_size, ch, dim1, N)
+
+        return output
+
+
+def set_low_copy_layout(model, enabled):
+    #use the forward_low_copy() of the DPRNN/DPRNN_TAC modules of model
+    for m in unwrap_model(model).modules():
+        if isinstance(m, (DPRNN, DPRNN_TAC)):
+            m.low_copy = enabled
+
+
 # base module for deep DPRNN
 class DPRNN_base(nn.Module):
     def __init__(self, input_dim, feature_dim, hidden_dim, output_dim, num_spk=2,
@@ -406,16 +573,34 @@ class FaSNet_base(nn.Module):
         pad_context = torch.zeros(batch_size, nmic, context).type(input.type())
         input = torch.cat([pad_context, input, pad_context], 2)  # B, ch, L
 
-        # calculate index for each chunk
+        # overlapping chunks as a strided view, copied once
+        nchunk = 2*nsample // window - 1
+        chunks = input.unfold(2, 2*context + window, stride)[:,:,:nchunk].contiguous()  # B, ch, nchunk, chunk_size
+
+        # center frame
+        center_frame = chunks[:,:,:,context:context+window]
+
+        return center_frame, chunks, rest
+
+    def seg_signal_context_gather(self, x, window, context):
+        """
+        Reference implementation of seg_signal_context, with one gather per chunk offset.
+        Used by the tests and benchmarks.
+        """
+        input, rest = self.pad_input(x, window)
+        batch_size, nmic, nsample = input.shape
+        stride = window // 2
+
+        pad_context = torch.zeros(batch_size, nmic, context).type(input.type())
+        input = torch.cat([pad_context, input, pad_context], 2)  # B, ch, L
+
         nchunk = 2*nsample // window - 1
         begin_idx = np.arange(nchunk)*stride
         begin_idx = torch.from_numpy(begin_idx).type(input.type()).long().view(1, 1, -1)  # 1, 1, nchunk
         begin_idx = begin_idx.expand(batch_size, nmic, nchunk)  # B, ch, nchunk
-        # select entries from index
         chunks = [torch.gather(input, 2, begin_idx+i).unsqueeze(3) for i in range(2*context + window)]  # B, ch, nchunk, 1
         chunks = torch.cat(chunks, 3)  # B, ch, nchunk, chunk_size
 
-        # center frame
         center_frame = chunks[:,:,:,context:context+window]
 
         return center_frame, chunks, rest
@@ -430,6 +615,12 @@ class FaSNet_base(nn.Module):
         assert ref.size(1) == target.size(1), "Inputs should have same length."
         assert ref.size(2) >= target.size(2), "Reference input should be no smaller than the target input."
 
+        # the normalization is numerically sensitive: always compute it in fp32
+        with torch.autocast(ref.device.type, enabled=False):
+            return self._seq_cos_sim(ref.float(), target.float())
+
+    def _seq_cos_sim(self, ref, target):
+
         seq_length = ref.size(1)
 
         larger_ch = ref.size(0)
@@ -453,6 +644,29 @@ class FaSNet_base(nn.Module):
 
         return cos_sim.view(larger_ch, seq_length, -1)
 
+    def overlap_add(self, all_bf_output, rest, num_mic):
+        """
+        Signal of the beamformed frames (B, nspk, nmic, L, win) of a whole input,
+        overlap-added and averaged over the valid channels: (B, nspk, T)
+        """
+        batch_size, nspk, nmic = all_bf_output.shape[:3]
+
+        # reshape to utterance
+        bf_signal = all_bf_output.reshape(batch_size*nspk*nmic, -1, self.window*2)
+        bf_signal1 = bf_signal[:,:,:self.window].contiguous().view(batch_size*nspk*nmic, 1, -1)[:,:,self.stride:]
+        bf_signal2 = bf_signal[:,:,self.window:].contiguous().view(batch_size*nspk*nmic, 1, -1)[:,:,:-self.stride]
+        bf_signal = bf_signal1 + bf_signal2  # B*nspk*nmic, 1, T
+        if rest > 0:
+            bf_signal = bf_signal[:,:,:-rest]
+
+        return self.channel_mean(bf_signal.view(batch_size, nspk, nmic, -1), num_mic)  # B, nspk, T
+
+    def channel_mean(self, bf_signal, num_mic):
+        # mean of the beamformed signals (B, nspk, nmic, T), considering only the valid channels
+        if num_mic.max() == 0:
+            return bf_signal.mean(2)  # B, nspk, T
+        return masked_channel_mean(bf_signal, num_mic, 2)  # B, nspk, T
+
     def forward(self, input, num_mic):
         """
         input: shape (batch, max_num_ch, T)
@@ -478,12 +692,21 @@ class FaSNet_origin(FaSNet_base):
 
     def forward(self, input, num_mic):
 
-        batch_size = input.size(0)
-        nmic = input.size(1)
-
         # split input into chunks
         all_seg, all_mic_context, rest = self.seg_signal_context(input, self.window, self.context)  # B, nmic, L, win/chunk
-        seq_length = all_seg.size(2)
+
+        enc_output, ref_cos_sim = self.frame_features(all_seg, all_mic_context, num_mic)
+        all_bf_output = self.filter_frames(all_mic_context, enc_output, ref_cos_sim, num_mic)  # B, nspk, nmic, L, win
+
+        return self.overlap_add(all_bf_output, rest, num_mic)
+
+    def frame_features(self, all_seg, all_mic_context, num_mic):
+        """
+        Features of each frame that depend only on the frame and its context:
+        encoder output of all mics, before the normalization, and cosine similarity
+        of the ref mic context with the other mics.
+        """
+        batch_size, nmic, seq_length, _ = all_seg.shape
 
         # first step: filtering the ref mic to create a clean estimate
         # calculate cosine similarity
@@ -495,15 +718,25 @@ class FaSNet_origin(FaSNet_base):
             ref_cos_sim = ref_cos_sim.mean(0)  # B, L, 2*win+1
             ref_cos_sim = ref_cos_sim.transpose(1, 2).contiguous()  # B, 2*win+1, L
         else:
-            # consider only the valid channels
-            ref_cos_sim = [ref_cos_sim[:num_mic[b],b,:].mean(0).unsqueeze(0) for b in range(batch_size)]  # 1, L, 2*win+1
-            ref_cos_sim = torch.cat(ref_cos_sim, 0).transpose(1, 2).contiguous()  # B, 2*win+1, L
+            # consider only the valid channels, the nmic-1 channels other than the ref mic
+            ref_cos_sim = masked_channel_mean(ref_cos_sim, num_mic - 1, 0, batch_dim=1)  # B, L, 2*win+1
+            ref_cos_sim = ref_cos_sim.transpose(1, 2).contiguous()  # B, 2*win+1, L
 
+        # embeddings for all channels, the same for every speaker
+        enc_output = self.encoder(all_mic_context.contiguous().view(-1, 1, self.context*2+self.window))  # B*nmic*L, N, 1
+        enc_output = enc_output.view(batch_size, nmic, seq_length, self.enc_dim).transpose(2, 3).contiguous()  # B, nmic, N, L
+
+        return enc_output, ref_cos_sim
+
+    def filter_frames(self, all_mic_context, enc_output, ref_cos_sim, num_mic):
+        """
+        Beamformed frames of all mics, shape (B, nspk, nmic, L, win), from the
+        contexts and frame features of a sequence of L frames.
+        """
+        batch_size, nmic, seq_length, _ = all_mic_context.shape
 
         # pass to a DPRNN
-        ref_feature = all_mic_context[:,0].contiguous().view(batch_size*seq_length, 1, self.context*2+self.window)
-        ref_feature = self.encoder(ref_feature)  # B*L, N, 1
-        ref_feature = ref_feature.view(batch_size, seq_length, self.enc_dim).transpose(1, 2).contiguous()  # B, N, L
+        ref_feature = enc_output[:,0]  # B, N, L
         ref_filter = self.ref_BF(torch.cat([self.enc_LN(ref_feature), ref_cos_sim], 1), num_mic)  # B, 1, nspk, L, 2*win+1
 
         # convolve with ref mic context segments
@@ -524,8 +757,8 @@ class FaSNet_origin(FaSNet_base):
         other_cos_sim = other_cos_sim.permute(1,0,3,2).contiguous().view(-1, self.filter_dim, seq_length)  # B*nspk*(nmic-1), 2*win+1, L
 
         # pass to another DPRNN
-        other_feature = self.encoder(other_context_saved.view(-1, 1, self.context*2+self.window)).view(-1, seq_length, self.enc_dim)  # B*nspk*(nmic-1), L, N
-        other_feature = other_feature.transpose(1, 2).contiguous()  # B*nspk*(nmic-1), N, L
+        other_feature = torch.cat([enc_output[:,1:].unsqueeze(1)]*self.num_spk, 1)  # B, nspk, nmic-1, N, L
+        other_feature = other_feature.view(-1, self.enc_dim, seq_length)  # B*nspk*(nmic-1), N, L
         other_filter = self.other_BF(torch.cat([self.enc_LN(other_feature), other_cos_sim], 1), num_mic)  # B*nspk*(nmic-1), 1, 1, L, 2*win+1
 
         # convolve with other mic context segments
@@ -536,23 +769,7 @@ class FaSNet_origin(FaSNet_base):
 
         all_bf_output = torch.cat([ref_output.unsqueeze(1), other_output], 1)  # B*nspk, nmic, L, win
 
-        # reshape to utterance
-        bf_signal = all_bf_output.view(batch_size*self.num_spk*nmic, -1, self.window*2)
-        bf_signal1 = bf_signal[:,:,:self.window].contiguous().view(batch_size*self.num_spk*nmic, 1, -1)[:,:,self.stride:]
-        bf_signal2 = bf_signal[:,:,self.window:].contiguous().view(batch_size*self.num_spk*nmic, 1, -1)[:,:,:-self.stride]
-        bf_signal = bf_signal1 + bf_signal2  # B*nspk*nmic, 1, T
-        if rest > 0:
-            bf_signal = bf_signal[:,:,:-rest]
-
-        bf_signal = bf_signal.view(batch_size, self.num_spk, nmic, -1)  # B, nspk, nmic, T
-        # consider only the valid channels
-        if num_mic.max() == 0:
-            bf_signal = bf_signal.mean(2)  # B, nspk, T
-        else:
-            bf_signal = [bf_signal[b,:,:num_mic[b]].mean(1).unsqueeze(0) for b in range(batch_size)]  # nspk, T
-            bf_signal = torch.cat(bf_signal, 0)  # B, nspk, T
-
-        return bf_signal
+        return all_bf_output.view(batch_size, self.num_spk, nmic, seq_length, self.window)
 
 # single-stage FaSNet + TAC
 class FaSNet_TAC(FaSNet_base):
@@ -565,16 +782,25 @@ class FaSNet_TAC(FaSNet_base):
 
     def forward(self, input, num_mic):
 
-        batch_size = input.size(0)
-        nmic = input.size(1)
-
         # split input into chunks
         all_seg, all_mic_context, rest = self.seg_signal_context(input, self.window, self.context)  # B, nmic, L, win/chunk
-        seq_length = all_seg.size(2)
+
+        enc_output, all_cos_sim = self.frame_features(all_seg, all_mic_context, num_mic)
+        all_bf_output = self.filter_frames(all_mic_context, enc_output, all_cos_sim, num_mic)  # B, nspk, nmic, L, win
+
+        return self.overlap_add(all_bf_output, rest, num_mic)
+
+    def frame_features(self, all_seg, all_mic_context, num_mic):
+        """
+        Features of each frame that depend only on the frame and its context:
+        encoder output of all mics, before the normalization, and cosine similarity
+        of the ref mic center frame with the context of all mics.
+        """
+        batch_size, nmic, seq_length, _ = all_seg.shape
 
         # embeddings for all channels
-        enc_output = self.encoder(all_mic_context.view(-1, 1, self.context*2+self.window)).view(batch_size*nmic, seq_length, self.enc_dim).transpose(1, 2).contiguous()  # B*nmic, N, L
-        enc_output = self.enc_LN(enc_output).view(batch_size, nmic, self.enc_dim, seq_length)  # B, nmic, N, L
+        enc_output = self.encoder(all_mic_context.contiguous().view(-1, 1, self.context*2+self.window))  # B*nmic*L, N, 1
+        enc_output = enc_output.view(batch_size, nmic, seq_length, self.enc_dim).transpose(2, 3).contiguous()  # B, nmic, N, L
 
         # calculate the cosine similarities for ref channel's center frame with all channels' context
 
@@ -583,36 +809,144 @@ class FaSNet_TAC(FaSNet_base):
         all_cos_sim = self.seq_cos_sim(all_context, ref_seg)  # nmic, B*L, 2*win+1
         all_cos_sim = all_cos_sim.view(nmic, batch_size, seq_length, self.filter_dim).permute(1,0,3,2).contiguous()  # B, nmic, 2*win+1, L
 
+        return enc_output, all_cos_sim
+
+    def filter_frames(self, all_mic_context, enc_output, all_cos_sim, num_mic):
+        """
+        Beamformed frames of all mics, shape (B, nspk, nmic, L, win), from the
+        contexts and frame features of a sequence of L frames.
+        """
+        batch_size, nmic, seq_length, _ = all_mic_context.shape
+
+        enc_output = self.enc_LN(enc_output.view(batch_size*nmic, self.enc_dim, seq_length))
+        enc_output = enc_output.view(batch_size, nmic, self.enc_dim, seq_length)  # B, nmic, N, L
         input_feature = torch.cat([enc_output, all_cos_sim], 2)  # B, nmic, N+2*win+1, L
 
         # pass to DPRNN
         all_filter = self.all_BF(input_feature, num_mic)  # B, ch, nspk, L, 2*win+1
 
         # convolve with all mic's context
-        mic_context = torch.cat([all_mic_context.view(batch_size*nmic, 1, seq_length,
-                                                      self.context*2+self.window)]*self.num_spk, 1)  # B*nmic, nspk, L, 3*win
+        mic_context = torch.cat([all_mic_context.contiguous().view(batch_size*nmic, 1, seq_length,
+                                                                   self.context*2+self.window)]*self.num_spk, 1)  # B*nmic, nspk, L, 3*win
         all_bf_output = F.conv1d(mic_context.view(1, -1, self.context*2+self.window),
                                  all_filter.view(-1, 1, self.filter_dim),
                                  groups=batch_size*nmic*self.num_spk*seq_length) # 1, B*nmic*nspk*L, win
         all_bf_output = all_bf_output.view(batch_size, nmic, self.num_spk, seq_length, self.window)  # B, nmic, nspk, L, win
 
-        # reshape to utterance
-        bf_signal = all_bf_output.view(batch_size*nmic*self.num_spk, -1, self.window*2)
-        bf_signal1 = bf_signal[:,:,:self.window].contiguous().view(batch_size*nmic*self.num_spk, 1, -1)[:,:,self.stride:]
-        bf_signal2 = bf_signal[:,:,self.window:].contiguous().view(batch_size*nmic*self.num_spk, 1, -1)[:,:,:-self.stride]
-        bf_signal = bf_signal1 + bf_signal2  # B*nmic*nspk, 1, T
-        if rest > 0:
-            bf_signal = bf_signal[:,:,:-rest]
+        return all_bf_output.transpose(1, 2)
 
-        bf_signal = bf_signal.view(batch_size, nmic, self.num_spk, -1)  # B, nmic, nspk, T
-        # consider only the valid channels
-        if num_mic.max() == 0:
-            bf_signal = bf_signal.mean(1)  # B, nspk, T
+
+class StreamingFaSNet():
+    '''
+    Stateful streaming enhancement with a trained FaSNet_origin or FaSNet_TAC model.
+    process() takes hops of hop_len samples, shape (ch, hop_len), and returns
+    the enhanced hops, shape (nspk, hop_len), delayed by lookahead samples:
+    the algorithmic latency is hop_len + lookahead samples.
+    The features of a frame that depend only on its context (encoder output and
+    cosine similarities, see frame_features()) are computed once, as soon as the
+    frame context has been received, and cached for the frames of the last
+    window_len samples. The DPRNN blocks are bidirectional and normalized over the
+    whole sequence, so their state can not be carried from a call to the next one:
+    every hop runs them on the cached frames of the window, which bounds memory
+    and compute per hop and approximates the output on the whole recording.
+    The lookahead must include the context of the frames of the last output
+    sample: at least model.stride + model.context samples, plus fade_len.
+    Consecutive hops are crossfaded over fade_len samples, that the previous hop
+    estimated in its lookahead.
+    '''
+    def __init__(self, model, hop_len, window_len, lookahead, fade_len=None, num_mic=None, device='cpu'):
+        frame_lookahead = model.stride + model.context
+        if lookahead < frame_lookahead:
+            raise ValueError('lookahead must be at least ' + str(frame_lookahead) + ' samples (stride + context of the model)')
+        if hop_len + lookahead > window_len:
+            raise ValueError('window_len must be at least hop_len + lookahead')
+        if fade_len is None:
+            fade_len = min(hop_len, lookahead - frame_lookahead)
+        if fade_len > min(hop_len, lookahead - frame_lookahead):
+            raise ValueError('fade_len can not be longer than hop_len and lookahead - ' + str(frame_lookahead))
+        self.model = model.eval()
+        self.hop_len = hop_len
+        self.lookahead = lookahead
+        self.fade_len = fade_len
+        self.device = device
+        self.stride = model.stride
+        self.chunk_len = model.context*2 + model.window
+        # cached frames: the window, and at least the frames of a hop and its lookahead
+        self.window_frames = max(window_len // self.stride, (hop_len + lookahead) // self.stride + 2)
+        self.num_mic = torch.tensor([0.]) if num_mic is None else num_mic
+        self.fadein = torch.arange(fade_len, device=device).float() / max(fade_len, 1)
+        self.fadeout = 1. - self.fadein
+        self.reset()
+
+    def reset(self):
+        #start a new stream
+        self.samples = None  # input from the context start of the next frame
+        self.contexts = None  # 1, ch, L, chunk_len contexts of the cached frames
+        self.features = None  # frame features of the cached frames, L last
+        self.first_frame = 0  # index of the first cached frame
+        self.received = 0
+        self.tail = None
+
+    def add_frames(self):
+        # frame features of the frames whose context has been received
+        n_new = (self.samples.shape[-1] - self.chunk_len) // self.stride + 1
+        if n_new <= 0:
+            return
+        chunks = self.samples.unfold(1, self.chunk_len, self.stride)[:,:n_new].unsqueeze(0).contiguous()  # 1, ch, n_new, chunk_len
+        center = chunks[:,:,:,self.model.context:self.model.context+self.model.window]
+        features = self.model.frame_features(center, chunks, self.num_mic)
+        if self.contexts is None:
+            self.contexts, self.features = chunks, features
         else:
-            bf_signal = [bf_signal[b,:num_mic[b]].mean(0).unsqueeze(0) for b in range(batch_size)]  # nspk, T
-            bf_signal = torch.cat(bf_signal, 0)  # B, nspk, T
+            self.contexts = torch.cat([self.contexts, chunks], 2)
+            self.features = [torch.cat([f, new], -1) for f, new in zip(self.features, features)]
+        drop = max(self.contexts.shape[2] - self.window_frames, 0)
+        self.contexts = self.contexts[:,:,drop:]
+        self.features = [f[...,drop:] for f in self.features]
+        self.first_frame += drop
+        self.samples = self.samples[:,n_new*self.stride:]
+
+    def process(self, hop):
+        if hop.shape[-1] != self.hop_len:
+            raise ValueError('Expected hops of ' + str(self.hop_len) + ' samples')
+        if self.samples is None:
+            # the zero padding of the model before the first frame context
+            self.samples = torch.zeros(hop.shape[0], self.stride + self.model.context, device=self.device)
+        self.samples = torch.cat([self.samples, hop.to(self.device).float()], 1)
+        self.received += self.hop_len
+
+        # output samples of this hop and of the next crossfade
+        start = self.received - self.lookahead - self.hop_len
+        end = start + self.hop_len + self.fade_len
+        signal = torch.zeros(self.model.num_spk, end - start, device=self.device)
+        with torch.no_grad():
+            self.add_frames()
+            # frames overlapping the output, sample t is in the frames t // stride and t // stride + 1
+            first = max(start // self.stride, self.first_frame)
+            last = (end - 1) // self.stride + 1
+            if self.contexts is not None and last > first:
+                frames = self.model.filter_frames(self.contexts, *self.features, self.num_mic)  # 1, nspk, nmic, L, win
+                frames = frames[:,:,:,first-self.first_frame:last-self.first_frame+1].float()
+                blocks = frames[:,:,:,:-1,self.stride:] + frames[:,:,:,1:,:self.stride]  # 1, nspk, nmic, n, stride
+                blocks = self.model.channel_mean(blocks.reshape(blocks.shape[0], blocks.shape[1], blocks.shape[2], -1),
+                                                 self.num_mic)[0]  # nspk, n*stride from sample first*stride
+                begin = max(start, first*self.stride)
+                signal[:,begin-start:] = blocks[:,begin-first*self.stride:end-first*self.stride]
+
+        output = signal[:,:self.hop_len].clone()
+        # the previous call estimated the first fade_len samples in its lookahead
+        if self.tail is not None and self.fade_len > 0:
+            output[:,:self.fade_len] = self.tail * self.fadeout + output[:,:self.fade_len] * self.fadein
+        self.tail = signal[:,self.hop_len:]
+        return output
 
-        return bf_signal
+    def flush(self):
+        #the last lookahead samples of the stream, none if no hop has been processed
+        if self.samples is None:
+            return torch.zeros(self.model.num_spk, 0, device=self.device)
+        n_hops = -(-self.lookahead // self.hop_len)
+        output = [self.process(torch.zeros(self.samples.shape[0], self.hop_len)) for i in range(n_hops)]
+        return torch.cat(output, 1)[:,:self.lookahead]
 
 
 def test_model():
@@ -637,5 +971,143 @@ def test_model():
     print('TAC output shape: ', y2.shape)  # (batch, nspk, length)
 
 
+def test_seg_signal_context():
+    '''
+    Test that seg_signal_context gives the same chunks (bit by bit)
+    as the reference gather implementation
+    '''
+    print ('\nTesting seg_signal_context')
+    model = FaSNet_origin(enc_dim=64, feature_dim=64, hidden_dim=128, layer=6, segment_size=24,
+                          nspk=1, win_len=16, context_len=16, sr=16000)
+    for length in [32000, 32001, 31999, 1000]:
+        x = torch.rand(2, 4, length)
+        center, chunks, rest = model.seg_signal_context(x, model.window, model.context)
+        center_ref, chunks_ref, rest_ref = model.seg_signal_context_gather(x, model.window, model.context)
+        assert torch.equal(chunks, chunks_ref) and torch.equal(center, center_ref) and rest == rest_ref
+        print ('Length ' + str(length) + ': chunks ' + str(tuple(chunks.shape)) + ' equal')
+
+
+def test_masked_channel_mean():
+    '''
+    Test masked_channel_mean against the per-sample means, and the models
+    with batches mixing 4-channel and 8-channel inputs (zero-padded to 8)
+    against the inputs processed one by one with their own channels
+    '''
+    print ('\nTesting masked_channel_mean')
+    num_mic = torch.tensor([4, 8, 2])
+    x = torch.rand(3, 8, 5, 7)
+    reference = torch.cat([x[b,:num_mic[b]].mean(0).unsqueeze(0) for b in range(3)], 0)
+    assert torch.allclose(masked_channel_mean(x, num_mic, 1), reference, atol=1e-6)
+    x = torch.rand(8, 3, 5)
+    reference = torch.cat([x[:num_mic[b],b].mean(0).unsqueeze(0) for b in range(3)], 0)
+    assert torch.allclose(masked_channel_mean(x, num_mic, 0, batch_dim=1), reference, atol=1e-6)
+
+    x = torch.rand(2, 8, 16000)
+    x[0,4:] = 0.
+    num_mic = torch.tensor([4, 8])
+    for model in [FaSNet_origin(enc_dim=64, feature_dim=64, hidden_dim=128, layer=2, segment_size=24,
+                                nspk=1, win_len=16, context_len=16, sr=16000),
+                  FaSNet_TAC(enc_dim=64, feature_dim=64, hidden_dim=128, layer=2, segment_size=24,
+                             nspk=1, win_len=16, context_len=16, sr=16000)]:
+        model.eval()
+        with torch.no_grad():
+            y = model(x, num_mic)
+            for b in range(len(num_mic)):
+                y_b = model(x[b:b+1,:num_mic[b]], num_mic[b:b+1])
+                assert torch.allclose(y[b:b+1], y_b, atol=1e-5)
+        print (type(model).__name__ + ' mixed 4/8 channels output shape: ', y.shape, 'equal to the single inputs')
+
+
+def test_streaming():
+    '''
+    Test the streaming enhancement with 64 ms hops and 32 ms lookahead against the
+    offline enhancement of the whole signal: the cached frame features must be the
+    offline ones, and the output, delayed by the lookahead, close to the offline one
+    (the bidirectional DPRNN only sees the lookahead of the future frames)
+    '''
+    #evaluate_baseline_task1 is in the repository root
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from evaluate_baseline_task1 import enhance_sound
+    print ('\nTesting StreamingFaSNet')
+    x = torch.rand(4, 1024*20) - 0.5
+    for model in [FaSNet_origin(enc_dim=64, feature_dim=64, hidden_dim=128, layer=2, segment_size=24,
+                                nspk=1, win_len=16, context_len=16, sr=16000),
+                  FaSNet_TAC(enc_dim=64, feature_dim=64, hidden_dim=128, layer=2, segment_size=24,
+                             nspk=1, win_len=16, context_len=16, sr=16000)]:
+        model.eval()
+        with torch.no_grad():
+            offline = torch.from_numpy(enhance_sound(x.unsqueeze(0), model, 'cpu', x.shape[-1], 1.))[0]
+            all_seg, all_mic_context, rest = model.seg_signal_context(x.unsqueeze(0), model.window, model.context)
+            features = model.frame_features(all_seg, all_mic_context, torch.tensor([0.]))
+        streamer = StreamingFaSNet(model, hop_len=1024, window_len=16000, lookahead=512)
+        output = [streamer.process(x[:,i:i+1024]) for i in range(0, x.shape[-1], 1024)]
+        # the cached frames are the last ones of the offline frames
+        n = streamer.first_frame + streamer.contexts.shape[2]
+        assert torch.equal(streamer.contexts, all_mic_context[:,:,streamer.first_frame:n])
+        assert all([torch.allclose(f, f_offline[...,streamer.first_frame:n], atol=1e-5)
+                    for f, f_offline in zip(streamer.features, features)])
+        output = torch.cat(output + [streamer.flush()], 1)[:,streamer.lookahead:]
+        assert output.shape == offline.shape == (1, x.shape[-1])
+        snr = 10 * torch.log10(offline.pow(2).sum() / (output - offline).pow(2).sum())
+        assert snr > 8
+        # flushing an empty stream gives no samples
+        streamer.reset()
+        assert streamer.flush().shape == (1, 0)
+        print (type(model).__name__ + ' streamed output shape: ', output.shape, '| SNR to the offline output {:.1f} dB'.format(snr.item()))
+
+
+def test_activation_checkpointing():
+    '''
+    Test that the checkpointed DPRNN layers give the gradients of the standard training step
+    '''
+    print ('\nTesting activation checkpointing')
+    x = torch.rand(2, 4, 8000)
+    num_mic = torch.tensor([3, 4])
+    for model in [FaSNet_origin(enc_dim=64, feature_dim=64, hidden_dim=128, layer=2, segment_size=24,
+                                nspk=1, win_len=16, context_len=16, sr=16000),
+                  FaSNet_TAC(enc_dim=64, feature_dim=64, hidden_dim=128, layer=2, segment_size=24,
+                             nspk=1, win_len=16, context_len=16, sr=16000)]:
+        grads = []
+        for checkpointing in [False, True]:
+            set_activation_checkpointing(model, checkpointing)
+            model.zero_grad()
+            model(x, num_mic).sum().backward()
+            grads.append([p.grad.clone() for p in model.parameters()])
+        assert all([torch.allclose(g, g_ckpt, atol=1e-5) for g, g_ckpt in zip(*grads)])
+        print (type(model).__name__ + ': equal gradients with checkpointing')
+
+
+def test_low_copy_layout():
+    '''
+    Test that the low-copy layout of the DPRNN layers gives the outputs and gradients of the standard one
+    '''
+    print ('\nTesting low-copy DPRNN layout')
+    #in double precision: the float32 gradients of y.sum() reach 1e5 and some of them
+    #differ by more than 1e-3 relative between the layouts, from rounding alone
+    x = torch.rand(2, 4, 8000).double()
+    for model in [FaSNet_origin(enc_dim=64, feature_dim=64, hidden_dim=128, layer=2, segment_size=24,
+                                nspk=1, win_len=16, context_len=16, sr=16000).double(),
+                  FaSNet_TAC(enc_dim=64, feature_dim=64, hidden_dim=128, layer=2, segment_size=24,
+                             nspk=1, win_len=16, context_len=16, sr=16000).double()]:
+        for num_mic in [torch.tensor([0, 0]), torch.tensor([3, 4])]:
+            outputs, grads = [], []
+            for low_copy in [False, True]:
+                set_low_copy_layout(model, low_copy)
+                model.zero_grad()
+                y = model(x, num_mic)
+                y.sum().backward()
+                outputs.append(y.detach())
+                grads.append([p.grad.clone() for p in model.parameters()])
+            assert torch.allclose(outputs[0], outputs[1], atol=1e-10)
+            assert all([(g - g_low).norm() <= 1e-8 * g.norm() for g, g_low in zip(*grads)])
+            print (type(model).__name__ + ' num_mic ' + str(num_mic.tolist()) + ': max abs output difference ',
+                   (outputs[0] - outputs[1]).abs().max().item())
+
+
 if __name__ == "__main__":
     test_model()
+    test_seg_signal_context()
+    test_masked_channel_mean()
+    test_streaming()
+    test_activation_checkpointing()
+    test_low_copy_layout()
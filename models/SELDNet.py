@@ -1,20 +1,56 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import os
+import os, sys
+import copy
 import numpy as np
-import utility_functions as uf
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+try:
+    from models.checkpointing import checkpoint, is_compiling, unwrap_model
+except ImportError:
+    #run as a script from the models directory
+    from checkpointing import checkpoint, is_compiling, unwrap_model
 
 '''
 Pytorch implementation of the original SELDNet: https://arxiv.org/pdf/1807.00129.pdf
 And an augmented version of it, adapted for the output of the L#DAS21 challenge.
 '''
 
+def pooled_mask(mask, pool, n_frames):
+    '''
+    Mask of the valid pooled frames from the [batch, time] mask of the valid
+    input frames: a pooled frame is valid if all its pool input frames are
+    '''
+    return mask[:,:n_frames*pool].reshape(mask.shape[0], n_frames, pool).all(-1)
+
+
+def checkpoint_block(block, x):
+    '''
+    block(x) with activation checkpointing. The BatchNorm running statistics
+    are updated by the forward pass only, not again by the recomputation
+    '''
+    def run(x):
+        if not torch.is_grad_enabled():
+            return block(x)
+        #recomputation in the backward pass
+        bns = [m for m in block.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+        saved = [(bn.momentum, bn.num_batches_tracked.clone()) for bn in bns]
+        for bn in bns:
+            bn.momentum = 0.
+        try:
+            return block(x)
+        finally:
+            for bn, (momentum, num_batches_tracked) in zip(bns, saved):
+                bn.momentum = momentum
+                bn.num_batches_tracked.copy_(num_batches_tracked)
+    return checkpoint(run, x)
+
+
 class Seldnet_vanilla(nn.Module):
     def __init__(self, time_dim, freq_dim=256, input_channels=8, output_classes=14,
                  pool_size=[[8,2],[8,2],[2,2]], pool_time=False,  n_cnn_filters=64,
                  rnn_size=128, n_rnn=2,fc_size=128, dropout_perc=0., class_overlaps=3.,
-                 verbose=False):
+                 bidirectional=True, verbose=False):
         super(Seldnet_vanilla, self).__init__()
         self.verbose = verbose
         self.time_dim = time_dim
@@ -23,8 +59,12 @@ class Seldnet_vanilla(nn.Module):
         doa_output_size = sed_output_size * 3   #here 3 is the number of spatial dimensions xyz
         if pool_time:
             self.time_pooled_size = int(time_dim / np.prod(np.array(pool_size), axis=0)[-1])
+            self.time_pool = int(np.prod(np.array(pool_size), axis=0)[-1])
         else:
             self.time_pooled_size = time_dim
+            self.time_pool = 1
+        self.block_time_pools = [p[1] if pool_time else 1 for p in pool_size]
+        rnn_out_size = rnn_size * 2 if bidirectional else rnn_size
         #building CNN feature extractor
         conv_layers = []
         in_chans = input_channels
@@ -47,46 +87,96 @@ class Seldnet_vanilla(nn.Module):
         self.cnn = nn.Sequential(*conv_layers)
 
         self.rnn = nn.GRU(128, rnn_size, num_layers=n_rnn, batch_first=True,
-                          bidirectional=True, dropout=dropout_perc)
+                          bidirectional=bidirectional, dropout=dropout_perc)
 
         self.sed = nn.Sequential(
-                    nn.Linear(256, fc_size),
+                    nn.Linear(rnn_out_size, fc_size),
                     nn.Dropout(dropout_perc),
                     nn.Linear(fc_size, sed_output_size),
                     nn.Sigmoid())
 
         self.doa = nn.Sequential(
-                    nn.Linear(256, fc_size),
+                    nn.Linear(rnn_out_size, fc_size),
                     nn.Dropout(dropout_perc),
                     nn.Linear(fc_size, doa_output_size),
                     nn.Tanh())
+        #FusedHeads replacing sed and doa, set by fuse_for_inference()
+        self.fused_heads = None
+        #recompute the cnn blocks in the backward pass instead of storing their activations
+        self.checkpointing = False
 
-    def forward(self, x):
-        x = self.cnn(x)
-        if self.verbose:
+    def forward(self, x, mask=None):
+        '''
+        x: [batch, channels, freq, time] spectrograms of any length
+        mask: optional [batch, time] bool mask of the valid time frames, for batches
+        of zero-padded inputs of different lengths. The padded frames are zeroed after
+        every cnn block, skipped by the rnn and their sed/doa outputs are set to zero.
+        '''
+        #prints would break the graphs of torch.compile and torch.jit
+        verbose = self.verbose and not is_compiling()
+        if mask is None and not self.checkpointing:
+            x = self.cnn(x)
+        else:
+            #zero the padded frames after every block, like the conv padding of a shorter input
+            pool = 1
+            for block, block_pool in zip(self.cnn, self.block_time_pools):
+                if self.checkpointing and torch.is_grad_enabled():
+                    x = checkpoint_block(block, x)
+                else:
+                    x = block(x)
+                pool *= block_pool
+                if mask is not None:
+                    x = x * pooled_mask(mask, pool, x.shape[-1])[:,None,None,:].to(x.dtype)
+        if verbose:
             print ('cnn out ', x.shape)    #target dim: [batch, n_cnn_filters, 2, time_frames]
         x = x.permute(0,3,1,2) #[batch, time, channels, freq]
-        if self.verbose:
+        if verbose:
             print ('permuted: ', x.shape)    #target dim: [batch, time_frames, n_cnn_filters, 2]
-        x = x.reshape(x.shape[0], self.time_pooled_size, -1)
-        if self.verbose:
+        x = x.reshape(x.shape[0], x.shape[1], -1)    #the pooled time is inferred from the input
+        if verbose:
             print ('reshaped: ', x.shape)    #target dim: [batch, 2*n_cnn_filters]
+        if mask is not None:
+            valid = pooled_mask(mask, self.time_pool, x.shape[1])
+            x = nn.utils.rnn.pack_padded_sequence(x, valid.sum(1).cpu(), batch_first=True,
+                                                  enforce_sorted=False)
         x, h = self.rnn(x)
-        if self.verbose:
+        if mask is not None:
+            x, _ = nn.utils.rnn.pad_packed_sequence(x, batch_first=True, total_length=valid.shape[1])
+        if verbose:
             print ('rnn out:  ', x.shape)    #target dim: [batch, 2*n_cnn_filters]
-        sed = self.sed(x)
-        doa = self.doa(x)
-        if self.verbose:
+        sed, doa = self.heads(x)
+        if mask is not None:
+            sed = sed * valid.unsqueeze(-1)
+            doa = doa * valid.unsqueeze(-1)
+        if verbose:
             print ('sed prediction:  ', sed.shape)  #target dim: [batch, time, sed_output_size]
             print ('doa prediction: ', doa.shape)  #target dim: [batch, time, doa_output_size]
 
         return sed, doa
 
+    def cnn_features(self, x):
+        #cnn output as a sequence: [batch, time_frames, features]
+        x = self.cnn(x)
+        x = x.permute(0,3,1,2) #[batch, time, channels, freq]
+        return x.reshape(x.shape[0], x.shape[1], -1)
+
+    def rnn_heads(self, x, h=None):
+        #rnn and sed/doa heads, with the initial and last rnn hidden states
+        x, h = self.rnn(x, h)
+        sed, doa = self.heads(x)
+        return sed, doa, h
+
+    def heads(self, x):
+        #sed and doa predictions from the rnn output
+        if self.fused_heads is not None:
+            return self.fused_heads(x)
+        return self.sed(x), self.doa(x)
+
 class Seldnet_augmented(nn.Module):
     def __init__(self, time_dim, freq_dim=256, input_channels=4, output_classes=14,
                  pool_size=[[8,2],[8,2],[2,2],[1,1]], cnn_filters=[64,128,256,512], pool_time=True,
                  rnn_size=256, n_rnn=3, fc_size=1024, dropout_perc=0.3, class_overlaps=3.,
-                 verbose=False):
+                 bidirectional=True, verbose=False):
         super(Seldnet_augmented, self).__init__()
         self.verbose = verbose
         self.time_dim = time_dim
@@ -95,8 +185,12 @@ class Seldnet_augmented(nn.Module):
         doa_output_size = sed_output_size * 3   #here 3 is the number of spatial dimensions xyz
         if pool_time:
             self.time_pooled_size = int(time_dim / np.prod(np.array(pool_size), axis=0)[-1])
+            self.time_pool = int(np.prod(np.array(pool_size), axis=0)[-1])
         else:
             self.time_pooled_size = time_dim
+            self.time_pool = 1
+        self.block_time_pools = [p[1] if pool_time else 1 for p in pool_size]
+        rnn_out_size = rnn_size * 2 if bidirectional else rnn_size
         #building CNN feature extractor
         conv_layers = []
         in_chans = input_channels
@@ -119,11 +213,13 @@ class Seldnet_augmented(nn.Module):
 
         self.cnn = nn.Sequential(*conv_layers)
 
-        self.rnn = nn.GRU(1024, rnn_size, num_layers=n_rnn, batch_first=True,
-                          bidirectional=True, dropout=dropout_perc)
+        #cnn output features per frame: last block channels * pooled frequency bins (512*2 by default)
+        rnn_input_size = int(cnn_filters[-1] * freq_dim // np.prod(np.array(pool_size), axis=0)[0])
+        self.rnn = nn.GRU(rnn_input_size, rnn_size, num_layers=n_rnn, batch_first=True,
+                          bidirectional=bidirectional, dropout=dropout_perc)
 
         self.sed = nn.Sequential(
-                    nn.Linear(rnn_size*2, fc_size),
+                    nn.Linear(rnn_out_size, fc_size),
                     nn.ReLU(),
                     nn.Linear(fc_size, fc_size),
                     nn.ReLU(),
@@ -134,7 +230,7 @@ class Seldnet_augmented(nn.Module):
                     nn.Sigmoid())
 
         self.doa = nn.Sequential(
-                    nn.Linear(rnn_size*2, fc_size),
+                    nn.Linear(rnn_out_size, fc_size),
                     nn.ReLU(),
                     nn.Linear(fc_size, fc_size),
                     nn.ReLU(),
@@ -143,28 +239,259 @@ class Seldnet_augmented(nn.Module):
                     nn.Dropout(dropout_perc),
                     nn.Linear(fc_size, doa_output_size),
                     nn.Tanh())
+        #FusedHeads replacing sed and doa, set by fuse_for_inference()
+        self.fused_heads = None
+        #recompute the cnn blocks in the backward pass instead of storing their activations
+        self.checkpointing = False
 
-    def forward(self, x):
-        x = self.cnn(x)
-        if self.verbose:
+    def forward(self, x, mask=None):
+        '''
+        x: [batch, channels, freq, time] spectrograms of any length
+        mask: optional [batch, time] bool mask of the valid time frames, for batches
+        of zero-padded inputs of different lengths. The padded frames are zeroed after
+        every cnn block, skipped by the rnn and their sed/doa outputs are set to zero.
+        '''
+        #prints would break the graphs of torch.compile and torch.jit
+        verbose = self.verbose and not is_compiling()
+        if mask is None and not self.checkpointing:
+            x = self.cnn(x)
+        else:
+            #zero the padded frames after every block, like the conv padding of a shorter input
+            pool = 1
+            for block, block_pool in zip(self.cnn, self.block_time_pools):
+                if self.checkpointing and torch.is_grad_enabled():
+                    x = checkpoint_block(block, x)
+                else:
+                    x = block(x)
+                pool *= block_pool
+                if mask is not None:
+                    x = x * pooled_mask(mask, pool, x.shape[-1])[:,None,None,:].to(x.dtype)
+        if verbose:
             print ('cnn out ', x.shape)    #target dim: [batch, n_cnn_filters, 2, time_frames]
         x = x.permute(0,3,1,2) #[batch, time, channels, freq]
-        if self.verbose:
+        if verbose:
             print ('permuted: ', x.shape)    #target dim: [batch, time_frames, n_cnn_filters, 2]
-        x = x.reshape(x.shape[0], self.time_pooled_size, -1)
-        if self.verbose:
+        x = x.reshape(x.shape[0], x.shape[1], -1)    #the pooled time is inferred from the input
+        if verbose:
             print ('reshaped: ', x.shape)    #target dim: [batch, 2*n_cnn_filters]
+        if mask is not None:
+            valid = pooled_mask(mask, self.time_pool, x.shape[1])
+            x = nn.utils.rnn.pack_padded_sequence(x, valid.sum(1).cpu(), batch_first=True,
+                                                  enforce_sorted=False)
         x, h = self.rnn(x)
-        if self.verbose:
+        if mask is not None:
+            x, _ = nn.utils.rnn.pad_packed_sequence(x, batch_first=True, total_length=valid.shape[1])
+        if verbose:
             print ('rnn out:  ', x.shape)    #target dim: [batch, 2*n_cnn_filters]
-        sed = self.sed(x)
-        doa = self.doa(x)
-        if self.verbose:
+        sed, doa = self.heads(x)
+        if mask is not None:
+            sed = sed * valid.unsqueeze(-1)
+            doa = doa * valid.unsqueeze(-1)
+        if verbose:
             print ('sed prediction:  ', sed.shape)  #target dim: [batch, time, sed_output_size]
             print ('doa prediction: ', doa.shape)  #target dim: [batch, time, doa_output_size]
 
         return sed, doa
 
+    def cnn_features(self, x):
+        #cnn output as a sequence: [batch, time_frames, features]
+        x = self.cnn(x)
+        x = x.permute(0,3,1,2) #[batch, time, channels, freq]
+        return x.reshape(x.shape[0], x.shape[1], -1)
+
+    def rnn_heads(self, x, h=None):
+        #rnn and sed/doa heads, with the initial and last rnn hidden states
+        x, h = self.rnn(x, h)
+        sed, doa = self.heads(x)
+        return sed, doa, h
+
+    def heads(self, x):
+        #sed and doa predictions from the rnn output
+        if self.fused_heads is not None:
+            return self.fused_heads(x)
+        return self.sed(x), self.doa(x)
+
+
+def split_head(head):
+    #Linear layers of a sed/doa head, each with the activations that follow it (Dropout removed)
+    linears, activations = [], []
+    for m in head:
+        if isinstance(m, nn.Linear):
+            linears.append(m)
+            activations.append([])
+        elif not isinstance(m, nn.Dropout):
+            activations[-1].append(m)
+    return linears, activations
+
+
+class FusedHeads(nn.Module):
+    '''
+    The sed and doa heads of a SELDNet as a single inference module, without Dropout.
+    The first layers of the two heads read the same rnn output and run as one wider
+    GEMM; the following hidden layers run as one batched GEMM over the two heads
+    (block-diagonal weights); the output layers, of different sizes, run separately.
+    '''
+    def __init__(self, sed, doa):
+        super(FusedHeads, self).__init__()
+        sed_linears, sed_activations = split_head(sed)
+        doa_linears, doa_activations = split_head(doa)
+        if [(l.in_features, l.out_features) for l in sed_linears[:-1]] != \
+           [(l.in_features, l.out_features) for l in doa_linears[:-1]] or \
+           [[type(a) for a in act] for act in sed_activations[:-1]] != \
+           [[type(a) for a in act] for act in doa_activations[:-1]]:
+            raise ValueError('The sed and doa heads need the same hidden layers to be fused')
+        self.hidden_size = sed_linears[0].out_features
+        self.first = nn.Linear(sed_linears[0].in_features, 2 * self.hidden_size)
+        with torch.no_grad():
+            self.first.weight.copy_(torch.cat([sed_linears[0].weight, doa_linears[0].weight], 0))
+            self.first.bias.copy_(torch.cat([sed_linears[0].bias, doa_linears[0].bias], 0))
+        #hidden weights as [2, in, out] for torch.baddbmm, biases as [2, 1, out]
+        self.hidden_weights = nn.ParameterList([
+            nn.Parameter(torch.stack([s.weight.t(), d.weight.t()]).detach().clone())
+            for s, d in zip(sed_linears[1:-1], doa_linears[1:-1])])
+        self.hidden_biases = nn.ParameterList([
+            nn.Parameter(torch.stack([s.bias, d.bias]).unsqueeze(1).detach().clone())
+            for s, d in zip(sed_linears[1:-1], doa_linears[1:-1])])
+        self.activations = nn.ModuleList([nn.Sequential(*act) for act in sed_activations[:-1]])
+        self.sed_out = nn.Sequential(sed_linears[-1], *sed_activations[-1])
+        self.doa_out = nn.Sequential(doa_linears[-1], *doa_activations[-1])
+
+    def forward(self, x):
+        shape = x.shape[:-1]
+        x = self.activations[0](self.first(x.reshape(-1, x.shape[-1])))  #[N, 2*hidden]
+        x = x.view(-1, 2, self.hidden_size).transpose(0, 1)  #[2, N, hidden]
+        for weight, bias, activation in zip(self.hidden_weights, self.hidden_biases, self.activations[1:]):
+            x = activation(torch.baddbmm(bias, x, weight))
+        sed = self.sed_out(x[0])
+        doa = self.doa_out(x[1])
+        return sed.view(*shape, -1), doa.view(*shape, -1)
+
+
+def fuse_for_inference(model):
+    '''
+    Copy of a Seldnet_vanilla or Seldnet_augmented model for cpu inference:
+    BatchNorm folded into the convolutions, Dropout removed and the sed/doa
+    heads fused (FusedHeads). The outputs are the ones of model in eval mode,
+    up to float rounding.
+    '''
+    model = copy.deepcopy(unwrap_model(model)).eval()
+    blocks = []
+    for block in model.cnn:
+        conv, bn = block[0], block[1]
+        others = [m for m in list(block)[2:] if not isinstance(m, nn.Dropout)]
+        blocks.append(nn.Sequential(fuse_conv_bn_eval(conv, bn), *others))
+    model.cnn = nn.Sequential(*blocks)
+    #the gru dropout is only applied in training mode
+    model.rnn.dropout = 0.
+    model.fused_heads = FusedHeads(model.sed, model.doa).eval()
+    model.sed = None
+    model.doa = None
+    return model
+
+
+def streaming_margin(model):
+    '''
+    Pooled frames of context needed on each side of a chunk for the cnn output of
+    the chunk to match the whole-recording one, from the time kernel, padding and
+    stride of the conv and pooling layers: the frames near a chunk edge that see
+    the conv zero padding instead of the signal, counted at the resolution of each
+    layer and rounded up to whole pooled frames
+    '''
+    def time_param(param):
+        return param[-1] if isinstance(param, (tuple, list)) else param
+    edge = 0  #frames affected by a chunk edge, at the current time resolution
+    for m in model.cnn.modules():
+        if isinstance(m, nn.Conv2d):
+            kernel, padding = m.kernel_size[1], m.padding[1]
+            reach = max(padding, m.dilation[1] * (kernel - 1) - padding)
+            edge = int(np.ceil((edge + reach) / m.stride[1]))
+        elif isinstance(m, nn.MaxPool2d):
+            kernel = time_param(m.kernel_size)
+            stride = time_param(m.stride) if m.stride is not None else kernel
+            edge = int(np.ceil((edge + kernel - stride) / stride))
+    return edge
+
+
+class StreamingSeldnet():
+    '''
+    Chunked streaming inference of a Seldnet_vanilla or Seldnet_augmented model
+    built with bidirectional=False.
+    push() takes the next spectrogram frames, shape (batch, ch, freq, n) with any n,
+    and returns the sed and doa frames completed so far, one per pooled
+    (100 ms label) frame, shapes (batch, k, sed_size) and (batch, k, doa_size).
+    The cnn runs on chunks of chunk_frames pooled frames aligned with the time pooling,
+    with margin pooled frames of context on both sides, so that its output is the
+    same as on the whole recording; the gru hidden state is carried across chunks.
+    The default margin is the one the conv blocks need (see streaming_margin()),
+    a smaller one raises an error.
+    The latency is chunk_frames + margin pooled frames, and memory does not grow
+    with the length of the recording. flush() returns the last frames.
+    '''
+    def __init__(self, model, chunk_frames=10, margin=None):
+        if model.rnn.bidirectional:
+            raise ValueError('Streaming needs a model built with bidirectional=False')
+        needed = streaming_margin(model)
+        if margin is None:
+            margin = needed
+        elif margin < needed:
+            raise ValueError('The cnn of this model needs a margin of at least ' + str(needed) + ' pooled frames')
+        self.model = model.eval()
+        self.pool = model.time_pool
+        self.chunk_frames = chunk_frames
+        self.margin = margin
+        self.reset()
+
+    def reset(self):
+        #start a new recording
+        self.pending = None  #input frames not processed yet
+        self.context = None  #last processed input frames, left context of the next chunk
+        self.h = None
+
+    def process_chunk(self, x, n_frames):
+        #sed, doa of the first n_frames pooled frames of x, the next frames of x are right context
+        left_margin = 0
+        if self.context is not None:
+            left_margin = self.context.shape[-1] // self.pool
+            x = torch.cat([self.context, x], -1)
+        with torch.no_grad():
+            features = self.model.cnn_features(x)[:,left_margin:left_margin+n_frames]
+            sed, doa, self.h = self.model.rnn_heads(features, self.h)
+        #the last margin processed frames are the left context of the next chunk
+        end = (left_margin + n_frames) * self.pool
+        self.context = x[...,max(end - self.margin*self.pool, 0):end]
+        return sed, doa
+
+    def push(self, frames):
+        if self.pending is None:
+            self.pending = frames
+        else:
+            self.pending = torch.cat([self.pending, frames], -1)
+        chunk_len = self.chunk_frames * self.pool
+        margin_len = self.margin * self.pool
+        sed, doa = [], []
+        while self.pending.shape[-1] >= chunk_len + margin_len:
+            s, d = self.process_chunk(self.pending[...,:chunk_len+margin_len], self.chunk_frames)
+            sed.append(s)
+            doa.append(d)
+            self.pending = self.pending[...,chunk_len:]
+        return self.collect(sed, doa)
+
+    def flush(self):
+        #the frames left at the end of the recording, without right context
+        sed, doa = [], []
+        n_frames = self.pending.shape[-1] // self.pool if self.pending is not None else 0
+        if n_frames > 0:
+            s, d = self.process_chunk(self.pending[...,:n_frames*self.pool], n_frames)
+            sed.append(s)
+            doa.append(d)
+        self.reset()
+        return self.collect(sed, doa)
+
+    def collect(self, sed, doa):
+        if len(sed) == 0:
+            return None, None
+        return torch.cat(sed, 1), torch.cat(doa, 1)
+
 
 def test_model():
     '''
@@ -175,6 +502,9 @@ def test_model():
     sample = np.ones((in_chans,32000*60))
     nperseg = 512
     noverlap = 112
+    #utility_functions is in the repository root
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import utility_functions as uf
     sp = uf.spectrum_fast(sample, nperseg=nperseg, noverlap=noverlap, output_phase=False)
     sp = torch.tensor(sp.reshape(1,sp.shape[0],sp.shape[1],sp.shape[2])).float()
 
@@ -194,5 +524,128 @@ def test_model():
     sed, doa = model_vanilla(sp)
     print ('SED shape: ', sed.shape, "| DOA shape: ", doa.shape)    #target shape sed=[batch,600(label frames),42] doa=[batch, 600(label frames),126
 
+def test_streaming():
+    '''
+    Test that the streamed sed and doa frames match the ones of the whole input,
+    with the margin derived from the conv blocks of the default models and of
+    models without time pooling (one frame of context per block)
+    '''
+    print ('\nTesting StreamingSeldnet')
+    time_dim = 8 * 37
+    x = torch.rand(1, 4, 256, time_dim)
+    #models and the margins of their conv blocks
+    for model, margin in [(Seldnet_vanilla(time_dim, input_channels=4, pool_time=True, class_overlaps=3, bidirectional=False), 1),
+                          (Seldnet_augmented(time_dim, input_channels=4, pool_time=True, class_overlaps=3, bidirectional=False), 2),
+                          (Seldnet_vanilla(time_dim, input_channels=4, pool_time=False, class_overlaps=3, bidirectional=False), 3),
+                          (Seldnet_augmented(time_dim, input_channels=4, pool_time=False, class_overlaps=3, bidirectional=False), 4)]:
+        model.eval()
+        with torch.no_grad():
+            sed, doa = model(x)
+        assert streaming_margin(model) == margin
+        streamer = StreamingSeldnet(model, chunk_frames=5)
+        outputs = [streamer.push(x[...,i:i+50]) for i in range(0, time_dim, 50)] + [streamer.flush()]
+        sed_stream = torch.cat([o[0] for o in outputs if o[0] is not None], 1)
+        doa_stream = torch.cat([o[1] for o in outputs if o[1] is not None], 1)
+        assert torch.allclose(sed, sed_stream, atol=1e-5) and torch.allclose(doa, doa_stream, atol=1e-5)
+        #a smaller margin would change the outputs
+        try:
+            StreamingSeldnet(model, chunk_frames=5, margin=margin-1)
+            assert False
+        except ValueError:
+            pass
+        print (type(model).__name__ + ' time pool ' + str(model.time_pool) + ', margin ' + str(margin) +
+               ': streamed SED shape: ', sed_stream.shape, '| DOA shape: ', doa_stream.shape)
+
+
+def test_padding_mask():
+    '''
+    Test that the outputs of a zero-padded, masked batch of different-length inputs
+    match the ones of the inputs processed one by one
+    '''
+    print ('\nTesting padding mask')
+    lengths = [8 * 30, 8 * 17]
+    x = torch.zeros(2, 4, 256, max(lengths))
+    mask = torch.zeros(2, max(lengths), dtype=torch.bool)
+    for i, l in enumerate(lengths):
+        x[i,:,:,:l] = torch.rand(4, 256, l)
+        mask[i,:l] = True
+    model = Seldnet_augmented(max(lengths), input_channels=4, pool_time=True, class_overlaps=3, dropout_perc=0.)
+    model.eval()
+    with torch.no_grad():
+        sed, doa = model(x, mask)
+        for i, l in enumerate(lengths):
+            sed_i, doa_i = model(x[i:i+1,:,:,:l])
+            n = sed_i.shape[1]
+            assert torch.allclose(sed[i:i+1,:n], sed_i, atol=1e-5) and torch.allclose(doa[i:i+1,:n], doa_i, atol=1e-5)
+            assert sed[i,n:].abs().sum() == 0
+            print ('Length ' + str(l) + ': SED shape: ', sed_i.shape, '| DOA shape: ', doa_i.shape, 'equal in the masked batch')
+
+
+def test_fused_inference():
+    '''
+    Test that the model fused for inference gives the outputs of the original one
+    '''
+    print ('\nTesting fused inference model')
+    x = torch.rand(2, 4, 256, 8 * 20)
+    for model in [Seldnet_vanilla(8 * 20, input_channels=4, pool_time=True, class_overlaps=3, dropout_perc=0.3),
+                  Seldnet_augmented(8 * 20, input_channels=4, pool_time=True, class_overlaps=3, dropout_perc=0.3)]:
+        #non-trivial batchnorm statistics
+        for m in model.modules():
+            if isinstance(m, nn.BatchNorm2d):
+                m.running_mean.uniform_(-0.5, 0.5)
+                m.running_var.uniform_(0.5, 2.)
+                nn.init.uniform_(m.weight, 0.5, 1.5)
+                nn.init.uniform_(m.bias, -0.5, 0.5)
+        model.eval()
+        fused = fuse_for_inference(model)
+        with torch.no_grad():
+            sed, doa = model(x)
+            sed_fused, doa_fused = fused(x)
+        assert torch.allclose(sed, sed_fused, atol=1e-5) and torch.allclose(doa, doa_fused, atol=1e-5)
+        print (type(model).__name__ + ' fused: max abs difference ',
+               max((sed - sed_fused).abs().max().item(), (doa - doa_fused).abs().max().item()))
+
+
+def test_activation_checkpointing():
+    '''
+    Test that the checkpointed cnn blocks give the gradients and batchnorm statistics
+    of the standard training step, also under cpu bf16 autocast (the recomputation
+    must run in bf16 too)
+    '''
+    print ('\nTesting activation checkpointing')
+    x = torch.rand(2, 4, 256, 8 * 10)
+    for model in [Seldnet_vanilla(8 * 10, input_channels=4, pool_time=True, class_overlaps=3),
+                  Seldnet_augmented(8 * 10, input_channels=4, pool_time=True, class_overlaps=3)]:
+        model.train()
+        for amp in [False, True]:
+            results = []
+            for checkpointing in [False, True]:
+                m = copy.deepcopy(model)
+                m.checkpointing = checkpointing
+                #dtypes of the first conv outputs, in the forward pass and in the recomputation
+                dtypes = []
+                conv = [l for l in m.modules() if isinstance(l, nn.Conv2d)][0]
+                conv.register_forward_hook(lambda l, i, o: dtypes.append(o.dtype))
+                torch.manual_seed(0)
+                with torch.autocast('cpu', dtype=torch.bfloat16, enabled=amp):
+                    sed, doa = m(x)
+                    loss = sed.float().sum() + doa.float().sum()
+                loss.backward()
+                assert len(dtypes) == (2 if checkpointing else 1)
+                assert all([d == (torch.bfloat16 if amp else torch.float32) for d in dtypes])
+                results.append((dict(m.named_parameters()), m.state_dict()))
+            (params, state), (params_ckpt, state_ckpt) = results
+            for name in params:
+                assert torch.allclose(params[name].grad, params_ckpt[name].grad, atol=1e-5), name
+            for name in state:
+                assert torch.equal(state[name], state_ckpt[name]), name
+            print (type(model).__name__ + (' bf16 autocast' if amp else '') +
+                   ': equal gradients and batchnorm statistics with checkpointing')
+
+
 if __name__ == '__main__':
     test_model()
+    test_streaming()
+    test_padding_mask()
+    test_fused_inference()
+    test_activation_checkpointing()
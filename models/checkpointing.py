@@ -0,0 +1,56 @@
+import inspect
+import torch
+import torch.utils.checkpoint
+
+'''
+Activation checkpointing and compilation helpers shared by the models
+and the train scripts (re-exported by utility_functions)
+'''
+
+
+def unwrap_model(model):
+    #torch.compile keeps the original module in _orig_mod, TracedModel too (inside DDP)
+    model = getattr(model, '_orig_mod', model)
+    if isinstance(model, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)):
+        model = model.module
+    return getattr(model, '_orig_mod', model)
+
+
+def is_compiling():
+    '''
+    True while torch.compile or torch.jit are capturing the graph of a model,
+    when python side effects like prints would break it
+    '''
+    if torch.jit.is_scripting() or torch.jit.is_tracing():
+        return True
+    if hasattr(torch, 'compiler') and hasattr(torch.compiler, 'is_compiling'):
+        return torch.compiler.is_compiling()
+    return False
+
+
+def checkpoint(function, *args):
+    '''
+    function(*args) with activation checkpointing: its intermediate activations are not
+    stored but recomputed in the backward pass (recomputation runs with grad enabled).
+    The reentrant checkpoint (the only one of torch < 1.11) is used, with a dummy input
+    requiring grad, so that it also works when no input does (e.g. the first model layer).
+    The reentrant checkpoint restores only the cuda autocast state in the recomputation,
+    so the cpu autocast state of the forward pass (--amp bf16) is re-entered explicitly
+    '''
+    kwargs = {}
+    if 'use_reentrant' in inspect.signature(torch.utils.checkpoint.checkpoint).parameters:
+        kwargs['use_reentrant'] = True
+    cpu_autocast = torch.is_autocast_cpu_enabled()
+    cpu_autocast_dtype = torch.get_autocast_cpu_dtype()
+    def run(dummy, *args):
+        with torch.autocast('cpu', dtype=cpu_autocast_dtype, enabled=cpu_autocast):
+            return function(*args)
+    dummy = torch.ones(1, requires_grad=True)
+    return torch.utils.checkpoint.checkpoint(run, dummy, *args, **kwargs)
+
+
+def set_activation_checkpointing(model, enabled):
+    #enable checkpointing in the modules that support it (FaSNet DPRNN layers, SELDNet conv blocks)
+    for m in unwrap_model(model).modules():
+        if hasattr(m, 'checkpointing'):
+            m.checkpointing = enabled
@@ -20,20 +20,7 @@ Separate training, validation and test matrices are saved.
 Command line inputs define which task to process and its parameters.
 '''
 
-sound_classes_dict_task2 = {'Chink_and_clink':0,
-                           'Computer_keyboard':1,
-                           'Cupboard_open_or_close':2,
-                           'Drawer_open_or_close':3,
-                           'Female_speech_and_woman_speaking':4,
-                           'Finger_snapping':5,
-                           'Keys_jangling':6,
-                           'Knock':7,
-                           'Laughter':8,
-                           'Male_speech_and_man_speaking':9,
-                           'Printer':10,
-                           'Scissors':11,
-                           'Telephone':12,
-                           'Writing':13}
+sound_classes_dict_task2 = uf.sound_classes_dict_task2
 
 def preprocessing_task1(args):
     '''
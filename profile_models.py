@@ -0,0 +1,154 @@
+import sys, os
+import json
+import argparse
+import numpy as np
+import torch
+from model_builder import add_model_args, parse_model_args, build_model
+from models.FaSNet import set_low_copy_layout
+from quantize_model import latency_ms
+from utility_functions import count_macs, activation_memory_mb, set_activation_checkpointing
+
+'''
+Cost profile of a baseline model, for any architecture and model parameters
+of the train scripts (see model_builder.py), on a random input of --duration seconds:
+- parameters
+- MACs and MFLOPs (2 * MACs) per second of audio, counted on the convolution,
+  linear and recurrent layers. The functional convolutions of FaSNet (filter
+  cosine similarity and filter-and-sum) are not counted
+- training memory: activations saved for the backward pass and peak of the
+  tensors allocated by a training step (forward, loss and backward)
+- inference memory: peak of the tensors allocated by a forward pass
+- cpu latency of a forward pass for each thread count of --threads
+Parameters and inputs are not included in the memory figures.
+The report is printed and saved as json to --output_path, e.g.:
+python profile_models.py --task 2 --architecture seldnet_augmented --cnn_filters [32,64,128,256] --threads 1,2,4
+'''
+
+
+def peak_memory_mb(fn):
+    '''
+    Peak MB of the tensors allocated while running fn() on cpu, from the memory
+    usage of the top-level operators recorded by the profiler, in execution order
+    '''
+    with torch.autograd.profiler.profile(profile_memory=True) as prof:
+        fn()
+    events = sorted([e for e in prof.function_events if e.cpu_parent is None],
+                    key=lambda e: e.time_range.start)
+    usage = np.cumsum([0] + [e.cpu_memory_usage for e in events])
+    return usage.max() / 2.**20
+
+
+def example_input(args):
+    #random input of args.duration seconds, batch of args.batch_size
+    if args.task == 1:
+        return torch.rand(args.batch_size, args.input_channels, int(args.sr * args.duration))
+    #80 stft frames per second, a multiple of the time pooling of the model
+    frames = int(round(80 * args.duration)) // args.time_pool * args.time_pool
+    return torch.rand(args.batch_size, args.input_channels, args.freq_dim, frames)
+
+
+def profile_model(args):
+    if args.task == 2:
+        args.time_pool = int(np.prod([p[1] for p in args.pool_size])) if args.pool_time else 1
+    x = example_input(args)
+    duration = args.duration * args.batch_size
+    if args.task == 1:
+        model = build_model(args)
+        inputs = (x, torch.tensor([0.]))
+    else:
+        model = build_model(args, time_dim=x.shape[-1])
+        inputs = (x,)
+
+    def loss_fn():
+        outputs = model(*inputs)
+        if not isinstance(outputs, tuple):
+            outputs = (outputs,)
+        return sum([o.float().pow(2).mean() for o in outputs])
+
+    def train_step():
+        model.zero_grad()
+        loss_fn().backward()
+
+    def forward():
+        with torch.no_grad():
+            model(*inputs)
+
+    report = {'architecture': args.architecture,
+              'input_shape': list(x.shape),
+              'audio_seconds': duration,
+              'params': sum([p.numel() for p in model.parameters()]),
+              'trainable_params': sum([p.numel() for p in model.parameters() if p.requires_grad])}
+    #macs of the standard layers, before the low-copy layout replaces some of them with functional calls
+    model.eval()
+    macs = count_macs(model, inputs)
+    report['macs_per_second'] = macs / duration
+    report['mflops_per_second'] = 2 * macs / duration / 1e6
+
+    set_activation_checkpointing(model, args.activation_checkpointing)
+    set_low_copy_layout(model, args.low_copy_layout)
+    torch.set_num_threads(max(args.threads))
+    model.train()
+    losses = []
+    report['train_saved_activations_mb'] = activation_memory_mb(lambda: losses.append(loss_fn()),
+                                                                list(model.parameters()) + list(inputs))
+    losses.pop().backward()
+    report['train_peak_memory_mb'] = peak_memory_mb(train_step)
+    model.eval()
+    report['inference_peak_memory_mb'] = peak_memory_mb(forward)
+
+    report['latency_ms'] = {}
+    for n in args.threads:
+        torch.set_num_threads(n)
+        report['latency_ms'][n] = latency_ms(model, inputs, args.n_iters, args.n_warmup)
+    return report
+
+
+def main(args):
+    report = profile_model(args)
+    report['args'] = {k: v for k, v in vars(args).items() if isinstance(v, (int, float, str, bool, list, type(None)))}
+
+    print ('\n*******************************')
+    print ('PROFILE ' + args.architecture + ' (input ' + str(report['input_shape']) + ')')
+    print ('Parameters: {}'.format(report['params']))
+    print ('MFLOPs per second of audio: {:.1f}'.format(report['mflops_per_second']))
+    print ('Training: saved activations {:.1f} MB | peak {:.1f} MB'.format(
+           report['train_saved_activations_mb'], report['train_peak_memory_mb']))
+    print ('Inference: peak {:.1f} MB'.format(report['inference_peak_memory_mb']))
+    for n, latency in report['latency_ms'].items():
+        print ('CPU latency, {} threads: {:.1f} ms | real time factor {:.4f}'.format(
+               n, latency, latency / 1000. / report['audio_seconds']))
+
+    output_dir = os.path.dirname(args.output_path)
+    if len(output_dir) > 0 and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(args.output_path, 'w') as f:
+        json.dump(report, f, indent=4)
+    print ('Report saved to ' + args.output_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    parser.add_argument('--output_path', type=str, default=None,
+                        help='json report, default is RESULTS/Task<task>/profile_<architecture>.json')
+    parser.add_argument('--duration', type=float, default=None,
+                        help='seconds of audio of the input, default is segment_length / sr (task 1) or time_dim / 80 (task 2)')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--activation_checkpointing', type=str, default='False')
+    parser.add_argument('--low_copy_layout', type=str, default='False')
+    #benchmark parameters
+    parser.add_argument('--threads', type=str, default='1,2,4',
+                        help='torch thread counts of the latency measurements')
+    parser.add_argument('--n_iters', type=int, default=10)
+    parser.add_argument('--n_warmup', type=int, default=2)
+
+    args = parse_model_args(parser.parse_args())
+    args.activation_checkpointing = eval(args.activation_checkpointing)
+    args.low_copy_layout = eval(args.low_copy_layout)
+    args.threads = [int(n) for n in args.threads.split(',')]
+    if args.duration is None:
+        args.duration = args.segment_length / args.sr if args.task == 1 else args.time_dim / 80.
+    if args.output_path is None:
+        args.output_path = os.path.join('RESULTS', 'Task' + str(args.task), 'profile_' + args.architecture + '.json')
+
+    main(args)
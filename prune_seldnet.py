@@ -0,0 +1,244 @@
+import sys, os
+import copy
+import argparse
+from tqdm import tqdm
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.optim import Adam
+import torch.utils.data as utils
+from data_pipeline import load_pickle_split
+from model_builder import add_model_args, parse_model_args, build_model
+from quantize_model import task2_f_score, latency_ms
+from utility_functions import load_model, save_model, seld_loss, count_macs, cpu_snapshot
+
+'''
+Structured pruning of a trained Seldnet_augmented (Task 2).
+For each sparsity level of --sparsities, that fraction of the channels of every
+conv block and of the units of the hidden fc layers of the sed/doa heads is removed:
+the layers are rebuilt smaller (a Seldnet_augmented with reduced cnn_filters and
+fc_size), so that the pruned model is faster on cpu without sparse kernels.
+Conv channels are ranked by the L1 norm of their filter times the |gamma| of their
+BatchNorm, fc units by the L2 norms of their incoming and outgoing weights.
+The gru is not pruned.
+Each pruned model is fine-tuned with seld_loss on the training set, keeping the
+weights of the best validation loss, saved to checkpoint_dir/checkpoint_pruned_<sparsity>
+and evaluated on the test set: F score, MFLOPs per second of audio and cpu latency
+of every level are printed and saved to results_path/pruning_dict.json.
+The pruned checkpoints are evaluated (or further trained) passing the printed
+--cnn_filters and --fc_size to evaluate_baseline_task2.py (train_baseline_task2.py).
+'''
+
+
+def keep_indices(scores, n_keep):
+    #indices of the n_keep highest scores, in the original order
+    return torch.sort(torch.argsort(scores, descending=True)[:n_keep])[0]
+
+
+def conv_importance(block):
+    conv, bn = block[0], block[1]
+    return conv.weight.abs().sum((1, 2, 3)) * bn.weight.abs()
+
+
+def pruned_sizes(args, sparsity):
+    cnn_filters = [max(1, int(round(c * (1. - sparsity)))) for c in args.cnn_filters]
+    fc_size = max(1, int(round(args.fc_size * (1. - sparsity))))
+    return cnn_filters, fc_size
+
+
+def prune_seldnet(model, args, sparsity):
+    '''
+    Copy of a Seldnet_augmented with sparsity of its conv channels and hidden fc units removed.
+    Returns the pruned model and its arguments
+    '''
+    pruned_args = copy.copy(args)
+    pruned_args.cnn_filters, pruned_args.fc_size = pruned_sizes(args, sparsity)
+    pruned = build_model(pruned_args)
+    with torch.no_grad():
+        #cnn: output channels of each block, input channels of the next one
+        keep = None
+        for block, new_block, n_keep in zip(model.cnn, pruned.cnn, pruned_args.cnn_filters):
+            in_keep = keep
+            keep = keep_indices(conv_importance(block), n_keep)
+            weight = block[0].weight[keep]
+            if in_keep is not None:
+                weight = weight[:, in_keep]
+            new_block[0].weight.copy_(weight)
+            new_block[0].bias.copy_(block[0].bias[keep])
+            for name in ['weight', 'bias', 'running_mean', 'running_var']:
+                getattr(new_block[1], name).copy_(getattr(block[1], name)[keep])
+            new_block[1].num_batches_tracked.copy_(block[1].num_batches_tracked)
+
+        #rnn: the input features are ordered as [channel, frequency]
+        n_freq = model.rnn.input_size // args.cnn_filters[-1]
+        features = (keep[:, None] * n_freq + torch.arange(n_freq)[None]).reshape(-1)
+        for name, param in model.rnn.named_parameters():
+            if name.startswith('weight_ih_l0'):
+                param = param[:, features]
+            getattr(pruned.rnn, name).copy_(param)
+
+        #heads: output units of each hidden layer, inputs of the next layer
+        for head, new_head in [(model.sed, pruned.sed), (model.doa, pruned.doa)]:
+            linears = [m for m in head if isinstance(m, nn.Linear)]
+            new_linears = [m for m in new_head if isinstance(m, nn.Linear)]
+            keep = None
+            for i, (linear, new_linear) in enumerate(zip(linears, new_linears)):
+                weight, bias = linear.weight, linear.bias
+                if keep is not None:
+                    weight = weight[:, keep]
+                keep = None
+                if i < len(linears) - 1:
+                    scores = linear.weight.norm(dim=1) * linears[i+1].weight.norm(dim=0)
+                    keep = keep_indices(scores, pruned_args.fc_size)
+                    weight, bias = weight[keep], bias[keep]
+                new_linear.weight.copy_(weight)
+                new_linear.bias.copy_(bias)
+    return pruned, pruned_args
+
+
+def evaluate_loss(model, dataloader, loss_fn, device):
+    model.eval()
+    val_loss = 0.
+    with torch.no_grad():
+        for example_num, (x, target) in enumerate(dataloader):
+            loss = loss_fn(x.to(device), target.to(device))
+            val_loss += (1. / float(example_num + 1)) * (loss.item() - val_loss)
+    return val_loss
+
+
+def finetune(model, tr_data, val_data, args, device):
+    '''
+    Train model with seld_loss for args.finetune_epochs epochs, keeping the weights
+    of the best validation loss (the pruned weights included).
+    Returns the optimizer and the best validation loss
+    '''
+    criterion_sed = nn.BCELoss()
+    criterion_doa = nn.MSELoss()
+    optimizer = Adam(params=model.parameters(), lr=args.lr)
+
+    def loss_fn(x, target):
+        sed, doa = model(x)
+        return seld_loss(sed, doa, target, criterion_sed, criterion_doa,
+                         args.output_classes*args.class_overlaps,
+                         args.sed_loss_weight, args.doa_loss_weight)
+
+    best_loss = evaluate_loss(model, val_data, loss_fn, device)
+    best_state = cpu_snapshot(model.state_dict())
+    print ('Validation loss before fine-tuning: ' + str(best_loss))
+    for epoch in range(args.finetune_epochs):
+        model.train()
+        with tqdm(total=len(tr_data)) as pbar:
+            for x, target in tr_data:
+                loss = loss_fn(x.to(device), target.to(device))
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                pbar.set_description("Current loss: {:.4f}".format(loss.item()))
+                pbar.update(1)
+        val_loss = evaluate_loss(model, val_data, loss_fn, device)
+        print ('Fine-tuning epoch {}: validation loss {}'.format(epoch + 1, val_loss))
+        if val_loss < best_loss:
+            best_loss = val_loss
+            best_state = cpu_snapshot(model.state_dict())
+    model.load_state_dict(best_state)
+    return optimizer, best_loss
+
+
+def main(args):
+    if args.architecture != 'seldnet_augmented':
+        raise ValueError('Pruning is only implemented for seldnet_augmented')
+    device = 'cuda:' + str(args.gpu_id) if args.use_cuda else 'cpu'
+
+    print ('\nLoading dataset')
+    tr_dataset = load_pickle_split(args.training_predictors_path, args.training_target_path)
+    val_dataset = load_pickle_split(args.validation_predictors_path, args.validation_target_path)
+    test_dataset = load_pickle_split(args.predictors_path, args.target_path)
+    if args.n_examples is not None:
+        test_dataset = utils.Subset(test_dataset, range(min(args.n_examples, len(test_dataset))))
+    tr_data = utils.DataLoader(tr_dataset, args.batch_size, shuffle=True, pin_memory=True)
+    val_data = utils.DataLoader(val_dataset, args.batch_size, shuffle=False, pin_memory=True)
+    test_predictors = torch.stack([test_dataset[i][0] for i in range(len(test_dataset))])
+    test_target = torch.stack([test_dataset[i][1] for i in range(len(test_dataset))])
+
+    model = build_model(args)
+    load_model(model, None, args.model_path, False)
+    model.eval()
+
+    #latency and flops on the same input for all the levels
+    x = test_predictors[:1]
+    duration = x.shape[-1] / 80.  #80 stft frames per second
+
+    results = {}
+    for sparsity in [0.] + args.sparsities:
+        print ('\n*******************************')
+        print ('SPARSITY ' + str(sparsity))
+        if sparsity == 0:
+            pruned, pruned_args = model, args
+        else:
+            pruned, pruned_args = prune_seldnet(model, args, sparsity)
+            pruned = pruned.to(device)
+            optimizer, val_loss = finetune(pruned, tr_data, val_data, pruned_args, device)
+            pruned = pruned.cpu().eval()
+            checkpoint_path = os.path.join(args.checkpoint_dir, 'checkpoint_pruned_' + str(sparsity))
+            state = {'step': 0, 'worse_epochs': 0, 'epochs': 0, 'best_loss': val_loss,
+                     'pruning': {'sparsity': sparsity, 'cnn_filters': pruned_args.cnn_filters,
+                                 'fc_size': pruned_args.fc_size}}
+            save_model(pruned, optimizer, state, checkpoint_path)
+            print ('Pruned checkpoint saved to ' + checkpoint_path)
+        torch.set_num_threads(args.num_threads)
+        result = {'cnn_filters': pruned_args.cnn_filters,
+                  'fc_size': pruned_args.fc_size,
+                  'params': sum([p.numel() for p in pruned.parameters()]),
+                  'mflops_per_second': 2 * count_macs(pruned, (x,)) / duration / 1e6,
+                  'latency_ms': latency_ms(pruned, (x,), args.n_iters, args.n_warmup)}
+        result.update(task2_f_score(pruned, test_predictors, test_target, args))
+        results[sparsity] = result
+        torch.set_num_threads(args.train_threads)
+
+    print ('\n*******************************')
+    print ('RESULTS (cpu latency of a {:.0f} seconds input, {} threads)'.format(duration, args.num_threads))
+    for sparsity, r in results.items():
+        print ('sparsity {:.2f}: F score {:.4f} | {:.1f} MFLOPs/s of audio | {:.1f} ms | {} params | '
+               '--cnn_filters "{}" --fc_size {}'.format(sparsity, r['F score'], r['mflops_per_second'],
+               r['latency_ms'], r['params'], r['cnn_filters'], r['fc_size']))
+
+    if not os.path.exists(args.results_path):
+        os.makedirs(args.results_path)
+    np.save(os.path.join(args.results_path, 'pruning_dict.json'), results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    #i/o parameters
+    parser.add_argument('--checkpoint_dir', type=str, default='RESULTS/Task2')
+    parser.add_argument('--results_path', type=str, default='RESULTS/Task2/pruning')
+    parser.add_argument('--training_predictors_path', type=str, default='DATASETS/processed/task2_predictors_train.pkl')
+    parser.add_argument('--training_target_path', type=str, default='DATASETS/processed/task2_target_train.pkl')
+    parser.add_argument('--validation_predictors_path', type=str, default='DATASETS/processed/task2_predictors_validation.pkl')
+    parser.add_argument('--validation_target_path', type=str, default='DATASETS/processed/task2_target_validation.pkl')
+    parser.add_argument('--n_examples', type=int, default=None,
+                        help='evaluate only the first n test examples')
+    #pruning parameters
+    parser.add_argument('--sparsities', type=str, default='0.25,0.5,0.75',
+                        help='fractions of conv channels and fc units removed')
+    parser.add_argument('--finetune_epochs', type=int, default=5)
+    parser.add_argument('--lr', type=float, default=0.0001)
+    parser.add_argument('--batch_size', type=int, default=3)
+    parser.add_argument('--sed_loss_weight', type=float, default=1.)
+    parser.add_argument('--doa_loss_weight', type=float, default=5.)
+    parser.add_argument('--use_cuda', type=str, default='True')
+    parser.add_argument('--gpu_id', type=int, default=0)
+    #benchmark parameters
+    parser.add_argument('--num_threads', type=int, default=1,
+                        help='torch threads of the latency measurements')
+    parser.add_argument('--train_threads', type=int, default=torch.get_num_threads(),
+                        help='torch threads of the fine-tuning')
+    parser.add_argument('--n_iters', type=int, default=10)
+    parser.add_argument('--n_warmup', type=int, default=2)
+
+    args = parse_model_args(parser.parse_args())
+    args.use_cuda = eval(args.use_cuda)
+    args.sparsities = [float(s) for s in args.sparsities.split(',')]
+
+    main(args)
@@ -0,0 +1,157 @@
+import sys, os
+import io
+import time
+import pickle
+import argparse
+from tqdm import tqdm
+import numpy as np
+import torch
+from pystoi import stoi
+from metrics import location_sensitive_detection
+from evaluate_baseline_task1 import enhance_sound
+from evaluate_baseline_task2 import f_score
+from model_builder import add_model_args, parse_model_args, build_model
+from utility_functions import load_model, quantize_dynamic_int8, gen_submission_list_task2
+
+'''
+Dynamic int8 quantization of a trained baseline model for cpu inference.
+The GRU/LSTM and Linear layers are quantized: the rnn and the sed/doa heads
+of the SELDNets, the SingleRNN/DPRNN blocks of FaSNet.
+The quantized checkpoint is saved to --output_path, and the model size,
+cpu latency and challenge metric (Task 1 STOI, Task 2 F score) of the fp32
+and int8 models are compared on the test set.
+evaluate_baseline_task1.py and evaluate_baseline_task2.py load the quantized
+checkpoint directly through --model_path (with --use_cuda False).
+'''
+
+
+def serialized_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2.**20
+
+
+def latency_ms(model, inputs, n_iters, n_warmup):
+    #median cpu latency of a forward pass
+    times = []
+    with torch.no_grad():
+        for i in range(n_warmup + n_iters):
+            t = time.time()
+            model(*inputs)
+            if i >= n_warmup:
+                times.append(time.time() - t)
+    return 1000 * np.median(times)
+
+
+def task1_stoi(model, predictors, target, args):
+    #mean STOI of the enhanced test sounds, computed as in task1_metric
+    scores = []
+    with torch.no_grad():
+        for x, y in tqdm(zip(predictors, target), total=len(predictors)):
+            outputs = enhance_sound(x.unsqueeze(0), model, 'cpu', args.segment_length, args.segment_overlap)
+            outputs = np.squeeze(outputs)
+            y = np.squeeze(y.numpy())
+            scores.append(stoi(y, outputs, args.sr, extended=False))
+    return {'STOI': np.mean(scores)}
+
+
+def task2_f_score(model, predictors, target, args):
+    TP = FP = FN = 0
+    with torch.no_grad():
+        for x, y in tqdm(zip(predictors, target), total=len(predictors)):
+            sed, doa = model(x.unsqueeze(0))
+            sed = sed.cpu().numpy().squeeze()
+            doa = doa.cpu().numpy().squeeze()
+            sed_target = y[:,:args.output_classes*args.class_overlaps].numpy()
+            doa_target = y[:,args.output_classes*args.class_overlaps:].numpy()
+            y = gen_submission_list_task2(sed_target, doa_target,
+                                          max_overlaps=args.class_overlaps,
+                                          max_loc_value=args.max_loc_value)
+            prediction = gen_submission_list_task2(sed, doa,
+                                                   max_overlaps=args.class_overlaps,
+                                                   max_loc_value=args.max_loc_value)
+            tp, fp, fn, _ = location_sensitive_detection(prediction, y, args.num_frames,
+                                                         args.spatial_threshold, False)
+            TP += tp
+            FP += fp
+            FN += fn
+    precision, recall, F_score = f_score(TP, FP, FN)
+    return {'F score': F_score, 'precision': precision, 'recall': recall}
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+
+    print ('\nLoading dataset')
+    with open(args.predictors_path, 'rb') as f:
+        predictors = pickle.load(f)
+    with open(args.target_path, 'rb') as f:
+        target = pickle.load(f)
+    predictors = torch.tensor(np.array(predictors)).float()
+    target = torch.tensor(np.array(target)).float()
+    if args.n_examples is not None:
+        predictors = predictors[:args.n_examples]
+        target = target[:args.n_examples]
+    print ('Predictors: ', predictors.shape)
+
+    #LOAD AND QUANTIZE MODEL
+    model = build_model(args, time_dim=predictors.shape[-1])
+    state = load_model(model, None, args.model_path, False)
+    model.eval()
+    quantized = quantize_dynamic_int8(model)
+
+    output_dir = os.path.dirname(args.output_path)
+    if len(output_dir) > 0 and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    torch.save({'model_state_dict': quantized.state_dict(),
+                'quantization': 'dynamic_int8',
+                'state': state}, args.output_path)
+    print ('Quantized checkpoint saved to ' + args.output_path)
+
+    #COMPARE FP32 AND INT8
+    if args.task == 1:
+        example_inputs = (torch.zeros(1, predictors.shape[1], args.segment_length), torch.tensor([0.]))
+        metric_fn = task1_stoi
+    else:
+        example_inputs = (predictors[:1],)
+        metric_fn = task2_f_score
+
+    results = {}
+    for name, m in [('fp32', model), ('int8', quantized)]:
+        print ('\nEvaluating ' + name + ' model')
+        results[name] = {'size_mb': serialized_size_mb(m),
+                         'latency_ms': latency_ms(m, example_inputs, args.n_iters, args.n_warmup)}
+        results[name].update(metric_fn(m, predictors, target, args))
+
+    print ('*******************************')
+    print ('RESULTS (cpu, {} threads)'.format(args.num_threads))
+    for key in results['fp32']:
+        fp32, int8 = results['fp32'][key], results['int8'][key]
+        print ('{}: fp32 {:.4f} | int8 {:.4f} | delta {:+.4f}'.format(key, fp32, int8, int8 - fp32))
+    print ('Size reduction: x{:.2f}'.format(results['fp32']['size_mb'] / results['int8']['size_mb']))
+    print ('Latency speedup: x{:.2f}'.format(results['fp32']['latency_ms'] / results['int8']['latency_ms']))
+
+    if args.results_path is not None:
+        if not os.path.exists(args.results_path):
+            os.makedirs(args.results_path)
+        np.save(os.path.join(args.results_path, 'task{}_quantization_dict.json'.format(args.task)), results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    parser.add_argument('--output_path', type=str, default=None,
+                        help='quantized checkpoint, default is model_path + "_int8"')
+    parser.add_argument('--results_path', type=str, default=None)
+    parser.add_argument('--n_examples', type=int, default=None,
+                        help='evaluate only the first n test examples')
+    #benchmark parameters
+    parser.add_argument('--num_threads', type=int, default=1)
+    parser.add_argument('--n_iters', type=int, default=20)
+    parser.add_argument('--n_warmup', type=int, default=3)
+
+    args = parse_model_args(parser.parse_args())
+    if args.output_path is None:
+        args.output_path = args.model_path + '_int8'
+
+    main(args)
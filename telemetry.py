@@ -0,0 +1,183 @@
+import os, sys
+import time
+import json
+import resource
+import contextlib
+import torch
+
+'''
+Per-step telemetry of the training loops.
+Every step writes a JSON line with the time spent in each phase
+(data fetch, host-to-device transfer, forward, backward, optimizer step),
+and every epoch ends with a summary line telling whether the run
+is waiting for data or for compute.
+StepProfiler captures a torch.profiler trace of a few steps of the
+train and evaluate scripts (--profile_steps, --profile_dir).
+'''
+
+PHASES = ['data', 'to_device', 'forward', 'backward', 'optimizer']
+
+
+def peak_rss_mb():
+    #ru_maxrss is in KB on linux, in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss / 1024.
+    return rss / 1024.
+
+
+class TrainingTelemetry():
+    '''
+    Collect phase timings of the training steps and write them to path as JSON lines.
+    With enabled=False (e.g. on non-zero distributed ranks) nothing is written,
+    but the epoch summaries are still computed.
+    If device is a cuda device, phases are synchronized before being timed.
+    '''
+    def __init__(self, path, device='cpu', enabled=True):
+        self.sync = 'cuda' in str(device)
+        self.file = None
+        if enabled:
+            if len(os.path.dirname(path)) > 0 and not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            self.file = open(path, 'a')
+        self.epoch = 0
+        self.reset_step()
+
+    def reset_step(self):
+        self.step_times = {p: 0. for p in PHASES}
+
+    def start_epoch(self, epoch):
+        self.epoch = epoch
+        self.epoch_times = {p: 0. for p in PHASES}
+        self.epoch_steps = 0
+        self.epoch_samples = 0
+        self.epoch_start = time.time()
+        self.reset_step()
+
+    def add(self, phase, seconds):
+        self.step_times[phase] += seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t = time.time()
+        #named range in the profiler traces
+        with torch.profiler.record_function(name):
+            yield
+        if self.sync:
+            torch.cuda.synchronize()
+        self.step_times[name] += time.time() - t
+
+    def write(self, record):
+        if self.file is not None:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+    def end_step(self, step, n_samples):
+        step_time = sum(self.step_times.values())
+        record = {'type': 'step', 'epoch': self.epoch, 'step': step, 'samples': n_samples}
+        record.update({p + '_s': self.step_times[p] for p in PHASES})
+        record['samples_per_s'] = n_samples / step_time if step_time > 0 else 0.
+        self.write(record)
+        for p in PHASES:
+            self.epoch_times[p] += self.step_times[p]
+        self.epoch_steps += 1
+        self.epoch_samples += n_samples
+        self.reset_step()
+
+    def end_epoch(self, **extra):
+        '''
+        Write and print the epoch summary, extra items are added to the record
+        '''
+        wall_time = time.time() - self.epoch_start
+        compute_time = self.epoch_times['forward'] + self.epoch_times['backward'] + self.epoch_times['optimizer']
+        data_time = self.epoch_times['data'] + self.epoch_times['to_device']
+        record = {'type': 'epoch', 'epoch': self.epoch, 'steps': self.epoch_steps,
+                  'samples': self.epoch_samples, 'wall_s': wall_time}
+        record.update({p + '_s': self.epoch_times[p] for p in PHASES})
+        record['samples_per_s'] = self.epoch_samples / wall_time if wall_time > 0 else 0.
+        record['data_frac'] = data_time / wall_time if wall_time > 0 else 0.
+        record['bound'] = 'io' if data_time > compute_time else 'compute'
+        record['peak_rss_mb'] = peak_rss_mb()
+        if torch.cuda.is_available() and self.sync:
+            record['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2.**20
+        record.update(extra)
+        self.write(record)
+
+        print ('Epoch {} telemetry: {:.2f} samples/s, {}-bound ({:.1f}% waiting for data), peak RSS {:.0f} MB'.format(
+               self.epoch, record['samples_per_s'], record['bound'], 100 * record['data_frac'], record['peak_rss_mb']))
+        print ('    ' + ', '.join(['{}: {:.2f}s'.format(p, self.epoch_times[p]) for p in PHASES]))
+        return record
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class StepProfiler():
+    '''
+    torch.profiler capture of profile_steps steps, after 1 skipped step and
+    warmup steps. Shapes and memory are recorded; when the capture is done
+    a Chrome trace and the top-k operators tables are written to profile_dir.
+    With profile_steps=None all methods are no-ops.
+    '''
+    def __init__(self, profile_steps, profile_dir, warmup=1, row_limit=25, device='cpu'):
+        self.profiler = None
+        self.profile_dir = profile_dir
+        self.row_limit = row_limit
+        if not profile_steps:
+            return
+        if not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if 'cuda' in str(device):
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.total_steps = 1 + warmup + profile_steps
+        self.count = 0
+        self.profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=1, warmup=warmup, active=profile_steps, repeat=1),
+            on_trace_ready=self.export,
+            record_shapes=True,
+            profile_memory=True)
+
+    def export(self, prof):
+        trace_path = os.path.join(self.profile_dir, 'trace.json')
+        prof.export_chrome_trace(trace_path)
+        averages = prof.key_averages()
+        tables = ['TOP OPERATORS BY SELF CPU TIME',
+                  averages.table(sort_by='self_cpu_time_total', row_limit=self.row_limit),
+                  'TOP OPERATORS BY SELF CPU MEMORY',
+                  averages.table(sort_by='self_cpu_memory_usage', row_limit=self.row_limit),
+                  'TOP OPERATORS BY INPUT SHAPE',
+                  prof.key_averages(group_by_input_shape=True).table(sort_by='self_cpu_time_total',
+                                                                     row_limit=self.row_limit)]
+        with open(os.path.join(self.profile_dir, 'top_ops.txt'), 'w') as f:
+            f.write('\n\n'.join(tables))
+        print (tables[1])
+        print ('Profiler trace saved to ' + trace_path + ' (open it in chrome://tracing)')
+
+    def start(self):
+        if self.profiler is not None:
+            self.profiler.start()
+
+    def step(self):
+        if self.profiler is None:
+            return
+        self.profiler.step()
+        self.count += 1
+        if self.count == self.total_steps:
+            self.stop()
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+
+def add_profiler_args(parser):
+    parser.add_argument('--profile_steps', type=int, default=None,
+                        help='capture a torch.profiler trace of this many steps')
+    parser.add_argument('--profile_warmup', type=int, default=1,
+                        help='profiler warmup steps, after 1 skipped step')
+    parser.add_argument('--profile_dir', type=str, default=None,
+                        help='folder of the profiler outputs, default is results_path/profile')
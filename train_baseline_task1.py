@@ -3,14 +3,25 @@ import time
 import json
 import pickle
 import argparse
+import functools
 from tqdm import tqdm
 import numpy as np
 import torch
 import torch.nn as nn
 from torch.optim import Adam
 import torch.utils.data as utils
-from models.FaSNet import FaSNet_origin, FaSNet_TAC
-from utility_functions import load_model, save_model
+from models.FaSNet import FaSNet_origin, FaSNet_TAC, set_low_copy_layout
+from utility_functions import load_model, save_model, autocast
+from utility_functions import init_distributed, is_main_process, reduce_mean
+from utility_functions import unwrap_model, no_sync, memory_budget_batch, AsyncCheckpointWriter
+from utility_functions import get_rng_state, set_rng_state, broadcast_object, compile_model, set_activation_checkpointing
+from data_pipeline import load_dataset, build_dataloader, TimedLoader, add_dataset_args, eval_dataset_args
+from data_pipeline import set_loader_epoch, set_loader_start, loader_seed, set_loader_seed, validation_subset
+from background_validation import BackgroundValidator
+from telemetry import TrainingTelemetry, StepProfiler, add_profiler_args
+from distillation import cache_teacher_outputs, teacher_outputs_task1, TeacherTargetDataset
+from distillation import split_teacher_target, add_distillation_args
+from model_builder import build_model
 
 '''
 Train our baseline model for the Task1 of the L3DAS21 challenge.
@@ -25,19 +36,34 @@ def evaluate(model, device, criterion, dataloader):
     #compute loss without backprop
     model.eval()
     test_loss = 0.
-    with tqdm(total=len(dataloader) // args.batch_size) as pbar, torch.no_grad():
+    with tqdm(total=len(dataloader) // args.batch_size, disable=not is_main_process()) as pbar, torch.no_grad():
         for example_num, (x, target) in enumerate(dataloader):
             target = target.to(device)
             x = x.to(device)
-            outputs = model(x, torch.tensor([0.]))
-            loss = criterion(outputs, target)
+            with autocast(args.amp, device):
+                outputs = model(x, torch.tensor([0.]))
+            loss = criterion(outputs.float(), target)
             test_loss += (1. / float(example_num + 1)) * (loss - test_loss)
             pbar.set_description("Current loss: {:.4f}".format(test_loss))
             pbar.update(1)
-    return test_loss
+    #average across processes in distributed mode
+    return reduce_mean(test_loss)
+
+
+def batch_loss(model, x, target, criterion, amp):
+    #loss of a cpu batch, computed by the background validation process
+    with autocast(amp, 'cpu'):
+        outputs = model(x, torch.tensor([0.]))
+    return criterion(outputs.float(), target)
 
 
 def main(args):
+    if args.distributed:
+        #one process per cpu socket/node (or gpu), launched by torchrun
+        rank, world_size, local_rank = init_distributed(args.dist_backend)
+        args.gpu_id = local_rank
+        print ('Distributed training on ' + str(world_size) + ' processes')
+
     if args.use_cuda:
         device = 'cuda:' + str(args.gpu_id)
     else:
@@ -55,46 +81,11 @@ def main(args):
     #LOAD DATASET
     print ('\nLoading dataset')
 
-    with open(args.training_predictors_path, 'rb') as f:
-        training_predictors = pickle.load(f)
-    with open(args.training_target_path, 'rb') as f:
-        training_target = pickle.load(f)
-    with open(args.validation_predictors_path, 'rb') as f:
-        validation_predictors = pickle.load(f)
-    with open(args.validation_target_path, 'rb') as f:
-        validation_target = pickle.load(f)
-    with open(args.test_predictors_path, 'rb') as f:
-        test_predictors = pickle.load(f)
-    with open(args.test_target_path, 'rb') as f:
-        test_target = pickle.load(f)
-
-    training_predictors = np.array(training_predictors)
-    training_target = np.array(training_target)
-    validation_predictors = np.array(validation_predictors)
-    validation_target = np.array(validation_target)
-    test_predictors = np.array(test_predictors)
-    test_target = np.array(test_target)
-
-    print ('\nShapes:')
-    print ('Training predictors: ', training_predictors.shape)
-    print ('Validation predictors: ', validation_predictors.shape)
-    print ('Test predictors: ', test_predictors.shape)
-
-    #convert to tensor
-    training_predictors = torch.tensor(training_predictors).float()
-    validation_predictors = torch.tensor(validation_predictors).float()
-    test_predictors = torch.tensor(test_predictors).float()
-    training_target = torch.tensor(training_target).float()
-    validation_target = torch.tensor(validation_target).float()
-    test_target = torch.tensor(test_target).float()
-    #build dataset from tensors
-    tr_dataset = utils.TensorDataset(training_predictors, training_target)
-    val_dataset = utils.TensorDataset(validation_predictors, validation_target)
-    test_dataset = utils.TensorDataset(test_predictors, test_target)
-    #build data loader from dataset
-    tr_data = utils.DataLoader(tr_dataset, args.batch_size, shuffle=True, pin_memory=True)
-    val_data = utils.DataLoader(val_dataset, args.batch_size, shuffle=False, pin_memory=True)
-    test_data = utils.DataLoader(test_dataset, args.batch_size, shuffle=False, pin_memory=True)
+    tr_dataset = load_dataset(args, 'train', task=1)
+    val_dataset = load_dataset(args, 'validation', task=1)
+    #build data loaders, the test set is loaded only after training
+    tr_data = TimedLoader(build_dataloader(tr_dataset, args, shuffle=True))
+    val_data = build_dataloader(val_dataset, args, shuffle=False)
 
     #LOAD MODEL
     if args.architecture == 'fasnet':
@@ -113,6 +104,18 @@ def main(args):
     if args.use_cuda:
         print("Moving model to gpu")
     model = model.to(device)
+    set_activation_checkpointing(model, args.activation_checkpointing)
+    set_low_copy_layout(model, args.low_copy_layout)
+    #graph compilation of the training and validation steps:
+    #the torchscript traces run inside ddp, torch.compile outside
+    if args.compile == 'torchscript':
+        if args.activation_checkpointing or args.amp != 'none':
+            raise ValueError('--compile torchscript does not trace activation checkpointing and autocast')
+        model = compile_model(model, args.compile, training=True)
+    if args.distributed:
+        model = nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu_id] if args.use_cuda else None)
+    if args.compile != 'torchscript':
+        model = compile_model(model, args.compile)
 
     #compute number of parameters
     model_params = sum([np.prod(p.size()) for p in model.parameters()])
@@ -126,6 +129,27 @@ def main(args):
     else:
         raise NotImplementedError("Couldn't find this loss!")
 
+    #knowledge distillation: the teacher outputs are cached and appended to the training targets
+    if args.teacher_path is not None:
+        teacher_args = argparse.Namespace(**vars(args))
+        vars(teacher_args).update(args.teacher_args)
+        teacher = build_model(teacher_args).to(device)
+        load_model(teacher, None, args.teacher_path, args.use_cuda)
+        cache_path = args.teacher_cache or os.path.join(args.checkpoint_dir, 'teacher_outputs_train.npy')
+        cache_teacher_outputs(teacher, teacher_outputs_task1, tr_dataset, cache_path,
+                              args.teacher_path, args.batch_size, device)
+        del teacher
+        tr_dataset = TeacherTargetDataset(tr_dataset, cache_path, 0)
+        tr_data = TimedLoader(build_dataloader(tr_dataset, args, shuffle=True))
+
+    def training_loss(outputs, target):
+        #with a teacher, the target holds the ground truth and the teacher outputs
+        if args.teacher_path is None:
+            return criterion(outputs, target)
+        target, teacher_target = split_teacher_target(target, 1)
+        return ((1. - args.distill_weight) * criterion(outputs, target) +
+                args.distill_weight * criterion(outputs, teacher_target))
+
     #set up optimizer
     optimizer = Adam(params=model.parameters(), lr=args.lr)
 
@@ -140,70 +164,222 @@ def main(args):
         print("Continuing training full model from checkpoint " + str(args.load_model))
         state = load_model(model, optimizer, args.load_model, args.use_cuda)
 
+    #resume an interrupted run at the exact next batch
+    resume = None
+    if args.resume is not None:
+        print("Resuming training from checkpoint " + str(args.resume))
+        state = load_model(model, optimizer, args.resume, args.use_cuda)
+        resume = state.pop("resume")
+
+    #pick micro-batch size and accumulation steps from the memory budget
+    if args.max_memory_mb is not None:
+        def loss_fn(model, x, target):
+            with autocast(args.amp, device):
+                outputs = model(x, torch.tensor([0.]))
+            return training_loss(outputs.float(), target)
+        x, target = tr_dataset[0]
+        args.batch_size, args.accumulation_steps = memory_budget_batch(unwrap_model(model), loss_fn,
+                    x.unsqueeze(0).to(device), target.unsqueeze(0).to(device),
+                    args.batch_size, args.max_memory_mb)
+        tr_data = TimedLoader(build_dataloader(tr_dataset, args, shuffle=True))
+        val_data = build_dataloader(val_dataset, args, shuffle=False)
+    world_size = torch.distributed.get_world_size() if args.distributed else 1
+    print ('Micro-batch size: {}, accumulation steps: {}, effective batch size: {}'.format(
+           args.batch_size, args.accumulation_steps, args.batch_size * args.accumulation_steps * world_size))
+
+    #checkpoints are written in background
+    checkpoint_writer = AsyncCheckpointWriter(args.keep_checkpoints, args.async_checkpoint)
+
+    #per-step timings are written next to the results dict
+    telemetry = TrainingTelemetry(os.path.join(args.results_path, 'telemetry.jsonl'),
+                                  device, enabled=is_main_process())
+    #optional torch.profiler capture of the first training steps
+    profiler = StepProfiler(args.profile_steps if is_main_process() else None,
+                            args.profile_dir or os.path.join(args.results_path, 'profile'),
+                            args.profile_warmup, device=device)
+
     #TRAIN MODEL
     print('TRAINING START')
     train_loss_hist = []
     val_loss_hist = []
     epoch = 1
+    resume_path = os.path.join(args.checkpoint_dir, "resume_checkpoint")
+    if resume is not None:
+        if resume["batch_size"] != args.batch_size:
+            raise ValueError("Resuming needs the batch size of the interrupted run: " + str(resume["batch_size"]))
+        train_loss_hist = resume["train_loss_hist"]
+        val_loss_hist = resume["val_loss_hist"]
+        epoch = resume["epoch"]
+        set_loader_seed(tr_data, resume["sampler_seed"])
+
+    def save_resume_checkpoint(epoch, batch, train_loss):
+        #everything needed to restart training after the first batch batches of epoch
+        resume_state = dict(state)
+        resume_state["resume"] = {"epoch": epoch,
+                                  "batch": batch,
+                                  "batch_size": args.batch_size,
+                                  "train_loss": float(train_loss),
+                                  "train_loss_hist": train_loss_hist,
+                                  "val_loss_hist": val_loss_hist,
+                                  "sampler_seed": loader_seed(tr_data),
+                                  "rng": get_rng_state()}
+        checkpoint_writer.save(model, optimizer, resume_state, resume_path)
+
+    checkpoint_path = os.path.join(args.checkpoint_dir, "checkpoint")
+
+    def early_stopping_update(val_loss, checkpoint_fn):
+        #early stopping check of a validation loss,
+        #checkpoint_fn() returns the checkpoint of the validated weights
+        val_loss_hist.append(val_loss)
+        if val_loss >= state["best_loss"]:
+            state["worse_epochs"] += 1
+        else:
+            print("MODEL IMPROVED ON VALIDATION SET!")
+            state["worse_epochs"] = 0
+            state["best_loss"] = val_loss
+            state["best_checkpoint"] = checkpoint_path
+
+            # CHECKPOINT
+            if is_main_process():
+                print("Saving model...")
+                checkpoint = checkpoint_fn()
+                checkpoint["state"] = dict(state)
+                checkpoint_writer.write(checkpoint, checkpoint_path)
+
+    #validation every val_every_steps steps on a subsample of the validation set,
+    #in a background process of rank 0 or synchronously
+    validator = None
+    val_snapshots = {}
+    if args.val_every_steps:
+        val_subset = validation_subset(val_dataset, args.val_subsample)
+        print ('Step validation on ' + str(len(val_subset)) + ' data points')
+        if not args.background_validation:
+            val_subset_data = build_dataloader(val_subset, args, shuffle=False)
+        elif is_main_process():
+            loss_fn = functools.partial(batch_loss, criterion=criterion, amp=args.amp)
+            validator = BackgroundValidator(unwrap_model(model), loss_fn, val_subset,
+                                            args.batch_size, args.val_threads)
+
+    def consume_validation_results(block=False):
+        #early stopping on the losses of the snapshots validated in background,
+        #block waits for the snapshots still being validated
+        for step, val_loss in validator.results(block):
+            print("VALIDATION AT STEP {}: LOSS: {}".format(step, val_loss))
+            snapshot = val_snapshots.pop(step)
+            early_stopping_update(val_loss, lambda: snapshot)
+
+    def step_validation():
+        if not args.background_validation:
+            val_loss = float(evaluate(model, device, criterion, val_subset_data))
+            model.train()
+            print("VALIDATION AT STEP {}: LOSS: {}".format(state["step"], val_loss))
+            early_stopping_update(val_loss, lambda: checkpoint_writer.snapshot(model, optimizer, state))
+            return
+        if is_main_process():
+            consume_validation_results()
+            if validator.submit(state["step"], unwrap_model(model)):
+                val_snapshots[state["step"]] = checkpoint_writer.snapshot(model, optimizer, state)
+            else:
+                print("Validation process busy, skipping validation at step " + str(state["step"]))
+        #all processes follow the early stopping of rank 0
+        state.update(broadcast_object(state))
+
+    profiler.start()
     while state["worse_epochs"] < args.patience:
         print("Training epoch " + str(epoch))
-        avg_time = 0.
+        set_loader_epoch(tr_data, epoch)
+        telemetry.start_epoch(epoch)
         model.train()
         train_loss = 0.
-        with tqdm(total=len(tr_dataset) // args.batch_size) as pbar:
-            for example_num, (x, target) in enumerate(tr_data):
-                target = target.to(device)
-                x = x.to(device)
-                t = time.time()
+        start_batch = 0
+        if resume is not None:
+            #skip the batches processed before the interruption
+            start_batch = resume["batch"]
+            train_loss = torch.tensor(resume["train_loss"], device=device)
+            set_loader_start(tr_data, start_batch)
+            set_rng_state(resume["rng"])
+            resume = None
+        n_batches = start_batch + len(tr_data)
+        optimizer.zero_grad()
+        with tqdm(total=n_batches, initial=start_batch, disable=not is_main_process()) as pbar:
+            for example_num, (x, target) in enumerate(tr_data, start_batch):
+                telemetry.add('data', tr_data.last_wait)
+                with telemetry.phase('to_device'):
+                    target = target.to(device)
+                    x = x.to(device)
                 # Compute loss for each instrument/model
-                optimizer.zero_grad()
-                outputs = model(x, torch.tensor([0.]))
-                loss = criterion(outputs, target)
-                loss.backward()
-
-                train_loss += (1. / float(example_num + 1)) * (loss - train_loss)
-                optimizer.step()
-                state["step"] += 1
-                t = time.time() - t
-                avg_time += (1. / float(example_num + 1)) * (t - avg_time)
+                # gradients are accumulated over accumulation_steps micro-batches
+                update = (example_num + 1) % args.accumulation_steps == 0 or example_num + 1 == n_batches
+                with no_sync(model, update):
+                    with telemetry.phase('forward'):
+                        with autocast(args.amp, device):
+                            outputs = model(x, torch.tensor([0.]))
+                        loss = training_loss(outputs.float(), target)
+                    with telemetry.phase('backward'):
+                        (loss / args.accumulation_steps).backward()
+
+                train_loss += (1. / float(example_num + 1)) * (loss.detach() - train_loss)
+                if update:
+                    with telemetry.phase('optimizer'):
+                        optimizer.step()
+                        optimizer.zero_grad()
+                    state["step"] += 1
+                    if args.val_every_steps and state["step"] % args.val_every_steps == 0:
+                        step_validation()
+                    if args.checkpoint_every_steps and state["step"] % args.checkpoint_every_steps == 0 and is_main_process():
+                        save_resume_checkpoint(epoch, example_num + 1, train_loss)
+                telemetry.end_step(state["step"], x.shape[0])
+                profiler.step()
 
                 pbar.update(1)
+                if state["worse_epochs"] >= args.patience:
+                    break
 
-            #PASS VALIDATION DATA
-            val_loss = evaluate(model, device, criterion, val_data)
-            print("VALIDATION FINISHED: LOSS: " + str(val_loss))
+            telemetry.end_epoch(amp=args.amp, batch_size=args.batch_size,
+                                accumulation_steps=args.accumulation_steps)
 
-            # EARLY STOPPING CHECK
-            checkpoint_path = os.path.join(args.checkpoint_dir, "checkpoint")
+            if not args.val_every_steps:
+                #PASS VALIDATION DATA
+                val_loss = float(evaluate(model, device, criterion, val_data))
+                print("VALIDATION FINISHED: LOSS: " + str(val_loss))
 
-            if val_loss >= state["best_loss"]:
-                state["worse_epochs"] += 1
-            else:
-                print("MODEL IMPROVED ON VALIDATION SET!")
-                state["worse_epochs"] = 0
-                state["best_loss"] = val_loss
-                state["best_checkpoint"] = checkpoint_path
-
-                # CHECKPOINT
-                print("Saving model...")
-                save_model(model, optimizer, state, checkpoint_path)
+                # EARLY STOPPING CHECK
+                early_stopping_update(val_loss, lambda: checkpoint_writer.snapshot(model, optimizer, state))
 
             state["epochs"] += 1
             #state["worse_epochs"] = 200
-            train_loss_hist.append(train_loss.cpu().detach().numpy())
-            val_loss_hist.append(val_loss.cpu().detach().numpy())
+            train_loss_hist.append(reduce_mean(train_loss).cpu().detach().numpy())
+            if args.checkpoint_every_steps and is_main_process():
+                save_resume_checkpoint(epoch + 1, 0, 0.)
             epoch += 1
+    if args.val_every_steps and args.background_validation:
+        #the last submitted snapshot can still improve on the best model
+        if is_main_process():
+            consume_validation_results(block=True)
+            validator.close()
+        state.update(broadcast_object(state))
+    telemetry.close()
+    profiler.stop()
+
     #LOAD BEST MODEL AND COMPUTE LOSS FOR ALL SETS
     print("TESTING")
     # Load best model based on validation loss
+    checkpoint_writer.flush()
+    if args.distributed:
+        torch.distributed.barrier()  #wait for the last checkpoint written by rank 0
     state = load_model(model, None, state["best_checkpoint"], args.use_cuda)
     #compute loss on all set_output_size
-    train_loss = evaluate(model, device, criterion, tr_data)
+    #the full training set evaluation is optional
+    if args.teacher_path is not None:
+        #ground truth targets only
+        tr_data = build_dataloader(tr_dataset.dataset, args, shuffle=False)
+    train_loss = evaluate(model, device, criterion, tr_data) if args.final_train_eval else None
     val_loss = evaluate(model, device, criterion, val_data)
+    test_data = build_dataloader(load_dataset(args, 'test', task=1), args, shuffle=False)
     test_loss = evaluate(model, device, criterion, test_data)
 
     #PRINT AND SAVE RESULTS
-    results = {'train_loss': train_loss.cpu().detach().numpy(),
+    results = {'train_loss': train_loss.cpu().detach().numpy() if train_loss is not None else None,
                'val_loss': val_loss.cpu().detach().numpy(),
                'test_loss': test_loss.cpu().detach().numpy(),
                'train_loss_hist': train_loss_hist,
@@ -213,8 +389,11 @@ def main(args):
     for i in results:
         if 'hist' not in i:
             print (i, results[i])
-    out_path = os.path.join(args.results_path, 'results_dict.json')
-    np.save(out_path, results)
+    if is_main_process():
+        out_path = os.path.join(args.results_path, 'results_dict.json')
+        np.save(out_path, results)
+    if args.distributed:
+        torch.distributed.destroy_process_group()
 
 
 if __name__ == '__main__':
@@ -231,16 +410,49 @@ if __name__ == '__main__':
     parser.add_argument('--validation_target_path', type=str, default='DATASETS/processed/task1_target_validation.pkl')
     parser.add_argument('--test_predictors_path', type=str, default='DATASETS/processed/task1_predictors_test.pkl')
     parser.add_argument('--test_target_path', type=str, default='DATASETS/processed/task1_target_test.pkl')
+    add_dataset_args(parser, task=1)
+    add_profiler_args(parser)
+    add_distillation_args(parser)
     #training parameters
     parser.add_argument('--gpu_id', type=int, default=0)
     parser.add_argument('--use_cuda', type=str, default='True')
     parser.add_argument('--early_stopping', type=str, default='True')
     parser.add_argument('--fixed_seed', type=str, default='False')
+    parser.add_argument('--amp', type=str, default='none',
+                        help='none (fp32) or bf16 (bfloat16 autocast of the forward pass)')
+    parser.add_argument('--compile', type=str, default='none',
+                        help='none, inductor (torch.compile the model, needs torch >= 2.0) or torchscript (torch.jit.trace per input shape, torch >= 1.10)')
+    parser.add_argument('--low_copy_layout', type=str, default='False',
+                        help='keep the DPRNN features in the rnn layout across the layers, with fewer activation copies')
+    parser.add_argument('--activation_checkpointing', type=str, default='False',
+                        help='recompute the DPRNN layers in the backward pass: less memory, slower steps')
     parser.add_argument('--load_model', type=str, default=None,
                         help='Reload a previously trained model (whole task model)')
+    parser.add_argument('--async_checkpoint', type=str, default='True',
+                        help='write checkpoints on a background thread')
+    parser.add_argument('--keep_checkpoints', type=int, default=1,
+                        help='number of checkpoints to keep (older ones are renamed checkpoint.1, checkpoint.2, ...)')
+    parser.add_argument('--checkpoint_every_steps', type=int, default=None,
+                        help='write a resume checkpoint every this many optimizer steps and at the end of every epoch')
+    parser.add_argument('--resume', type=str, default=None,
+                        help='Resume an interrupted training from a resume_checkpoint, at the exact next batch')
+    parser.add_argument('--val_every_steps', type=int, default=None,
+                        help='validate every this many optimizer steps instead of at the end of every epoch (patience is then counted in validations)')
+    parser.add_argument('--val_subsample', type=float, default=1.,
+                        help='fraction of the validation set used by the step validation')
+    parser.add_argument('--background_validation', type=str, default='True',
+                        help='run the step validation in a separate process while training continues')
+    parser.add_argument('--val_threads', type=int, default=1,
+                        help='torch threads of the background validation process')
+    parser.add_argument('--final_train_eval', type=str, default='True',
+                        help='evaluate the best model on the whole training set at the end')
     parser.add_argument('--lr', type=float, default=0.00001)
     parser.add_argument('--batch_size', type=int, default=20,
-                        help="Batch size")
+                        help="Batch size, with --max_memory_mb it is the effective batch size")
+    parser.add_argument('--accumulation_steps', type=int, default=1,
+                        help="Micro-batches of gradient accumulation per optimizer step")
+    parser.add_argument('--max_memory_mb', type=float, default=None,
+                        help="Training memory budget: micro-batch size and accumulation steps are picked automatically")
     parser.add_argument('--sr', type=int, default=16000,
                         help="Sampling rate")
     parser.add_argument('--patience', type=int, default=50,
@@ -265,5 +477,12 @@ if __name__ == '__main__':
     args.use_cuda = eval(args.use_cuda)
     args.early_stopping = eval(args.early_stopping)
     args.fixed_seed = eval(args.fixed_seed)
+    args.async_checkpoint = eval(args.async_checkpoint)
+    args.background_validation = eval(args.background_validation)
+    args.final_train_eval = eval(args.final_train_eval)
+    args.teacher_args = eval(args.teacher_args)
+    args.activation_checkpointing = eval(args.activation_checkpointing)
+    args.low_copy_layout = eval(args.low_copy_layout)
+    eval_dataset_args(args, task=1)
 
     main(args)
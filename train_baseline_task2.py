@@ -3,6 +3,7 @@ import time
 import json
 import pickle
 import argparse
+import functools
 from tqdm import tqdm
 import numpy as np
 import torch
@@ -15,7 +16,17 @@ from dcase2019 import utils as dutils
 
 from dcase2019.dcase_dataset import DcaseDataset
 from models.SELDNet import Seldnet_vanilla, Seldnet_augmented
-from utility_functions import load_model, save_model
+from utility_functions import load_model, save_model, seld_loss, autocast
+from utility_functions import init_distributed, is_main_process, reduce_mean
+from utility_functions import unwrap_model, no_sync, memory_budget_batch, AsyncCheckpointWriter
+from utility_functions import get_rng_state, set_rng_state, broadcast_object, compile_model, set_activation_checkpointing
+from data_pipeline import load_dataset, build_dataloader, TimedLoader, add_dataset_args, eval_dataset_args
+from data_pipeline import set_loader_epoch, set_loader_start, loader_seed, set_loader_seed, validation_subset
+from background_validation import BackgroundValidator
+from telemetry import TrainingTelemetry, StepProfiler, add_profiler_args
+from distillation import cache_teacher_outputs, teacher_outputs_task2, TeacherTargetDataset
+from distillation import split_teacher_target, add_distillation_args
+from model_builder import build_model
 
 '''
 Train our baseline model for the Task2 of the L3DAS21 challenge.
@@ -30,90 +41,42 @@ def evaluate(model, device, criterion_sed, criterion_doa, dataloader):
     #compute loss without backprop
     model.eval()
     test_loss = 0.
-    with tqdm(total=len(dataloader) // args.batch_size) as pbar, torch.no_grad():
+    with tqdm(total=len(dataloader) // args.batch_size, disable=not is_main_process()) as pbar, torch.no_grad():
         for example_num, (x, target) in enumerate(dataloader):
             target = target.to(device)
             x = x.to(device)
             t = time.time()
             # Compute loss for each instrument/model
-            sed, doa = model(x)
-            loss = seld_loss(x, target, model, criterion_sed, criterion_doa)
+            with autocast(args.amp, device):
+                sed, doa = model(x)
+            loss = seld_loss(sed.float(), doa.float(), target, criterion_sed, criterion_doa,
+                             args.output_classes*args.class_overlaps,
+                             args.sed_loss_weight, args.doa_loss_weight)
             test_loss += (1. / float(example_num + 1)) * (loss - test_loss)
             pbar.set_description("Current loss: {:.4f}".format(test_loss))
             pbar.update(1)
-    return test_loss
-
-
-def seld_loss(x, target, model, criterion_sed, criterion_doa):
-    '''
-    compute seld loss as weighted sum of sed (BCE) and doa (MSE) losses
-    '''
-    #divide labels into sed and doa  (which are joint from the preprocessing)
-    target_sed = target[:,:,:args.output_classes*args.class_overlaps]
-    target_doa = target[:,:,args.output_classes*args.class_overlaps:]
-
-    #compute loss
-    sed, doa = model(x)
-    #print ('SDWINGWIEFGNWIJFNWEIJFN', sed.shape, doa.shape, target_sed.shape, target_doa.shape)
-    sed = torch.flatten(sed, start_dim=1)
-    doa = torch.flatten(doa, start_dim=1)
-    target_sed = torch.flatten(target_sed, start_dim=1)
-    target_doa = torch.flatten(target_doa, start_dim=1)
-
-    loss_sed = criterion_sed(sed, target_sed) * args.sed_loss_weight
-    loss_doa = criterion_doa(doa, target_doa) * args.doa_loss_weight
-
-    return loss_sed + loss_doa
-
-
-def load_datasets_using_pickle(args):
-    with open(args.training_predictors_path, 'rb') as f:
-        training_predictors = pickle.load(f)
-    with open(args.training_target_path, 'rb') as f:
-        training_target = pickle.load(f)
-    with open(args.validation_predictors_path, 'rb') as f:
-        validation_predictors = pickle.load(f)
-    with open(args.validation_target_path, 'rb') as f:
-        validation_target = pickle.load(f)
-    with open(args.test_predictors_path, 'rb') as f:
-        test_predictors = pickle.load(f)
-    with open(args.test_target_path, 'rb') as f:
-        test_target = pickle.load(f)
-
-    training_predictors = np.array(training_predictors)
-    training_target = np.array(training_target)
-    validation_predictors = np.array(validation_predictors)
-    validation_target = np.array(validation_target)
-    test_predictors = np.array(test_predictors)
-    test_target = np.array(test_target)
-
-    print ('\nShapes:')
-    print ('Training predictors: ', training_predictors.shape)
-    print ('Validation predictors: ', validation_predictors.shape)
-    print ('Test predictors: ', test_predictors.shape)
-    print ('Training target: ', training_target.shape)
-    print ('Validation target: ', validation_target.shape)
-    print ('Test target: ', test_target.shape)
-
-    features_dim = int(test_target.shape[-2] * test_target.shape[-1])
-
-    #convert to tensor
-    training_predictors = torch.tensor(training_predictors).float()
-    validation_predictors = torch.tensor(validation_predictors).float()
-    test_predictors = torch.tensor(test_predictors).float()
-    training_target = torch.tensor(training_target).float()
-    validation_target = torch.tensor(validation_target).float()
-    test_target = torch.tensor(test_target).float()
-    #build dataset from tensors
-    tr_dataset = utils.TensorDataset(training_predictors, training_target)
-    val_dataset = utils.TensorDataset(validation_predictors, validation_target)
-    test_dataset = utils.TensorDataset(test_predictors, test_target)
-    #build data loader from dataset
-    tr_data = utils.DataLoader(tr_dataset, args.batch_size, shuffle=True, pin_memory=True)
-    val_data = utils.DataLoader(val_dataset, args.batch_size, shuffle=False, pin_memory=True)
-    test_data = utils.DataLoader(test_dataset, args.batch_size, shuffle=False, pin_memory=True)
-    
-    return tr_data, val_data, test_data, len(tr_dataset), test_predictors.shape[-1]
+    #average across processes in distributed mode
+    return reduce_mean(test_loss)
+
+
+def batch_loss(model, x, target, criterion_sed, criterion_doa, amp, sed_output_size,
+               sed_loss_weight, doa_loss_weight):
+    #loss of a cpu batch, computed by the background validation process
+    with autocast(amp, 'cpu'):
+        sed, doa = model(x)
+    return seld_loss(sed.float(), doa.float(), target, criterion_sed, criterion_doa,
+                     sed_output_size, sed_loss_weight, doa_loss_weight)
+
+
+def load_datasets(args):
+    #the test set is loaded only after training, see main()
+    tr_dataset = load_dataset(args, 'train', task=2)
+    val_dataset = load_dataset(args, 'validation', task=2)
+    tr_data = TimedLoader(build_dataloader(tr_dataset, args, shuffle=True))
+    val_data = build_dataloader(val_dataset, args, shuffle=False)
+    n_time_frames = tr_dataset[0][0].shape[-1]
+
+    return tr_data, val_data, len(tr_dataset), n_time_frames
 
 def main(args):
 
@@ -128,6 +91,12 @@ def main(args):
     cfg.conf = argparse.Namespace(**(cfg.conf))
     args = cfg.conf
 
+    if args.distributed:
+        #one process per cpu socket/node (or gpu), launched by torchrun
+        rank, world_size, local_rank = init_distributed(args.dist_backend)
+        args.gpu_id = local_rank
+        print ('Distributed training on ' + str(world_size) + ' processes')
+
     if args.use_cuda:
         device = 'cuda:' + str(args.gpu_id)
     else:
@@ -152,7 +121,7 @@ def main(args):
         len_tr_dataset = training_set.__len__()
         sample_item = training_set.__getitem__(1)
     else:
-        tr_data, val_data, test_data, len_tr_dataset, n_time_frames = load_datasets_using_pickle(args)
+        tr_data, val_data, len_tr_dataset, n_time_frames = load_datasets(args)
 
     #LOAD MODEL
     if args.architecture == 'seldnet_vanilla':
@@ -161,18 +130,29 @@ def main(args):
                     pool_time=args.pool_time, rnn_size=args.rnn_size, n_rnn=args.n_rnn,
                     fc_size=args.fc_size, dropout_perc=args.dropout_perc,
                     n_cnn_filters=args.n_cnn_filters, class_overlaps=args.class_overlaps,
-                    verbose=args.verbose)
+                    bidirectional=args.bidirectional, verbose=args.verbose)
     if args.architecture == 'seldnet_augmented':
         model = Seldnet_augmented(time_dim=n_time_frames, freq_dim=args.freq_dim, input_channels=args.input_channels,
                     output_classes=args.output_classes, pool_size=args.pool_size,
                     pool_time=args.pool_time, rnn_size=args.rnn_size, n_rnn=args.n_rnn,
                     fc_size=args.fc_size, dropout_perc=args.dropout_perc,
                     cnn_filters=args.cnn_filters, class_overlaps=args.class_overlaps,
-                    verbose=args.verbose)
+                    bidirectional=args.bidirectional, verbose=args.verbose)
 
     if args.use_cuda:
         print("Moving model to gpu")
     model = model.to(device)
+    set_activation_checkpointing(model, args.activation_checkpointing)
+    #graph compilation of the training and validation steps:
+    #the torchscript traces run inside ddp, torch.compile outside
+    if args.compile == 'torchscript':
+        if args.activation_checkpointing or args.amp != 'none':
+            raise ValueError('--compile torchscript does not trace activation checkpointing and autocast')
+        model = compile_model(model, args.compile, training=True)
+    if args.distributed:
+        model = nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu_id] if args.use_cuda else None)
+    if args.compile != 'torchscript':
+        model = compile_model(model, args.compile)
 
     #compute number of parameters
     model_params = sum([np.prod(p.size()) for p in model.parameters()])
@@ -182,6 +162,30 @@ def main(args):
     criterion_sed = nn.BCELoss()
     criterion_doa = nn.MSELoss()
 
+    #knowledge distillation: the teacher outputs are cached and appended to the training targets
+    if args.teacher_path is not None:
+        tr_dataset = tr_data.loader.dataset
+        teacher_args = argparse.Namespace(**vars(args))
+        vars(teacher_args).update(args.teacher_args)
+        teacher = build_model(teacher_args, n_time_frames).to(device)
+        load_model(teacher, None, args.teacher_path, args.use_cuda)
+        cache_path = args.teacher_cache or os.path.join(args.checkpoint_dir, 'teacher_outputs_train.npy')
+        cache_teacher_outputs(teacher, teacher_outputs_task2, tr_dataset, cache_path,
+                              args.teacher_path, args.batch_size, device)
+        del teacher
+        tr_data = TimedLoader(build_dataloader(TeacherTargetDataset(tr_dataset, cache_path, -1), args, shuffle=True))
+
+    def training_loss(sed, doa, target):
+        #with a teacher, the target holds the ground truth and the teacher outputs
+        def loss(target):
+            return seld_loss(sed, doa, target, criterion_sed, criterion_doa,
+                             args.output_classes*args.class_overlaps,
+                             args.sed_loss_weight, args.doa_loss_weight)
+        if args.teacher_path is None:
+            return loss(target)
+        target, teacher_target = split_teacher_target(target, -1)
+        return (1. - args.distill_weight) * loss(target) + args.distill_weight * loss(teacher_target)
+
     #set up optimizer
     optimizer = Adam(params=model.parameters(), lr=args.lr)
 
@@ -196,72 +200,227 @@ def main(args):
         print("Continuing training full model from checkpoint " + str(args.load_model))
         state = load_model(model, optimizer, args.load_model, args.use_cuda)
 
+    #resume an interrupted run at the exact next batch
+    resume = None
+    if args.resume is not None:
+        print("Resuming training from checkpoint " + str(args.resume))
+        state = load_model(model, optimizer, args.resume, args.use_cuda)
+        resume = state.pop("resume")
+
+    #pick micro-batch size and accumulation steps from the memory budget
+    if args.max_memory_mb is not None:
+        def loss_fn(model, x, target):
+            with autocast(args.amp, device):
+                sed, doa = model(x)
+            return training_loss(sed.float(), doa.float(), target)
+        tr_dataset = tr_data.loader.dataset
+        val_dataset = val_data.dataset
+        x, target = tr_dataset[0]
+        args.batch_size, args.accumulation_steps = memory_budget_batch(unwrap_model(model), loss_fn,
+                    x.unsqueeze(0).to(device), target.unsqueeze(0).to(device),
+                    args.batch_size, args.max_memory_mb)
+        tr_data = TimedLoader(build_dataloader(tr_dataset, args, shuffle=True))
+        val_data = build_dataloader(val_dataset, args, shuffle=False)
+    world_size = torch.distributed.get_world_size() if args.distributed else 1
+    print ('Micro-batch size: {}, accumulation steps: {}, effective batch size: {}'.format(
+           args.batch_size, args.accumulation_steps, args.batch_size * args.accumulation_steps * world_size))
+
+    #checkpoints are written in background
+    checkpoint_writer = AsyncCheckpointWriter(args.keep_checkpoints, args.async_checkpoint)
+
+    #per-step timings are written next to the results dict
+    telemetry = TrainingTelemetry(os.path.join(args.results_path, 'telemetry.jsonl'),
+                                  device, enabled=is_main_process())
+    #optional torch.profiler capture of the first training steps
+    profiler = StepProfiler(args.profile_steps if is_main_process() else None,
+                            args.profile_dir or os.path.join(args.results_path, 'profile'),
+                            args.profile_warmup, device=device)
+
     #TRAIN MODEL
     print('TRAINING START')
     train_loss_hist = []
     val_loss_hist = []
     epoch = 1
+    resume_path = os.path.join(args.checkpoint_dir, "resume_checkpoint")
+    if resume is not None:
+        if resume["batch_size"] != args.batch_size:
+            raise ValueError("Resuming needs the batch size of the interrupted run: " + str(resume["batch_size"]))
+        train_loss_hist = resume["train_loss_hist"]
+        val_loss_hist = resume["val_loss_hist"]
+        epoch = resume["epoch"]
+        set_loader_seed(tr_data, resume["sampler_seed"])
+
+    def save_resume_checkpoint(epoch, batch, train_loss):
+        #everything needed to restart training after the first batch batches of epoch
+        resume_state = dict(state)
+        resume_state["resume"] = {"epoch": epoch,
+                                  "batch": batch,
+                                  "batch_size": args.batch_size,
+                                  "train_loss": float(train_loss),
+                                  "train_loss_hist": train_loss_hist,
+                                  "val_loss_hist": val_loss_hist,
+                                  "sampler_seed": loader_seed(tr_data),
+                                  "rng": get_rng_state()}
+        checkpoint_writer.save(model, optimizer, resume_state, resume_path)
+
+    checkpoint_path = os.path.join(args.checkpoint_dir, "checkpoint")
+
+    def early_stopping_update(val_loss, checkpoint_fn):
+        #early stopping check of a validation loss,
+        #checkpoint_fn() returns the checkpoint of the validated weights
+        val_loss_hist.append(val_loss)
+        if val_loss >= state["best_loss"]:
+            state["worse_epochs"] += 1
+        else:
+            print("MODEL IMPROVED ON VALIDATION SET!")
+            state["worse_epochs"] = 0
+            state["best_loss"] = val_loss
+            state["best_checkpoint"] = checkpoint_path
+
+            # CHECKPOINT
+            if is_main_process():
+                print("Saving model...")
+                checkpoint = checkpoint_fn()
+                checkpoint["state"] = dict(state)
+                checkpoint_writer.write(checkpoint, checkpoint_path)
+
+    #validation every val_every_steps steps on a subsample of the validation set,
+    #in a background process of rank 0 or synchronously
+    validator = None
+    val_snapshots = {}
+    if args.val_every_steps:
+        val_subset = validation_subset(val_data.dataset, args.val_subsample)
+        print ('Step validation on ' + str(len(val_subset)) + ' data points')
+        if not args.background_validation:
+            val_subset_data = build_dataloader(val_subset, args, shuffle=False)
+        elif is_main_process():
+            loss_fn = functools.partial(batch_loss, criterion_sed=criterion_sed, criterion_doa=criterion_doa,
+                                        amp=args.amp, sed_output_size=args.output_classes*args.class_overlaps,
+                                        sed_loss_weight=args.sed_loss_weight, doa_loss_weight=args.doa_loss_weight)
+            validator = BackgroundValidator(unwrap_model(model), loss_fn, val_subset,
+                                            args.batch_size, args.val_threads)
+
+    def consume_validation_results(block=False):
+        #early stopping on the losses of the snapshots validated in background,
+        #block waits for the snapshots still being validated
+        for step, val_loss in validator.results(block):
+            print("VALIDATION AT STEP {}: LOSS: {}".format(step, val_loss))
+            snapshot = val_snapshots.pop(step)
+            early_stopping_update(val_loss, lambda: snapshot)
+
+    def step_validation():
+        if not args.background_validation:
+            val_loss = float(evaluate(model, device, criterion_sed, criterion_doa, val_subset_data))
+            model.train()
+            print("VALIDATION AT STEP {}: LOSS: {}".format(state["step"], val_loss))
+            early_stopping_update(val_loss, lambda: checkpoint_writer.snapshot(model, optimizer, state))
+            return
+        if is_main_process():
+            consume_validation_results()
+            if validator.submit(state["step"], unwrap_model(model)):
+                val_snapshots[state["step"]] = checkpoint_writer.snapshot(model, optimizer, state)
+            else:
+                print("Validation process busy, skipping validation at step " + str(state["step"]))
+        #all processes follow the early stopping of rank 0
+        state.update(broadcast_object(state))
+
+    profiler.start()
     while state["worse_epochs"] < args.patience:
         print("Training epoch " + str(epoch))
-        avg_time = 0.
+        set_loader_epoch(tr_data, epoch)
+        telemetry.start_epoch(epoch)
         model.train()
         train_loss = 0.
-        with tqdm(total=len_tr_dataset // args.batch_size) as pbar:
-            for example_num, (x, target) in enumerate(tr_data):
-                target = target.to(device)
-                x = x.to(device)
-                t = time.time()
+        start_batch = 0
+        if resume is not None:
+            #skip the batches processed before the interruption
+            start_batch = resume["batch"]
+            train_loss = torch.tensor(resume["train_loss"], device=device)
+            set_loader_start(tr_data, start_batch)
+            set_rng_state(resume["rng"])
+            resume = None
+        n_batches = start_batch + len(tr_data)
+        optimizer.zero_grad()
+        with tqdm(total=n_batches, initial=start_batch, disable=not is_main_process()) as pbar:
+            for example_num, (x, target) in enumerate(tr_data, start_batch):
+                telemetry.add('data', tr_data.last_wait)
+                with telemetry.phase('to_device'):
+                    target = target.to(device)
+                    x = x.to(device)
                 # Compute loss for each instrument/model
-                optimizer.zero_grad()
-                sed, doa = model(x)
-
-                loss = seld_loss(x, target, model, criterion_sed, criterion_doa)
-                loss.backward()
-
-                train_loss += (1. / float(example_num + 1)) * (loss - train_loss)
-                optimizer.step()
-                state["step"] += 1
-                t = time.time() - t
-                avg_time += (1. / float(example_num + 1)) * (t - avg_time)
+                # gradients are accumulated over accumulation_steps micro-batches
+                update = (example_num + 1) % args.accumulation_steps == 0 or example_num + 1 == n_batches
+                with no_sync(model, update):
+                    with telemetry.phase('forward'):
+                        with autocast(args.amp, device):
+                            sed, doa = model(x)
+                        loss = training_loss(sed.float(), doa.float(), target)
+                    with telemetry.phase('backward'):
+                        (loss / args.accumulation_steps).backward()
+
+                train_loss += (1. / float(example_num + 1)) * (loss.detach() - train_loss)
+                if update:
+                    with telemetry.phase('optimizer'):
+                        optimizer.step()
+                        optimizer.zero_grad()
+                    state["step"] += 1
+                    if args.val_every_steps and state["step"] % args.val_every_steps == 0:
+                        step_validation()
+                    if args.checkpoint_every_steps and state["step"] % args.checkpoint_every_steps == 0 and is_main_process():
+                        save_resume_checkpoint(epoch, example_num + 1, train_loss)
+                telemetry.end_step(state["step"], x.shape[0])
+                profiler.step()
 
                 pbar.update(1)
+                if state["worse_epochs"] >= args.patience:
+                    break
 
-            #PASS VALIDATION DATA
-            val_loss = evaluate(model, device, criterion_sed, criterion_doa, val_data)
-            print("VALIDATION FINISHED: LOSS: " + str(val_loss))
+            telemetry.end_epoch(amp=args.amp, batch_size=args.batch_size,
+                                accumulation_steps=args.accumulation_steps)
 
-            # EARLY STOPPING CHECK
-            checkpoint_path = os.path.join(args.checkpoint_dir, "checkpoint")
+            if not args.val_every_steps:
+                #PASS VALIDATION DATA
+                val_loss = float(evaluate(model, device, criterion_sed, criterion_doa, val_data))
+                print("VALIDATION FINISHED: LOSS: " + str(val_loss))
 
-            if val_loss >= state["best_loss"]:
-                state["worse_epochs"] += 1
-            else:
-                print("MODEL IMPROVED ON VALIDATION SET!")
-                state["worse_epochs"] = 0
-                state["best_loss"] = val_loss
-                state["best_checkpoint"] = checkpoint_path
-
-                # CHECKPOINT
-                print("Saving model...")
-                save_model(model, optimizer, state, checkpoint_path)
+                # EARLY STOPPING CHECK
+                early_stopping_update(val_loss, lambda: checkpoint_writer.snapshot(model, optimizer, state))
 
             state["epochs"] += 1
             #state["worse_epochs"] = 200
-            train_loss_hist.append(train_loss.cpu().detach().numpy())
-            val_loss_hist.append(val_loss.cpu().detach().numpy())
+            train_loss_hist.append(reduce_mean(train_loss).cpu().detach().numpy())
+            if args.checkpoint_every_steps and is_main_process():
+                save_resume_checkpoint(epoch + 1, 0, 0.)
             epoch += 1
 
+    if args.val_every_steps and args.background_validation:
+        #the last submitted snapshot can still improve on the best model
+        if is_main_process():
+            consume_validation_results(block=True)
+            validator.close()
+        state.update(broadcast_object(state))
+    telemetry.close()
+    profiler.stop()
+
     #LOAD BEST MODEL AND COMPUTE LOSS FOR ALL SETS
     print("TESTING")
     # Load best model based on validation loss
+    checkpoint_writer.flush()
+    if args.distributed:
+        torch.distributed.barrier()  #wait for the last checkpoint written by rank 0
     state = load_model(model, None, state["best_checkpoint"], args.use_cuda)
     #compute loss on all set_output_size
-    train_loss = evaluate(model, device, criterion_sed, criterion_doa, tr_data)
+    #the full training set evaluation is optional
+    if args.teacher_path is not None:
+        #ground truth targets only
+        tr_data = build_dataloader(tr_data.loader.dataset.dataset, args, shuffle=False)
+    train_loss = evaluate(model, device, criterion_sed, criterion_doa, tr_data) if args.final_train_eval else None
     val_loss = evaluate(model, device, criterion_sed, criterion_doa, val_data)
+    test_data = build_dataloader(load_dataset(args, 'test', task=2), args, shuffle=False)
     test_loss = evaluate(model, device, criterion_sed, criterion_doa, test_data)
 
     #PRINT AND SAVE RESULTS
-    results = {'train_loss': train_loss.cpu().detach().numpy(),
+    results = {'train_loss': train_loss.cpu().detach().numpy() if train_loss is not None else None,
                'val_loss': val_loss.cpu().detach().numpy(),
                'test_loss': test_loss.cpu().detach().numpy(),
                'train_loss_hist': train_loss_hist,
@@ -271,8 +430,11 @@ def main(args):
     for i in results:
         if 'hist' not in i:
             print (i, results[i])
-    out_path = os.path.join(args.results_path, 'results_dict.json')
-    np.save(out_path, results)
+    if is_main_process():
+        out_path = os.path.join(args.results_path, 'results_dict.json')
+        np.save(out_path, results)
+    if args.distributed:
+        torch.distributed.destroy_process_group()
 
 
 if __name__ == '__main__':
@@ -282,8 +444,16 @@ if __name__ == '__main__':
                         help='Folder to write results dicts into')
     parser.add_argument('--checkpoint_dir', type=str, default='RESULTS/Task2',
                         help='Folder to write checkpoints into')
+    parser.add_argument('--compile', type=str, default='none',
+                        help='none, inductor (torch.compile the model, needs torch >= 2.0) or torchscript (torch.jit.trace per input shape, torch >= 1.10)')
+    parser.add_argument('--activation_checkpointing', type=str, default='False',
+                        help='recompute the cnn blocks in the backward pass: less memory, slower steps')
     parser.add_argument('--load_model', type=str, default=None,
                         help='Reload a previously trained model (whole task model)')
+    parser.add_argument('--async_checkpoint', type=str, default='True',
+                        help='write checkpoints on a background thread')
+    parser.add_argument('--keep_checkpoints', type=int, default=1,
+                        help='number of checkpoints to keep (older ones are renamed checkpoint.1, checkpoint.2, ...)')
     #dataset parameters
     parser.add_argument('--training_predictors_path', type=str, default='DATASETS/processed/task2_predictors_train.pkl')
     parser.add_argument('--training_target_path', type=str, default='DATASETS/processed/task2_target_train.pkl')
@@ -291,15 +461,38 @@ if __name__ == '__main__':
     parser.add_argument('--validation_target_path', type=str, default='DATASETS/processed/task2_target_validation.pkl')
     parser.add_argument('--test_predictors_path', type=str, default='DATASETS/processed/task2_predictors_test.pkl')
     parser.add_argument('--test_target_path', type=str, default='DATASETS/processed/task2_target_test.pkl')
+    add_dataset_args(parser, task=2)
+    add_profiler_args(parser)
+    add_distillation_args(parser)
     #training parameters
     parser.add_argument('--gpu_id', type=int, default=0)
     parser.add_argument('--use_cuda', type=str, default='True')
     parser.add_argument('--early_stopping', type=str, default='True')
     parser.add_argument('--fixed_seed', type=str, default='False')
-
+    parser.add_argument('--amp', type=str, default='none',
+                        help='none (fp32) or bf16 (bfloat16 autocast of the forward pass)')
+
+    parser.add_argument('--checkpoint_every_steps', type=int, default=None,
+                        help='write a resume checkpoint every this many optimizer steps and at the end of every epoch')
+    parser.add_argument('--resume', type=str, default=None,
+                        help='Resume an interrupted training from a resume_checkpoint, at the exact next batch')
+    parser.add_argument('--val_every_steps', type=int, default=None,
+                        help='validate every this many optimizer steps instead of at the end of every epoch (patience is then counted in validations)')
+    parser.add_argument('--val_subsample', type=float, default=1.,
+                        help='fraction of the validation set used by the step validation')
+    parser.add_argument('--background_validation', type=str, default='True',
+                        help='run the step validation in a separate process while training continues')
+    parser.add_argument('--val_threads', type=int, default=1,
+                        help='torch threads of the background validation process')
+    parser.add_argument('--final_train_eval', type=str, default='True',
+                        help='evaluate the best model on the whole training set at the end')
     parser.add_argument('--lr', type=float, default=0.00001)
     parser.add_argument('--batch_size', type=int, default=3,
-                        help="Batch size")
+                        help="Batch size, with --max_memory_mb it is the effective batch size")
+    parser.add_argument('--accumulation_steps', type=int, default=1,
+                        help="Micro-batches of gradient accumulation per optimizer step")
+    parser.add_argument('--max_memory_mb', type=float, default=None,
+                        help="Training memory budget: micro-batch size and accumulation steps are picked automatically")
     parser.add_argument('--sr', type=int, default=32000,
                         help="Sampling rate")
     parser.add_argument('--patience', type=int, default=100,
@@ -320,6 +513,8 @@ if __name__ == '__main__':
     parser.add_argument('--cnn_filters', type=str, default='[64,128,256,512]',
                         help= 'only for seldnet augmented')
     parser.add_argument('--pool_time', type=str, default='True')
+    parser.add_argument('--bidirectional', type=str, default='True',
+                        help='bidirectional gru, False for models that can be streamed')
     parser.add_argument('--rnn_size', type=int, default=256)
     parser.add_argument('--n_rnn', type=int, default=3)
     parser.add_argument('--fc_size', type=int, default=1024)
@@ -336,9 +531,16 @@ if __name__ == '__main__':
     args.use_cuda = eval(args.use_cuda)
     args.early_stopping = eval(args.early_stopping)
     args.fixed_seed = eval(args.fixed_seed)
+    args.async_checkpoint = eval(args.async_checkpoint)
+    args.background_validation = eval(args.background_validation)
+    args.final_train_eval = eval(args.final_train_eval)
+    args.teacher_args = eval(args.teacher_args)
+    args.activation_checkpointing = eval(args.activation_checkpointing)
     args.pool_size= eval(args.pool_size)
     args.pool_time = eval(args.pool_time)
     args.cnn_filters = eval(args.cnn_filters)
+    args.bidirectional = eval(args.bidirectional)
     args.verbose = eval(args.verbose)
+    eval_dataset_args(args, task=2)
 
     main(args)
@@ -1,31 +1,139 @@
 import os, sys
+import random
 import numpy as np
 import pickle
 import math
+import copy
+import warnings
+import queue
+import atexit
+import threading
+import contextlib
 import pandas as pd
 import torch
 from scipy.signal import stft
 import librosa
+from models.checkpointing import unwrap_model, is_compiling, checkpoint, set_activation_checkpointing
 
 '''
 Miscellaneous utilities
 '''
 
-def save_model(model, optimizer, state, path):
-    if isinstance(model, torch.nn.DataParallel):
-        model = model.module  # save state dict of wrapped module
+sound_classes_dict_task2 = {'Chink_and_clink':0,
+                           'Computer_keyboard':1,
+                           'Cupboard_open_or_close':2,
+                           'Drawer_open_or_close':3,
+                           'Female_speech_and_woman_speaking':4,
+                           'Finger_snapping':5,
+                           'Keys_jangling':6,
+                           'Knock':7,
+                           'Laughter':8,
+                           'Male_speech_and_man_speaking':9,
+                           'Printer':10,
+                           'Scissors':11,
+                           'Telephone':12,
+                           'Writing':13}
+
+
+def atomic_save(obj, path, keep_last=1):
+    '''
+    torch.save to a temporary file renamed to path, so that path always
+    contains a complete checkpoint. With keep_last > 1 the previous files
+    are rotated to path.1, path.2, ... path.(keep_last-1)
+    '''
     if len(os.path.dirname(path)) > 0 and not os.path.exists(os.path.dirname(path)):
         os.makedirs(os.path.dirname(path))
-    torch.save({
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    for i in range(keep_last - 1, 0, -1):
+        older = path + '.' + str(i - 1) if i > 1 else path
+        if os.path.exists(older):
+            os.replace(older, path + '.' + str(i))
+    os.replace(tmp_path, path)
+
+
+def save_model(model, optimizer, state, path):
+    model = unwrap_model(model)  # save state dict of wrapped module
+    atomic_save({
         'model_state_dict': model.state_dict(),
         'optimizer_state_dict': optimizer.state_dict(),
         'state': state,  # state of training loop (was 'step')
     }, path)
 
 
+def cpu_snapshot(obj):
+    '''
+    Copy of a (nested) state dict with all tensors cloned to cpu memory
+    '''
+    if torch.is_tensor(obj):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        return type(obj)((k, cpu_snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+class AsyncCheckpointWriter():
+    '''
+    Save checkpoints on a background thread, so that slow disks do not block training.
+    save() snapshots model, optimizer and training state to cpu memory and returns;
+    the files are written with atomic_save(), keeping the last keep_last checkpoints.
+    flush() waits for the pending writes and is also called at exit.
+    With async_write=False, save() writes synchronously.
+    '''
+    def __init__(self, keep_last=1, async_write=True):
+        self.keep_last = keep_last
+        self.async_write = async_write
+        self.error = None
+        self.queue = queue.Queue()
+        if async_write:
+            self.thread = threading.Thread(target=self.worker, daemon=True)
+            self.thread.start()
+            atexit.register(self.flush)
+
+    def worker(self):
+        while True:
+            obj, path = self.queue.get()
+            try:
+                atomic_save(obj, path, self.keep_last)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Checkpoint writing failed') from error
+
+    def snapshot(self, model, optimizer, state):
+        #checkpoint dict in cpu memory, that can be written later with write()
+        model = unwrap_model(model)
+        return cpu_snapshot({
+            'model_state_dict': model.state_dict(),
+            'optimizer_state_dict': optimizer.state_dict(),
+            'state': state,
+        })
+
+    def write(self, obj, path):
+        self.check_error()
+        if self.async_write:
+            self.queue.put((obj, path))
+        else:
+            atomic_save(obj, path, self.keep_last)
+
+    def save(self, model, optimizer, state, path):
+        self.write(self.snapshot(model, optimizer, state), path)
+
+    def flush(self):
+        if self.async_write:
+            self.queue.join()
+        self.check_error()
+
+
 def load_model(model, optimizer, path, cuda):
-    if isinstance(model, torch.nn.DataParallel):
-        model = model.module  # load state dict of wrapped module
+    model = unwrap_model(model)  # load state dict of wrapped module
     if cuda:
         checkpoint = torch.load(path)
     else:
@@ -52,6 +160,311 @@ def load_model(model, optimizer, path, cuda):
     return state
 
 
+def quantize_dynamic_int8(model):
+    '''
+    Dynamic int8 quantization of the GRU, LSTM and Linear layers of model, for cpu
+    inference: weights are stored in int8, activations are quantized on the fly
+    '''
+    model = unwrap_model(model).cpu().eval()
+    return torch.quantization.quantize_dynamic(model, {torch.nn.GRU, torch.nn.LSTM, torch.nn.Linear},
+                                               dtype=torch.qint8)
+
+
+def load_inference_model(model, path, cuda):
+    '''
+    Load a checkpoint for inference: either a checkpoint of the training scripts,
+    or an int8 checkpoint of quantize_model.py, loaded into a quantized copy of model.
+    Returns the model to use and the training state
+    '''
+    checkpoint = torch.load(path, map_location='cpu')
+    if checkpoint.get('quantization') == 'dynamic_int8':
+        if cuda:
+            raise ValueError('int8 quantized models can only run on cpu, use --use_cuda False')
+        model = quantize_dynamic_int8(model)
+        model.load_state_dict(checkpoint['model_state_dict'])
+        return model, checkpoint.get('state', {})
+    return model, load_model(model, None, path, cuda)
+
+
+def seld_loss(sed, doa, target, criterion_sed, criterion_doa, sed_output_size,
+              sed_loss_weight=1., doa_loss_weight=5.):
+    '''
+    Compute seld loss as weighted sum of sed (BCE) and doa (MSE) losses,
+    from the (sed, doa) outputs the model already computed for this batch.
+    sed_output_size is output_classes * class_overlaps
+    '''
+    #divide labels into sed and doa  (which are joint from the preprocessing)
+    target_sed = target[:,:,:sed_output_size]
+    target_doa = target[:,:,sed_output_size:]
+
+    sed = torch.flatten(sed, start_dim=1)
+    doa = torch.flatten(doa, start_dim=1)
+    target_sed = torch.flatten(target_sed, start_dim=1)
+    target_doa = torch.flatten(target_doa, start_dim=1)
+
+    loss_sed = criterion_sed(sed, target_sed) * sed_loss_weight
+    loss_doa = criterion_doa(doa, target_doa) * doa_loss_weight
+
+    return loss_sed + loss_doa
+
+
+def init_distributed(backend='gloo'):
+    '''
+    Join the process group set up by torchrun (RANK, WORLD_SIZE, MASTER_ADDR
+    and MASTER_PORT environment variables).
+    Printing is disabled on all processes except rank 0.
+    Returns rank, world size and local rank.
+    '''
+    if 'RANK' not in os.environ or 'WORLD_SIZE' not in os.environ:
+        raise RuntimeError('Distributed mode needs the environment variables set by torchrun')
+    torch.distributed.init_process_group(backend)
+    rank = torch.distributed.get_rank()
+    if rank != 0:
+        sys.stdout = open(os.devnull, 'w')
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    return rank, torch.distributed.get_world_size(), local_rank
+
+
+def is_main_process():
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank() == 0
+    return True
+
+
+def reduce_mean(value):
+    '''
+    Average a scalar (float or tensor) across all processes.
+    A no-op when not running distributed.
+    '''
+    if not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+        return value
+    value = torch.as_tensor(value, dtype=torch.float64).detach().cpu().clone()
+    torch.distributed.all_reduce(value)
+    return (value / torch.distributed.get_world_size()).float()
+
+
+def broadcast_object(obj):
+    '''
+    Send a picklable object from rank 0 to all processes.
+    A no-op when not running distributed.
+    '''
+    if not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+        return obj
+    objects = [obj]
+    torch.distributed.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+def autocast(amp, device):
+    '''
+    Mixed-precision context for the forward pass: bfloat16 autocast if amp is
+    'bf16', a disabled (fp32) context if amp is 'none'.
+    Losses should be computed outside of it, on .float() outputs.
+    '''
+    if amp not in ['none', 'bf16']:
+        raise ValueError('amp can only be none or bf16')
+    device_type = 'cuda' if 'cuda' in str(device) else 'cpu'
+    return torch.autocast(device_type, dtype=torch.bfloat16, enabled=amp=='bf16')
+
+
+def no_sync(model, sync):
+    '''
+    Skip the DistributedDataParallel gradient all-reduce when sync is False,
+    i.e. for all micro-batches but the last of a gradient accumulation
+    '''
+    model = getattr(model, '_orig_mod', model)
+    if isinstance(model, torch.nn.parallel.DistributedDataParallel) and not sync:
+        return model.no_sync()
+    return contextlib.nullcontext()
+
+
+class TracedModel(torch.nn.Module):
+    '''
+    TorchScript training of model with the torch versions without torch.compile:
+    a torch.jit.trace of model is taken at the first call of every train/eval mode
+    and input shapes, and run for the next calls. The traces share the parameters
+    and buffers of model, so they are trained by the optimizer of model and update
+    its BatchNorm statistics, and gradients flow through them.
+    The python control flow of the forward pass is fixed by the trace, including
+    the branches on input values (e.g. FaSNet with num_mic 0), which must not
+    change between calls of the same shapes. Activation checkpointing and autocast
+    are not traced.
+    '''
+    def __init__(self, model):
+        super(TracedModel, self).__init__()
+        self._orig_mod = model
+        #traces by (training, input shapes), in a dict and not as submodules that
+        #would duplicate the parameters of model in the state dict
+        self.graphs = {}
+
+    def forward(self, *inputs):
+        key = (self.training,) + tuple([tuple(x.shape) for x in inputs])
+        if key not in self.graphs:
+            #the tracing pass must not update the batchnorm statistics
+            buffers = [(b, b.clone()) for b in self._orig_mod.buffers()]
+            with torch.no_grad(), warnings.catch_warnings():
+                warnings.simplefilter('ignore', torch.jit.TracerWarning)
+                self.graphs[key] = torch.jit.trace(self._orig_mod, inputs, check_trace=False)
+                for b, saved in buffers:
+                    b.copy_(saved)
+        return self.graphs[key](*inputs)
+
+
+def compile_model(model, mode, example_inputs=None, training=False):
+    '''
+    Graph-compiled model for faster training and inference:
+    - none: the model itself
+    - inductor: torch.compile with the inductor backend (torch >= 2.0), sharing
+      the parameters of model. A graph is compiled for every input shape and
+      train/eval mode, at its first call
+    - torchscript: with training, a TracedModel (torch >= 1.10) tracing model for
+      every input shape and train/eval mode at its first call. For inference,
+      torch.jit.trace of the eval mode model with example_inputs (a tuple), frozen,
+      with inputs of the shape of example_inputs
+    '''
+    if mode == 'none':
+        return model
+    if mode == 'inductor':
+        if not hasattr(torch, 'compile'):
+            raise ValueError('--compile inductor needs torch >= 2.0, found ' + torch.__version__)
+        return torch.compile(model, backend='inductor')
+    if mode == 'torchscript' and training:
+        return TracedModel(model)
+    if mode == 'torchscript':
+        model.eval()
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example_inputs)
+        return torch.jit.freeze(traced)
+    raise ValueError('compile can only be none, inductor or torchscript')
+
+
+def storage_ptr(t):
+    #address of the storage of t, shared by all its views (untyped_storage since torch 2.0)
+    if hasattr(t, 'untyped_storage'):
+        return t.untyped_storage().data_ptr()
+    return t.storage().data_ptr()
+
+
+def activation_memory_mb(step_fn, exclude=()):
+    '''
+    Memory (MB) of the tensors saved for backward while running step_fn(),
+    counting every storage once. The tensors sharing the storage of a tensor
+    of exclude (e.g. the model parameters and inputs, which autograd also saves)
+    are not counted. This is the part of the training memory that grows with
+    the batch size.
+    '''
+    excluded = set([storage_ptr(t) for t in exclude])
+    storages = {}
+    def pack(t):
+        if storage_ptr(t) not in excluded:
+            storages[t.data_ptr()] = t.numel() * t.element_size()
+        return t
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        step_fn()
+    return sum(storages.values()) / 2.**20
+
+
+def count_macs(model, inputs):
+    '''
+    Multiply-accumulate operations of a forward pass of model on inputs,
+    counted with forward hooks on the convolution, linear and recurrent layers
+    (elementwise operations and normalizations are not counted)
+    '''
+    macs = [0]
+    def conv_hook(m, input, output):
+        macs[0] += output.numel() * (m.in_channels // m.groups) * int(np.prod(m.kernel_size))
+    def linear_hook(m, input, output):
+        macs[0] += output.numel() * m.in_features
+    def rnn_hook(m, input, output):
+        x = input[0]
+        if isinstance(x, torch.nn.utils.rnn.PackedSequence):
+            steps = x.data.shape[0]  #batch * time, without the padded frames
+        elif x.dim() == 2:
+            steps = x.shape[0]  #unbatched sequence
+        else:
+            steps = x.shape[0] * x.shape[1]  #batch * time, with or without batch_first
+        gates = {'LSTM': 4, 'GRU': 3}.get(m.mode, 1)
+        directions = 2 if m.bidirectional else 1
+        per_step = 0
+        for layer in range(m.num_layers):
+            in_size = m.input_size if layer == 0 else m.hidden_size * directions
+            per_step += directions * gates * (in_size + m.hidden_size) * m.hidden_size
+        macs[0] += steps * per_step
+    hooks = []
+    for m in model.modules():
+        if isinstance(m, (torch.nn.Conv1d, torch.nn.Conv2d)):
+            hooks.append(m.register_forward_hook(conv_hook))
+        elif isinstance(m, torch.nn.Linear):
+            hooks.append(m.register_forward_hook(linear_hook))
+        elif isinstance(m, torch.nn.RNNBase):
+            hooks.append(m.register_forward_hook(rnn_hook))
+    with torch.no_grad():
+        model(*inputs)
+    for h in hooks:
+        h.remove()
+    return macs[0]
+
+
+def memory_budget_batch(model, loss_fn, x, target, batch_size, max_memory_mb):
+    '''
+    Pick micro-batch size and gradient accumulation steps that give an effective
+    batch of batch_size while keeping the training memory under max_memory_mb.
+    The memory per data point is probed running forward and backward with
+    batches of 1 and 2 copies of the data point (x, target), of shape [1, ...].
+    loss_fn(model, x, target) must return the loss of a batch.
+    '''
+    def probe(n):
+        #tensors saved by the forward pass only: with activation checkpointing the
+        #recomputation in the backward pass holds a single layer at a time.
+        #The parameters are counted in fixed below, not in the probe
+        losses = []
+        mem = activation_memory_mb(lambda: losses.append(
+              loss_fn(model, x.repeat_interleave(n, 0), target.repeat_interleave(n, 0))),
+              list(model.parameters()))
+        losses[0].backward()
+        model.zero_grad()
+        return mem
+
+    #the probe steps must not change batchnorm statistics
+    model_state = copy.deepcopy(model.state_dict())
+    model.train()
+    mem_1 = probe(1)
+    per_sample = max(probe(2) - mem_1, 1e-6)
+    model.load_state_dict(model_state)
+    #parameters, gradients and the two Adam moments
+    params_mb = sum([p.numel() * p.element_size() for p in model.parameters()]) / 2.**20
+    fixed = max(mem_1 - per_sample, 0.) + 4 * params_mb
+    micro_batch = int((max_memory_mb - fixed) // per_sample)
+    if micro_batch < 1:
+        raise ValueError('max_memory_mb is too small: a single data point needs ' +
+                         str(int(fixed + per_sample)) + ' MB')
+    micro_batch = min(micro_batch, batch_size)
+    accumulation_steps = int(math.ceil(batch_size / micro_batch))
+    print ('Memory per data point: {:.1f} MB, fixed: {:.1f} MB'.format(per_sample, fixed))
+    return micro_batch, accumulation_steps
+
+
+def get_rng_state():
+    '''
+    State of all random generators used in training (python, numpy, torch
+    and cuda), to be stored in resume checkpoints
+    '''
+    state = {'python': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
 def spectrum_fast(x, nperseg=512, noverlap=128, window='hamming', cut_dc=True,
                   output_phase=True, cut_last_timeframe=True):
     '''